@@ -0,0 +1,108 @@
+"""Benchmark de la preparación de audio para el reconocedor.
+
+Compara, clip por clip, el camino anterior (probar soundfile, y al fallar pydub/ffmpeg
+con mezcla y remuestreo en pydub) con el actual de main.py (contenedor por magic bytes,
+mezcla y remuestreo con numpy y recorte de silencio). Informa el tiempo de decodificación
+de cada uno y cuántos segundos de audio dejan de llegar al reconocedor.
+
+Uso:
+    python bench_audio.py [carpeta_o_archivos...] [--repeat N]
+
+Por defecto usa los clips de audio_messages/. Los webm/mp4 necesitan ffmpeg instalado.
+"""
+import argparse
+import glob
+import io
+import os
+import statistics
+import time
+
+import soundfile as sf
+from pydub import AudioSegment
+
+import main
+
+
+def decode_before(audio_bytes: bytes) -> bytes:
+    """Como decodificaba transcribe_audio antes de sniff_container/voiced_span."""
+    try:
+        with io.BytesIO(audio_bytes) as audio_file:
+            data, samplerate = sf.read(audio_file)
+        with io.BytesIO() as wav_io:
+            sf.write(wav_io, data, samplerate, format="WAV", subtype="PCM_16")
+            return wav_io.getvalue()
+    except Exception:
+        pass
+    with io.BytesIO(audio_bytes) as audio_file:
+        audio_segment = AudioSegment.from_file(audio_file, format="webm")
+    audio_segment = audio_segment.set_channels(1).set_frame_rate(16000)
+    with io.BytesIO() as wav_io:
+        audio_segment.export(wav_io, format="wav")
+        return wav_io.getvalue()
+
+
+def wav_seconds(wav_bytes: bytes) -> float:
+    if not wav_bytes:
+        return 0.0
+    with io.BytesIO(wav_bytes) as wav_io:
+        return sf.info(wav_io).duration
+
+
+def timed(fn, audio_bytes: bytes, repeat: int):
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn(audio_bytes)
+        times.append(time.perf_counter() - started)
+    return result, statistics.median(times) * 1000
+
+
+def collect(paths):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(f for f in glob.glob(os.path.join(path, "*")) if os.path.isfile(f)))
+        else:
+            files.append(path)
+    return files
+
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("paths", nargs="*", default=["audio_messages"])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'clip':32} {'tipo':5} {'antes ms':>9} {'ahora ms':>9} {'ahorro ms':>10} {'audio s':>8} {'al recon. s':>11}")
+    totals = {"before": 0.0, "after": 0.0, "audio": 0.0, "speech": 0.0, "clips": 0}
+    for path in collect(args.paths):
+        with open(path, "rb") as f:
+            audio_bytes = f.read()
+        name = os.path.basename(path)[:32]
+        container = main.sniff_container(audio_bytes) or "?"
+        try:
+            before_wav, before_ms = timed(decode_before, audio_bytes, args.repeat)
+            after_wav, after_ms = timed(main._decode_clip_to_wav, audio_bytes, args.repeat)
+        except Exception as e:
+            print(f"{name:32} {container:5} no se pudo decodificar: {e}")
+            continue
+        audio_s, speech_s = wav_seconds(before_wav), wav_seconds(after_wav)
+        print(f"{name:32} {container:5} {before_ms:9.2f} {after_ms:9.2f} {before_ms - after_ms:10.2f} "
+              f"{audio_s:8.2f} {speech_s:11.2f}")
+        totals["before"] += before_ms
+        totals["after"] += after_ms
+        totals["audio"] += audio_s
+        totals["speech"] += speech_s
+        totals["clips"] += 1
+
+    if not totals["clips"]:
+        print("Ningún clip decodificado.")
+        return
+    clips = totals["clips"]
+    print(f"\n{clips} clips: decodificación {totals['before'] / clips:.2f} ms -> {totals['after'] / clips:.2f} ms "
+          f"por clip; al reconocedor {totals['speech']:.1f} s de {totals['audio']:.1f} s de audio "
+          f"({100 * (1 - totals['speech'] / totals['audio']) if totals['audio'] else 0:.0f}% menos).")
+
+
+if __name__ == "__main__":
+    run()
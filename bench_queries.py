@@ -0,0 +1,113 @@
+"""Benchmark de las consultas calientes que cubren los índices de la migración 4.
+
+Siembra una base SQLite temporal con mensajes repartidos en varios días y con canales, y
+mide cada consulta con los índices (como corre en main.py) y forzando el recorrido de la
+tabla con NOT INDEXED, que es lo que hacía la base antes de la migración:
+  - la página del historial de get_history_page (por id, hacia atrás desde un cursor);
+  - el lote de mensajes vencidos de expire_messages_batch, en la pasada habitual en la
+    que no queda nada vencido;
+  - la búsqueda de canal sin importar mayúsculas de create_group/join_group;
+  - la pregunta de si un audio_hash sigue en uso (limpieza de blobs huérfanos).
+La página del historial va por la clave primaria, que NOT INDEXED no deshabilita: las dos
+columnas tienen que dar parecido, y la fila queda como referencia de lo que cuesta cada
+reconexión.
+
+Uso:
+    python bench_queries.py [--messages N] [--channels N] [--days N] [--repeat N]
+
+Trabaja siempre sobre SQLite: NOT INDEXED no existe en Postgres, y borrar índices para
+comparar no es algo para hacer sobre la base de producción.
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+SURNAMES = ["Perez", "Gomez", "Ruiz", "Diaz", "Sosa", "Vera", "Rios", "Luna"]
+FUNCTIONS = ["Maletero", "Tractorista", "Supervisor", "Rampa"]
+
+
+def seed(main, messages: int, channels: int, days: int, rng: random.Random):
+    today = main.datetime.utcnow()
+    # En orden cronológico, como llegan: los ids crecen con la fecha
+    moments = sorted(today - main.timedelta(days=rng.randrange(days), minutes=rng.randrange(24 * 60))
+                     for _ in range(messages))
+    rows = []
+    for i, moment in enumerate(moments):
+        rows.append((f"{rng.choice(SURNAMES)}_{rng.choice(FUNCTIONS)}", "Pendiente de transcripción",
+                     moment.strftime("%H:%M"), moment.strftime("%Y-%m-%d"), f"{i:064x}"))
+    with main.db_connection() as conn:
+        c = conn.cursor()
+        c.executemany(main.q("INSERT INTO messages (user_id, text, timestamp, date, audio_hash) "
+                             "VALUES (?, ?, ?, ?, ?)"), rows)
+        c.executemany(main.q("INSERT INTO channels (name, password_hash, created_at) VALUES (?, ?, ?)"),
+                      [(f"Canal{i}", "x", today.isoformat()) for i in range(channels)])
+
+
+def queries(main, messages: int, channels: int, days: int, rng: random.Random):
+    # La retención corre seguido y casi siempre no encuentra nada: lo vencido ya se borró
+    # en la pasada anterior. El corte es el día más viejo que quedó.
+    cutoff = (main.datetime.utcnow() - main.timedelta(days=days - 1)).strftime("%Y-%m-%d")
+    return [
+        ("historial WHERE id < ? ORDER BY id DESC",
+         f"SELECT {main.HISTORY_META_COLUMNS} FROM messages {{hint}} WHERE id < ? ORDER BY id DESC LIMIT ?",
+         lambda: (rng.randrange(messages) + 1, main.HISTORY_PAGE_SIZE)),
+        ("vencidos WHERE date < ? (retención)",
+         "SELECT id FROM messages {hint} WHERE date < ? ORDER BY date, timestamp, id LIMIT ?",
+         lambda: (cutoff, main.RETENTION_BATCH_SIZE)),
+        ("canal por LOWER(name)",
+         "SELECT name FROM channels {hint} WHERE LOWER(name) = LOWER(?)",
+         lambda: (f"CANAL{rng.randrange(channels)}",)),
+        ("audio_hash en uso",
+         "SELECT 1 FROM messages {hint} WHERE audio_hash = ? LIMIT 1",
+         lambda: (f"{rng.randrange(messages):064x}",)),
+    ]
+
+
+def measure(main, sql: str, params, repeat: int) -> float:
+    times = []
+    with main.db_connection() as conn:
+        c = conn.cursor()
+        for _ in range(repeat):
+            args = params()
+            started = time.perf_counter()
+            c.execute(main.q(sql), args)
+            c.fetchall()
+            times.append((time.perf_counter() - started) * 1000)
+    return statistics.mean(times)
+
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=300000)
+    parser.add_argument("--channels", type=int, default=50000)
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    # Vacía (y no ausente) para que load_dotenv no la complete desde un .env
+    os.environ["DATABASE_URL"] = ""
+    os.environ["SQLITE_PATH"] = os.path.join(tempfile.mkdtemp(), "bench_queries.db")
+    sys.argv = sys.argv[:1]
+    import main
+
+    rng = random.Random(1234)
+    main.init_db()
+    started = time.perf_counter()
+    seed(main, args.messages, args.channels, args.days, rng)
+    with main.db_connection() as conn:
+        conn.cursor().execute("ANALYZE")
+    print(f"{args.messages} mensajes y {args.channels} canales sembrados en {time.perf_counter() - started:.1f} s "
+          f"(SQLite {main.SQLITE_PATH}), media de {args.repeat} corridas")
+    print(f"{'consulta':40} {'sin índice ms':>14} {'con índice ms':>14}")
+    for name, sql, params in queries(main, args.messages, args.channels, args.days, rng):
+        without = measure(main, sql.format(hint="NOT INDEXED"), params, args.repeat)
+        with_index = measure(main, sql.format(hint=""), params, args.repeat)
+        print(f"{name:40} {without:14.2f} {with_index:14.2f}")
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,127 @@
+"""Benchmark de la búsqueda en las transcripciones.
+
+Siembra un corpus de mensajes con frases de rampa generadas al azar y mide la latencia
+de search_messages (índice FTS5 / tsvector) contra el recorrido con LIKE que era la única
+alternativa antes del índice, para una mezcla de búsquedas con y sin filtros.
+
+Uso:
+    python bench_search.py [--messages N] [--queries N] [--postgres]
+
+Por defecto trabaja sobre una base SQLite temporal. Con --postgres usa la de DATABASE_URL:
+los mensajes sembrados llevan usuario "bench_*" y se borran al terminar.
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+WORDS = {
+    "lugar": ["puerta", "posición", "manga", "plataforma", "hangar", "cinta", "bodega", "pista"],
+    "cosa": ["tractor", "carro", "valija", "contenedor", "escalera", "combustible", "pushback", "GPU"],
+    "acción": ["necesito", "mandame", "llevá", "revisá", "liberá", "esperá", "confirmá", "cargá"],
+    "relleno": ["ya", "urgente", "cuando puedas", "por favor", "ahora", "en cinco", "otra vez", "dale"],
+}
+GROUPS = ["Rampa", "Torre", "Equipos", "Cargas"]
+USERS = [f"bench_{name}_{function}" for name in ("Perez", "Gomez", "Ruiz", "Diaz", "Sosa", "Vera")
+         for function in ("Maletero", "Tractorista", "Supervisor")]
+
+
+def phrase(rng: random.Random) -> str:
+    return (f"{rng.choice(WORDS['acción'])} {rng.choice(WORDS['cosa'])} en {rng.choice(WORDS['lugar'])} "
+            f"{rng.randint(1, 40)} {rng.choice(WORDS['relleno'])}")
+
+
+def seed(main, count: int, rng: random.Random):
+    now = main.datetime.utcnow()
+    batch = []
+    for i in range(count):
+        moment = now - main.timedelta(minutes=rng.randint(0, 20 * 60))
+        batch.append((rng.choice(USERS), phrase(rng), moment.strftime("%H:%M"), moment.strftime("%Y-%m-%d"),
+                      rng.choice(GROUPS)))
+    with main.db_connection() as conn:
+        c = conn.cursor()
+        c.executemany(main.q("INSERT INTO messages (user_id, text, timestamp, date, group_id) VALUES (?, ?, ?, ?, ?)"),
+                      batch)
+
+
+def search_like(main, terms, user_id=None, group_id=None, limit=20):
+    """Lo que había que hacer sin índice: un LIKE por palabra sobre toda la tabla."""
+    sql = "SELECT id, text FROM messages WHERE " + " AND ".join("LOWER(text) LIKE ?" for _ in terms)
+    params = [f"%{term}%" for term in terms]
+    if user_id:
+        sql += " AND user_id = ?"
+        params.append(user_id)
+    if group_id:
+        sql += " AND group_id = ?"
+        params.append(group_id)
+    sql += " ORDER BY id DESC LIMIT ?"
+    params.append(limit)
+    with main.db_connection() as conn:
+        c = conn.cursor()
+        c.execute(main.q(sql), params)
+        return c.fetchall()
+
+
+def workload(rng: random.Random, count: int):
+    queries = []
+    for _ in range(count):
+        kind = rng.random()
+        terms = [rng.choice(WORDS["lugar"]), str(rng.randint(1, 40))] if kind < 0.5 else [rng.choice(WORDS["cosa"])]
+        filters = {}
+        if rng.random() < 0.3:
+            filters["user_id"] = rng.choice(USERS)
+        if rng.random() < 0.3:
+            filters["group_id"] = rng.choice(GROUPS)
+        queries.append(([term.lower() for term in terms], filters))
+    return queries
+
+
+def measure(fn, queries):
+    times = []
+    hits = 0
+    for terms, filters in queries:
+        started = time.perf_counter()
+        hits += len(fn(terms, **filters))
+        times.append((time.perf_counter() - started) * 1000)
+    times.sort()
+    return statistics.median(times), times[int(len(times) * 0.95) - 1], hits
+
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=50000)
+    parser.add_argument("--queries", type=int, default=300)
+    parser.add_argument("--postgres", action="store_true")
+    args = parser.parse_args()
+
+    if not args.postgres:
+        # Vacía (y no ausente) para que load_dotenv no la complete desde un .env
+        os.environ["DATABASE_URL"] = ""
+        os.environ["SQLITE_PATH"] = os.path.join(tempfile.mkdtemp(), "bench_search.db")
+    sys.argv = sys.argv[:1]
+    import main
+
+    rng = random.Random(1234)
+    main.init_db()
+    started = time.perf_counter()
+    seed(main, args.messages, rng)
+    print(f"{args.messages} mensajes sembrados en {time.perf_counter() - started:.1f} s "
+          f"({'Postgres' if main.USE_POSTGRES else 'SQLite ' + main.SQLITE_PATH})")
+    try:
+        queries = workload(rng, args.queries)
+        print(f"{'método':10} {'p50 ms':>8} {'p95 ms':>8} {'resultados':>11}")
+        for name, fn in (("índice", lambda terms, **f: main.search_messages(terms, **f)),
+                         ("LIKE", lambda terms, **f: search_like(main, terms, **f))):
+            p50, p95, hits = measure(fn, queries)
+            print(f"{name:10} {p50:8.2f} {p95:8.2f} {hits:11}")
+    finally:
+        if main.USE_POSTGRES:
+            with main.db_connection() as conn:
+                conn.cursor().execute("DELETE FROM messages WHERE user_id LIKE 'bench\\_%'")
+
+
+if __name__ == "__main__":
+    run()
@@ -128,7 +128,8 @@ async function queueMessage(message) {
         const db = await openDB();
         const tx = db.transaction(MESSAGE_QUEUE, 'readwrite');
         const store = tx.objectStore(MESSAGE_QUEUE);
-        const messageWithTimestamp = { ...message, timestamp: Date.now() };
+        // queued_at y no timestamp: timestamp es la hora del mensaje que muestra el chat
+        const messageWithTimestamp = { ...message, queued_at: Date.now() };
         await store.add(messageWithTimestamp);
         await tx.done;
         console.log('Mensaje encolado:', messageWithTimestamp);
@@ -146,14 +147,15 @@ async function syncMessages() {
         const messages = await store.getAll();
         const now = Date.now();
         for (const message of messages) {
-            if (now - message.timestamp > MAX_MESSAGE_AGE) {
+            if (now - (message.queued_at || message.timestamp) > MAX_MESSAGE_AGE) {
                 console.log('Descartando mensaje antiguo:', message);
                 await store.delete(message.id);
                 continue;
             }
             try {
                 console.log('Sincronizando mensaje:', message);
-                await notifyClient({ ...message, priority: message.priority || 'normal' });
+                const { id, queued_at, ...payload } = message;
+                await notifyClient({ ...payload, priority: message.priority || 'normal' });
                 await store.delete(message.id);
             } catch (err) {
                 console.error('Error al sincronizar mensaje:', message, err);
@@ -172,12 +174,12 @@ async function syncMessages() {
 async function notifyClient(message) {
     const clients = await self.clients.matchAll({ includeUncontrolled: true });
     if (clients.length === 0) {
-        console.warn('No hay clientes activos:', message);
-        return;
+        // Sin pestañas abiertas el mensaje queda en la cola para el próximo sync
+        throw new Error('No hay clientes activos');
     }
-    clients.forEach(client => {
-        client.postMessage({ type: 'SEND_MESSAGE', message });
-    });
+    // Una sola pestaña lo manda; si otra ya lo había mandado, el servidor lo descarta
+    // por su client_key.
+    clients[0].postMessage({ type: 'SEND_MESSAGE', message });
 }
 
 function openDB() {
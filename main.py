@@ -1,20 +1,30 @@
 import asyncio
 import base64
 import contextlib
+import gzip
 import json
 import os
 import time
 from datetime import datetime, timedelta
 import sqlite3
-from typing import Dict, List, Optional, Set
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException
+import threading
+import functools
+import hashlib
+import hmac
+import re
+import struct
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Dict, List, Optional, Set, Tuple
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Query, Request
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse, FileResponse
+from fastapi.responses import HTMLResponse, FileResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 import logging
 import speech_recognition as sr
 import io
 import soundfile as sf
+import numpy as np
 from pydub import AudioSegment
 from dotenv import load_dotenv
 from pydantic import BaseModel, validator
@@ -42,21 +52,219 @@ USE_POSTGRES = bool(DATABASE_URL)
 if USE_POSTGRES:
     import psycopg2
 
+# Pool de conexiones. Antes cada db_connection() abría una conexión nueva (TCP +
+# autenticación contra Postgres) y la cerraba al salir -- incluído el save_session de
+# cada 'ping', así que con unos cientos de handies eran miles de handshakes por minuto
+# contra un Postgres con tope bajo de conexiones. Ahora las conexiones se reutilizan.
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "5"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))  # segundos esperando una conexión libre
+DB_POOL_HEALTHCHECK_SECONDS = float(os.getenv("DB_POOL_HEALTHCHECK_SECONDS", "30"))
+SQLITE_PATH = os.getenv("SQLITE_PATH", "chat_history.db")
+
+class PoolTimeout(Exception):
+    """No se liberó ninguna conexión del pool dentro de DB_POOL_TIMEOUT."""
+
+class PostgresPool:
+    """Pool de conexiones psycopg2 con tamaño mínimo/máximo, espera acotada y chequeo
+    de salud. Una conexión que estuvo ociosa más de `healthcheck_after` segundos se
+    prueba con un SELECT 1 antes de entregarla (Render corta las conexiones inactivas
+    sin avisar), y si falla se reemplaza por una nueva."""
+
+    def __init__(self, dsn: str, minconn: int, maxconn: int, timeout: float, healthcheck_after: float):
+        self.dsn = dsn
+        self.minconn = max(0, min(minconn, maxconn))
+        self.maxconn = max(1, maxconn)
+        self.timeout = timeout
+        self.healthcheck_after = healthcheck_after
+        self._idle: List[tuple] = []  # (conexión, momento en que se devolvió)
+        self._size = 0  # conexiones abiertas en total (ociosas + prestadas)
+        self._cond = threading.Condition()
+        self._closed = False
+
+    def warm(self):
+        """Abre de entrada las `minconn` conexiones mínimas."""
+        while True:
+            with self._cond:
+                if self._size >= self.minconn:
+                    return
+                self._size += 1
+            try:
+                conn = psycopg2.connect(self.dsn)
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                raise
+            with self._cond:
+                self._idle.append((conn, time.monotonic()))
+                self._cond.notify()
+
+    def acquire(self):
+        deadline = time.monotonic() + self.timeout
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise PoolTimeout("El pool de conexiones está cerrado")
+                if self._idle:
+                    conn, idle_since = self._idle.pop()
+                    break
+                if self._size < self.maxconn:
+                    self._size += 1
+                    conn, idle_since = None, None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolTimeout(f"Sin conexiones libres tras {self.timeout:g}s (máximo {self.maxconn})")
+                self._cond.wait(remaining)
+
+        if conn is not None and self._is_healthy(conn, idle_since):
+            return conn
+        if conn is not None:
+            self._close_quietly(conn)
+        try:
+            return psycopg2.connect(self.dsn)
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+
+    def release(self, conn, broken: bool = False):
+        with self._cond:
+            if broken or conn.closed or self._closed:
+                self._size -= 1
+                self._close_quietly(conn)
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            for conn, _ in self._idle:
+                self._size -= 1
+                self._close_quietly(conn)
+            self._idle.clear()
+            self._cond.notify_all()
+
+    def stats(self) -> Dict[str, int]:
+        with self._cond:
+            return {"size": self._size, "idle": len(self._idle), "max": self.maxconn}
+
+    def _is_healthy(self, conn, idle_since: float) -> bool:
+        if conn.closed:
+            return False
+        if time.monotonic() - idle_since < self.healthcheck_after:
+            return True
+        try:
+            with conn.cursor() as c:
+                c.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except Exception as e:
+            logger.warning(f"Conexión del pool descartada por chequeo de salud: {e}")
+            return False
+
+    @staticmethod
+    def _close_quietly(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+class SQLiteConnection:
+    """Una única conexión SQLite persistente en modo WAL, compartida por todos los
+    helpers. SQLite no gana nada con varias conexiones de escritura, así que en lugar
+    de un pool hay un lock: cada db_connection() tiene la conexión en exclusiva hasta
+    que sale del bloque `with`."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn = None
+        self._lock = threading.RLock()
+
+    def acquire(self):
+        self._lock.acquire()
+        try:
+            if self._conn is None:
+                conn = sqlite3.connect(self.path, check_same_thread=False, timeout=DB_POOL_TIMEOUT)
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("PRAGMA synchronous=NORMAL")
+                self._conn = conn
+            return self._conn
+        except Exception:
+            self._lock.release()
+            raise
+
+    def release(self, conn, broken: bool = False):
+        try:
+            if broken and self._conn is conn:
+                self._conn = None
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+        finally:
+            self._lock.release()
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def stats(self) -> Dict[str, int]:
+        return {"size": 1 if self._conn is not None else 0, "idle": 1, "max": 1}
+
+_db_pool = None
+_db_pool_lock = threading.Lock()
+
+def get_db_pool():
+    """Crea el pool la primera vez que se lo necesita (no al importar el módulo)."""
+    global _db_pool
+    if _db_pool is None:
+        with _db_pool_lock:
+            if _db_pool is None:
+                if USE_POSTGRES:
+                    pool = PostgresPool(DATABASE_URL, DB_POOL_MIN, DB_POOL_MAX,
+                                        DB_POOL_TIMEOUT, DB_POOL_HEALTHCHECK_SECONDS)
+                    try:
+                        pool.warm()
+                    except Exception as e:
+                        logger.error(f"No se pudieron precalentar las conexiones del pool: {e}")
+                    _db_pool = pool
+                else:
+                    _db_pool = SQLiteConnection(SQLITE_PATH)
+    return _db_pool
+
+def close_db_pool():
+    global _db_pool
+    with _db_pool_lock:
+        if _db_pool is not None:
+            _db_pool.close()
+            _db_pool = None
+
 @contextlib.contextmanager
 def db_connection():
     """Reemplaza los `with sqlite3.connect(...) as conn` de antes: misma forma de uso
-    (commit automático al salir sin error), pero además cierra siempre la conexión --
-    Postgres en el plan gratis tiene un límite bajo de conexiones simultáneas, y el
-    patrón anterior nunca las cerraba explícitamente."""
-    conn = psycopg2.connect(DATABASE_URL) if USE_POSTGRES else sqlite3.connect("chat_history.db")
+    (commit automático al salir sin error, rollback si hubo excepción), pero la conexión
+    sale del pool y vuelve a él al terminar en lugar de abrirse y cerrarse cada vez."""
+    pool = get_db_pool()
+    conn = pool.acquire()
+    broken = False
     try:
         yield conn
         conn.commit()
     except Exception:
-        conn.rollback()
+        try:
+            conn.rollback()
+        except Exception:
+            # Si ni siquiera se puede hacer rollback, la conexión quedó inutilizable
+            # (típicamente la cortó el servidor): no se devuelve al pool.
+            broken = True
         raise
     finally:
-        conn.close()
+        pool.release(conn, broken=broken)
 
 def q(sql: str) -> str:
     """Traduce los placeholders '?' de SQLite a '%s' de Postgres cuando corresponde."""
@@ -183,88 +391,368 @@ async def health_check():
 async def get_service_worker():
     return FileResponse("handlysw.js", media_type="application/javascript")
 
-# Inicializar base de datos (Postgres en producción, SQLite en desarrollo local)
-def init_db():
-    try:
-        id_column = "id SERIAL PRIMARY KEY" if USE_POSTGRES else "id INTEGER PRIMARY KEY"
+# --- Migraciones de esquema ---
+# Cada migración es una función que recibe un cursor y se aplica una sola vez, en orden,
+# dentro de su propia transacción; la versión aplicada queda anotada en schema_version.
+# Las primeras están escritas para ser idempotentes porque las bases que ya estaban en
+# producción tienen esas tablas/columnas creadas desde antes de que existiera el runner.
+def _add_column(c, table: str, column_def: str):
+    if USE_POSTGRES:
+        c.execute(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {column_def}")
+        return
+    c.execute(f"PRAGMA table_info({table})")
+    existing = {row[1] for row in c.fetchall()}
+    if column_def.split()[0] not in existing:
+        c.execute(f"ALTER TABLE {table} ADD COLUMN {column_def}")
+
+def _migration_base_tables(c):
+    id_column = "id SERIAL PRIMARY KEY" if USE_POSTGRES else "id INTEGER PRIMARY KEY"
+    c.execute(f'''CREATE TABLE IF NOT EXISTS messages
+                 ({id_column}, user_id TEXT, audio TEXT, text TEXT, timestamp TEXT, date TEXT)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS sessions
+                 (token TEXT PRIMARY KEY, user_id TEXT, name TEXT, function TEXT, group_id TEXT,
+                  muted_users TEXT, last_active TIMESTAMP)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS users
+                 (surname TEXT PRIMARY KEY, employee_id TEXT, sector TEXT, password TEXT)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS channels
+                 (name TEXT PRIMARY KEY, password_hash TEXT, created_at TEXT)''')
+
+def _migration_message_duration(c):
+    _add_column(c, "messages", "duration INTEGER")
+
+def _migration_audio_store(c):
+    # Audio guardado aparte, direccionado por contenido (sha256): el mensaje
+    # solo referencia el hash. La columna `audio` queda para mensajes viejos.
+    for column in ("audio_hash TEXT", "audio_size INTEGER", "audio_mime TEXT"):
+        _add_column(c, "messages", column)
+    blob_type = "BYTEA" if USE_POSTGRES else "BLOB"
+    c.execute(f'''CREATE TABLE IF NOT EXISTS audio_blobs
+                 (hash TEXT PRIMARY KEY, mime TEXT, size INTEGER, data {blob_type}, created_at TEXT)''')
+
+def _migration_hot_query_indexes(c):
+    # - (date, timestamp): el lote de vencidos de la retención (expire_messages_batch), que
+    #   sin índice recorría la tabla entera aun cuando no había nada vencido. La página del
+    #   historial (get_history_page) va por id y le alcanza la clave primaria.
+    # - LOWER(name): cada create_group/join_group busca el canal sin importar mayúsculas;
+    #   sin un índice de expresión eso recorría la tabla entera.
+    # - audio_hash: la limpieza de blobs huérfanos pregunta qué hashes siguen en uso.
+    c.execute("CREATE INDEX IF NOT EXISTS idx_messages_date_timestamp ON messages (date, timestamp)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_channels_lower_name ON channels (LOWER(name))")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_messages_audio_hash ON messages (audio_hash)")
+
+def _migration_stream_chunks(c):
+    # Pedazos de audio de las transmisiones en vivo, guardados a medida que llegan; al
+    # soltar el botón se juntan en un solo blob y se borran.
+    blob_type = "BYTEA" if USE_POSTGRES else "BLOB"
+    c.execute(f'''CREATE TABLE IF NOT EXISTS audio_stream_chunks
+                 (stream_key TEXT, seq INTEGER, data {blob_type}, created_at TEXT,
+                  PRIMARY KEY (stream_key, seq))''')
+
+def _migration_audio_analysis(c):
+    # Lo que calcula la ingesta (ingest_clip): la forma de onda va con el mensaje porque
+    # la pide la interfaz en el historial; la sonoridad y la duración real, con el clip.
+    _add_column(c, "messages", "waveform TEXT")
+    for column in ("duration REAL", "loudness_db REAL", "gain_db REAL"):
+        _add_column(c, "audio_blobs", column)
+
+def _migration_message_client_key(c):
+    # Clave que manda el cliente con cada mensaje (ver claim_ingest). El índice único es el
+    # respaldo de la caché en memoria: un reintento que llega después de un reinicio igual
+    # encuentra la fila original en vez de insertar otra. Los NULL (mensajes viejos o
+    # clientes que no mandan clave) no chocan entre sí.
+    _add_column(c, "messages", "client_key TEXT")
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_client_key ON messages (user_id, client_key)")
+
+def _migration_retention_storage(c):
+    # Lo que necesita el motor de retención (ver run_retention) para borrar sin frenar al
+    # resto: en Postgres, messages pasa a estar particionada por día, así un día vencido
+    # se va entero con un DROP de su partición en vez de un DELETE fila por fila; en
+    # SQLite, auto_vacuum incremental para que las páginas liberadas vuelvan al disco de a
+    # poco (PRAGMA incremental_vacuum) en lugar de un VACUUM completo.
+    if USE_POSTGRES:
+        _partition_messages_by_day(c)
+        return
+    c.execute("PRAGMA auto_vacuum")
+    if c.fetchone()[0] != 2:
+        # Cambiar el modo de una base existente exige reescribirla con VACUUM, que no
+        # puede correr dentro de una transacción: se cierra la que hubiera abierta.
+        c.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        c.connection.commit()
+        c.execute("VACUUM")
+
+def _partition_messages_by_day(c):
+    c.execute("SELECT relkind FROM pg_class WHERE relname = 'messages' AND relkind IN ('r', 'p')")
+    if c.fetchone()[0] == "p":
+        return
+    # La tabla vieja se copia a la nueva particionada y se descarta. Las claves únicas de
+    # una tabla particionada tienen que incluir la columna de partición, por eso el id y la
+    # clave de idempotencia pasan a ser únicos junto con la fecha (el id sigue saliendo de
+    # la misma secuencia, así que en la práctica no se repite; la clave se deduplica en
+    # message_client_keys, ver migración 11).
+    c.execute("ALTER TABLE messages RENAME TO messages_unpartitioned")
+    c.execute("ALTER SEQUENCE messages_id_seq OWNED BY NONE")
+    c.execute('''CREATE TABLE messages
+                 (id INTEGER NOT NULL DEFAULT nextval('messages_id_seq'), user_id TEXT, audio TEXT,
+                  text TEXT, timestamp TEXT, date TEXT NOT NULL, duration INTEGER, audio_hash TEXT,
+                  audio_size INTEGER, audio_mime TEXT, waveform TEXT, client_key TEXT,
+                  PRIMARY KEY (id, date))
+                 PARTITION BY RANGE (date)''')
+    # Lo que no cae en ninguna partición diaria (fechas ausentes o con otro formato, o un día
+    # para el que todavía no se creó partición) va a la DEFAULT; la retención lo borra por lotes.
+    c.execute("CREATE TABLE messages_default PARTITION OF messages DEFAULT")
+    c.execute("SELECT DISTINCT date FROM messages_unpartitioned")
+    days = {row[0] for row in c.fetchall() if row[0] and re.fullmatch(r"\d{4}-\d{2}-\d{2}", row[0])}
+    today = datetime.utcnow().date()
+    days.update((today + timedelta(days=n)).isoformat() for n in range(PARTITION_DAYS_AHEAD + 1))
+    for day in sorted(days):
+        _create_day_partition(c, day)
+    c.execute("INSERT INTO messages (id, user_id, audio, text, timestamp, date, duration, audio_hash, "
+              "audio_size, audio_mime, waveform, client_key) "
+              "SELECT id, user_id, audio, text, timestamp, COALESCE(date, ''), duration, audio_hash, "
+              "audio_size, audio_mime, waveform, client_key FROM messages_unpartitioned")
+    c.execute("DROP TABLE messages_unpartitioned")
+    c.execute("ALTER SEQUENCE messages_id_seq OWNED BY messages.id")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_messages_date_timestamp ON messages (date, timestamp)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_messages_audio_hash ON messages (audio_hash)")
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_client_key ON messages (user_id, client_key, date)")
+
+def _day_partition_name(day: str) -> str:
+    return "messages_" + day.replace("-", "")
+
+def _create_day_partition(c, day: str):
+    next_day = (datetime.strptime(day, "%Y-%m-%d") + timedelta(days=1)).strftime("%Y-%m-%d")
+    c.execute(f"CREATE TABLE IF NOT EXISTS {_day_partition_name(day)} PARTITION OF messages "
+              f"FOR VALUES FROM ('{day}') TO ('{next_day}')")
+
+def _migration_message_search(c):
+    # Búsqueda por texto en las transcripciones (ver search_messages). El canal va con el
+    # mensaje para poder filtrar por grupo; los mensajes anteriores quedan sin canal.
+    # El índice se mantiene solo, fila por fila, al guardar, transcribir o borrar:
+    # - Postgres: columna tsvector generada a partir de `text` + índice GIN (en la tabla
+    #   particionada; cada partición nueva lo hereda).
+    # - SQLite: tabla FTS5 de contenido externo sobre messages, con triggers. Se indexa
+    #   sin acentos, así "camion" encuentra "camión".
+    _add_column(c, "messages", "group_id TEXT")
+    if USE_POSTGRES:
+        _add_column(c, "messages", f"text_tsv tsvector GENERATED ALWAYS AS "
+                                   f"(to_tsvector('{SEARCH_TEXT_CONFIG}', COALESCE(text, ''))) STORED")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_messages_text_tsv ON messages USING GIN (text_tsv)")
+        return
+    c.execute("CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5 "
+              "(text, content='messages', content_rowid='id', tokenize='unicode61 remove_diacritics 2')")
+    c.execute('''CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+                   INSERT INTO messages_fts (rowid, text) VALUES (new.id, new.text);
+                 END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+                   INSERT INTO messages_fts (messages_fts, rowid, text) VALUES ('delete', old.id, old.text);
+                 END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF text ON messages BEGIN
+                   INSERT INTO messages_fts (messages_fts, rowid, text) VALUES ('delete', old.id, old.text);
+                   INSERT INTO messages_fts (rowid, text) VALUES (new.id, new.text);
+                 END''')
+    c.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+
+def _migration_audio_original(c):
+    # El clip tal como se subió, al lado del recodificado a Opus (ver ingest_clip): Safari
+    # de iOS anterior a la 17 no reproduce Opus y lo pide con /audio/{hash}?original=1.
+    blob_type = "BYTEA" if USE_POSTGRES else "BLOB"
+    for column in ("original_mime TEXT", f"original_data {blob_type}"):
+        _add_column(c, "audio_blobs", column)
+
+def _migration_message_client_keys(c):
+    # En Postgres las claves únicas de messages incluyen la fecha (ver
+    # _partition_messages_by_day), así que el mismo reintento de un lado y del otro de la
+    # medianoche pasaba por dos mensajes distintos. La idempotencia pasa a una tabla
+    # aparte sin particionar, con (user_id, client_key) único de verdad; la retención la
+    # vacía junto con los mensajes. En SQLite messages no se particiona y alcanza con el
+    # índice de la migración 7.
+    if not USE_POSTGRES:
+        return
+    c.execute('''CREATE TABLE IF NOT EXISTS message_client_keys
+                 (user_id TEXT NOT NULL, client_key TEXT NOT NULL, message_id INTEGER, date TEXT NOT NULL,
+                  PRIMARY KEY (user_id, client_key))''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_message_client_keys_date ON message_client_keys (date)")
+    c.execute("INSERT INTO message_client_keys (user_id, client_key, message_id, date) "
+              "SELECT DISTINCT ON (user_id, client_key) user_id, client_key, id, date FROM messages "
+              "WHERE client_key IS NOT NULL ORDER BY user_id, client_key, id ON CONFLICT DO NOTHING")
+
+MIGRATIONS = [
+    (1, "tablas base", _migration_base_tables),
+    (2, "messages.duration", _migration_message_duration),
+    (3, "almacén de audio por hash", _migration_audio_store),
+    (4, "índices de consultas frecuentes", _migration_hot_query_indexes),
+    (5, "pedazos de transmisiones en vivo", _migration_stream_chunks),
+    (6, "forma de onda y sonoridad del audio", _migration_audio_analysis),
+    (7, "clave de idempotencia de los mensajes", _migration_message_client_key),
+    (8, "almacenamiento para la retención por lotes", _migration_retention_storage),
+    (9, "índice de búsqueda de transcripciones", _migration_message_search),
+    (10, "audio original para clientes sin Opus", _migration_audio_original),
+    (11, "claves de idempotencia sin particionar", _migration_message_client_keys),
+]
+
+def get_schema_version() -> int:
+    with db_connection() as conn:
+        c = conn.cursor()
+        c.execute("CREATE TABLE IF NOT EXISTS schema_version "
+                  "(version INTEGER PRIMARY KEY, description TEXT, applied_at TEXT)")
+        c.execute("SELECT MAX(version) FROM schema_version")
+        return c.fetchone()[0] or 0
+
+def run_migrations() -> int:
+    """Aplica las migraciones pendientes y devuelve la versión final del esquema."""
+    current = get_schema_version()
+    for version, description, migrate in MIGRATIONS:
+        if version <= current:
+            continue
         with db_connection() as conn:
             c = conn.cursor()
-            c.execute(f'''CREATE TABLE IF NOT EXISTS messages
-                         ({id_column}, user_id TEXT, audio TEXT, text TEXT, timestamp TEXT, date TEXT)''')
-
             if USE_POSTGRES:
-                c.execute("ALTER TABLE messages ADD COLUMN IF NOT EXISTS duration INTEGER")
-            else:
-                # Dynamically add duration column if it doesn't exist
-                try:
-                    c.execute("ALTER TABLE messages ADD COLUMN duration INTEGER")
-                except sqlite3.OperationalError:
-                    pass # Already exists
-
-            c.execute('''CREATE TABLE IF NOT EXISTS sessions
-                         (token TEXT PRIMARY KEY, user_id TEXT, name TEXT, function TEXT, group_id TEXT,
-                          muted_users TEXT, last_active TIMESTAMP)''')
-            c.execute('''CREATE TABLE IF NOT EXISTS users
-                         (surname TEXT PRIMARY KEY, employee_id TEXT, sector TEXT, password TEXT)''')
-            c.execute('''CREATE TABLE IF NOT EXISTS channels
-                         (name TEXT PRIMARY KEY, password_hash TEXT, created_at TEXT)''')
-        logger.info(f"Base de datos inicializada correctamente ({'Postgres' if USE_POSTGRES else 'SQLite'})")
+                # Si arrancan varios procesos a la vez, solo uno migra; el resto espera
+                # acá y después ve la versión ya anotada.
+                c.execute("SELECT pg_advisory_xact_lock(724001)")
+            c.execute(q("SELECT 1 FROM schema_version WHERE version = ?"), (version,))
+            if c.fetchone():
+                continue
+            migrate(c)
+            c.execute(q("INSERT INTO schema_version (version, description, applied_at) VALUES (?, ?, ?)"),
+                      (version, description, datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")))
+        logger.info(f"Migración {version} aplicada: {description}")
+        current = version
+    return current
+
+# Inicializar base de datos (Postgres en producción, SQLite en desarrollo local)
+def init_db():
+    try:
+        version = run_migrations()
+        logger.info(f"Base de datos inicializada correctamente ({'Postgres' if USE_POSTGRES else 'SQLite'}, "
+                    f"esquema v{version})")
     except Exception as e:
         logger.error(f"Error al inicializar la base de datos: {e}")
 
 # Estructuras de datos para control de WebSockets
-users: Dict[str, Dict[str, any]] = {}
+# Una sesión en memoria. Antes era un dict con diez claves por usuario; con __slots__ el
+# registro no lleva dict propio y ocupa una fracción de eso.
+class UserRecord:
+    __slots__ = ("user_id", "name", "function", "group_id", "muted_users", "logged_in",
+                 "websocket", "outbox", "active", "idle_since")
+
+    def __init__(self, user_id: str, name: str, function: str, group_id: Optional[str] = None,
+                 muted_users: Optional[Set[str]] = None, websocket: Optional[WebSocket] = None,
+                 outbox=None):
+        self.user_id = user_id
+        self.name = name
+        self.function = function
+        self.group_id = group_id
+        self.muted_users = muted_users if muted_users is not None else set()
+        self.logged_in = True
+        self.websocket = websocket
+        self.outbox = outbox
+        self.active = websocket is not None
+        self.idle_since = time.monotonic()  # desde cuándo está sin socket (ver evict_idle_sessions)
+
+users: Dict[str, UserRecord] = {}
 audio_queue: asyncio.Queue = asyncio.Queue()
-groups: Dict[str, List[str]] = {}
+
+# Índices de ruteo. Antes cada audio recorría todo `users` filtrando por group_id y
+# armando "nombre_funcion" para encontrar el destinatario de un mensaje directo, y cada
+# frame de señalización de la Cámara Familiar buscaba el token con un recorrido lineal.
+# Ahora se mantienen:
+#   - groups:      group_id -> tokens CONECTADOS de ese canal
+#   - user_tokens: user_id ("nombre_funcion") -> tokens (conectados o no)
+#   - online:      tokens con sesión iniciada y socket abierto
+#   - lobby:       los de `online` que no están en ningún canal (la pantalla principal)
+# Se actualizan con routing.update(token) después de cualquier cambio de socket,
+# logged_in, group_id o de borrar al usuario; update() compara contra lo que ya estaba
+# indexado para ese token, así que llamarlo de más no rompe nada.
+class RoutingIndex:
+    def __init__(self):
+        self.groups: Dict[str, Set[str]] = {}
+        self.user_tokens: Dict[str, Set[str]] = {}
+        self.online: Set[str] = set()
+        self.lobby: Set[str] = set()
+        self._entries: Dict[str, Tuple[Optional[str], str, bool]] = {}
+
+    @staticmethod
+    def _entry(user: UserRecord) -> Tuple[Optional[str], str, bool]:
+        online = bool(user.logged_in and user.websocket)
+        group_id = user.group_id if online else None
+        return group_id, f"{user.name}_{user.function}", online
+
+    def update(self, token: str):
+        user = users.get(token)
+        new = self._entry(user) if user else None
+        old = self._entries.get(token)
+        if old == new:
+            return
+        if old:
+            old_group, old_user_id, _ = old
+            if old_group:
+                members = self.groups.get(old_group)
+                members.discard(token)
+                if not members:
+                    del self.groups[old_group]
+            tokens = self.user_tokens.get(old_user_id)
+            tokens.discard(token)
+            if not tokens:
+                del self.user_tokens[old_user_id]
+            self.online.discard(token)
+            self.lobby.discard(token)
+        if new:
+            group_id, user_id, online = new
+            if group_id:
+                self.groups.setdefault(group_id, set()).add(token)
+            self.user_tokens.setdefault(user_id, set()).add(token)
+            if online:
+                self.online.add(token)
+                if not group_id:
+                    self.lobby.add(token)
+            self._entries[token] = new
+        else:
+            self._entries.pop(token, None)
+
+    def check(self) -> List[str]:
+        """Reconstruye los índices desde cero a partir de `users` y devuelve las
+        diferencias con los mantenidos (lista vacía = consistentes)."""
+        fresh = RoutingIndex()
+        for token in users:
+            fresh.update(token)
+        problems = []
+        for name in ("groups", "user_tokens", "online", "lobby", "_entries"):
+            if getattr(self, name) != getattr(fresh, name):
+                problems.append(f"{name}: mantenido={getattr(self, name)!r} esperado={getattr(fresh, name)!r}")
+        return problems
+
+routing = RoutingIndex()
 
 # Modo Cámara Familiar: salas de monitoreo en vivo (tipo cámara de seguridad),
 # una por grupo. Mapea group_id -> { token: camera_on }.
 monitor_rooms: Dict[str, Dict[str, bool]] = {}
 
-# Persistence helper for valid tokens
-def load_all_valid_tokens() -> Set[str]:
-    tokens = set()
-    try:
-        with db_connection() as conn:
-            c = conn.cursor()
-            c.execute("SELECT token FROM sessions")
-            for row in c.fetchall():
-                tokens.add(row[0])
-    except Exception as e:
-        logger.error(f"Error cargando tokens persistentes: {e}")
-    return tokens
-
-valid_tokens = load_all_valid_tokens()
-
 @app.post("/register")
-async def register_user(request: RegisterRequest):
+async def register_user(request: RegisterRequest, http_request: Request):
     surname = request.surname
     password = request.password
+    ip_key = ip_throttle_key(client_ip(http_request.headers, http_request.client))
+    wait = register_throttle.retry_after(ip_key, REGISTER_MAX_PER_IP)
+    if wait:
+        raise too_many_attempts(wait)
+    register_throttle.record(ip_key)
     
     # Generar legajo simulado y sector por defecto de manera determinista basados en el apellido
-    import hashlib
     hash_val = int(hashlib.md5(surname.encode('utf-8')).hexdigest(), 16)
     employee_id = str(10000 + (hash_val % 90000))  # Legajo de 5 dígitos determinista
     sector = "Operador"
 
-    with db_connection() as conn:
-        c = conn.cursor()
-        c.execute(q("SELECT employee_id, password FROM users WHERE surname = ?"), (surname,))
-        user_exists = c.fetchone()
-
-        hashed_password = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
-        if user_exists:
-            # Sobrescribir contraseña y actualizar información
-            c.execute(q("UPDATE users SET sector = ?, password = ? WHERE surname = ?"),
-                      (sector, hashed_password, surname))
-            logger.info(f"Contraseña actualizada/recuperada para: {surname}")
-            return {"message": "Contraseña actualizada exitosamente"}
-        else:
-            # Registrar nuevo usuario
-            c.execute(q("INSERT INTO users (surname, employee_id, sector, password) VALUES (?, ?, ?, ?)"),
-                      (surname, employee_id, sector, hashed_password))
-            logger.info(f"Usuario registrado: {surname} (Legajo: {employee_id}, Sector: {sector})")
-            return {"message": "Registro exitoso"}
+    try:
+        hashed_password = await hash_password_async(password)
+    except HashingBusy:
+        raise hashing_busy()
+    if not await upsert_user_async(surname, employee_id, sector, hashed_password):
+        # Ya existía: se sobrescribió la contraseña
+        logger.info(f"Contraseña actualizada/recuperada para: {surname}")
+        return {"message": "Contraseña actualizada exitosamente"}
+    logger.info(f"Usuario registrado: {surname} (Legajo: {employee_id}, Sector: {sector})")
+    return {"message": "Registro exitoso"}
 
 # Validación de token
 @app.post("/validate-token")
@@ -282,7 +770,9 @@ async def validate_token(request: TokenValidationRequest):
             raise HTTPException(status_code=401, detail="Formato de token inválido")
         
         employee_id, surname, sector = parts
-        if token not in valid_tokens:
+        # La base es la fuente de verdad (la comparten todos los workers); en memoria
+        # solo están las sesiones residentes (ver evict_idle_sessions).
+        if token not in users and not await session_exists_async(token):
             logger.error(f"Token no registrado: {token}")
             raise HTTPException(status_code=401, detail="Token no registrado")
         
@@ -292,47 +782,98 @@ async def validate_token(request: TokenValidationRequest):
         raise HTTPException(status_code=401, detail="Token inválido")
 
 @app.post("/login")
-async def login_user(request: LoginRequest):
+async def login_user(request: LoginRequest, http_request: Request):
     surname = request.surname
     password = request.password
+    ip_key = ip_throttle_key(client_ip(http_request.headers, http_request.client))
+    wait = throttled_for(ip_key)
+    if wait:
+        logger.warning(f"Login de {surname} frenado por demasiados intentos fallidos desde {ip_key}")
+        raise too_many_attempts(wait)
+    surname_key = f"login:{surname.lower()}"
+    delay = login_delay(surname_key)
+    if delay:
+        credential_stats["login_delayed"] += 1
+        logger.warning(f"Login de {surname} demorado {delay:g}s por intentos fallidos recientes")
+        await asyncio.sleep(delay)
 
-    with db_connection() as conn:
-        c = conn.cursor()
-        c.execute(q("SELECT surname, employee_id, sector, password FROM users WHERE surname = ?"),
-                  (surname,))
-        user = c.fetchone()
+    user = await get_user_async(surname)
 
     if not user:
         logger.error(f"Credenciales inválidas para apellido: {surname}")
+        record_failure(ip_key, surname_key)
         raise HTTPException(status_code=401, detail="Credenciales inválidas")
 
-    stored_password = user[3]
-    stored_bytes = stored_password.encode('utf-8') if isinstance(stored_password, str) else stored_password
-    if not bcrypt.checkpw(password.encode('utf-8'), stored_bytes):
+    try:
+        password_ok = await check_password_async(password, user[3])
+    except HashingBusy:
+        raise hashing_busy()
+    if not password_ok:
         logger.error(f"Contraseña incorrecta para: {surname}")
+        record_failure(ip_key, surname_key)
         raise HTTPException(status_code=401, detail="Contraseña incorrecta")
+    login_throttle.reset(surname_key)
 
     employee_id = user[1]
     sector = user[2]
     token_data = f"{employee_id}_{surname}_{sector}"
     token = base64.b64encode(token_data.encode('utf-8')).decode('utf-8')
-    valid_tokens.add(token)
-    save_session(token, token_data, surname, sector)
+    await save_session_async(token, token_data, surname, sector)
     logger.info(f"Login exitoso: {surname} (Legajo: {employee_id}, Sector: {sector})")
     return {"token": token, "message": "Inicio de sesión exitoso"}
 
 # --- COMUNICACIÓN Y MENSAJERÍA ---
 
+# Caché en memoria de los clips más recientes. Apenas se entrega un mensaje, todos los
+# destinatarios piden el mismo /audio/<hash> casi a la vez: sin esto serían N lecturas
+# del mismo blob en la base.
+AUDIO_CACHE_BYTES = int(os.getenv("AUDIO_CACHE_BYTES", str(32 * 1024 * 1024)))
+
+class AudioBlobCache:
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._items: "OrderedDict[str, tuple]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, audio_hash: str) -> Optional[tuple]:
+        with self._lock:
+            item = self._items.get(audio_hash)
+            if item is not None:
+                self._items.move_to_end(audio_hash)
+            return item
+
+    def put(self, audio_hash: str, mime: str, data: bytes):
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            if audio_hash in self._items:
+                self._items.move_to_end(audio_hash)
+                return
+            self._items[audio_hash] = (mime, data)
+            self._bytes += len(data)
+            while self._bytes > self.max_bytes:
+                _, (_, evicted) = self._items.popitem(last=False)
+                self._bytes -= len(evicted)
+
+audio_cache = AudioBlobCache(AUDIO_CACHE_BYTES)
+
 # Base de datos local
 def save_session(token: str, user_id: str, name: str, function: str, group_id: Optional[str] = None, muted_users: Optional[Set[str]] = None):
     muted_users_str = json.dumps(list(muted_users or set()))
     last_active = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+    save_sessions([(token, user_id, name, function, group_id, muted_users_str, last_active)])
+
+def save_sessions(rows: List[tuple]):
+    """Upsert en lote de filas (token, user_id, name, function, group_id, muted_users, last_active)."""
+    if not rows:
+        return
     with db_connection() as conn:
         c = conn.cursor()
         if USE_POSTGRES:
             # "INSERT OR REPLACE" es sintaxis propia de SQLite; en Postgres el
             # equivalente es un upsert con ON CONFLICT.
-            c.execute('''INSERT INTO sessions
+            c.executemany('''INSERT INTO sessions
                          (token, user_id, name, function, group_id, muted_users, last_active)
                          VALUES (%s, %s, %s, %s, %s, %s, %s)
                          ON CONFLICT (token) DO UPDATE SET
@@ -342,12 +883,12 @@ def save_session(token: str, user_id: str, name: str, function: str, group_id: O
                              group_id = EXCLUDED.group_id,
                              muted_users = EXCLUDED.muted_users,
                              last_active = EXCLUDED.last_active''',
-                      (token, user_id, name, function, group_id, muted_users_str, last_active))
+                      rows)
         else:
-            c.execute('''INSERT OR REPLACE INTO sessions
+            c.executemany('''INSERT OR REPLACE INTO sessions
                          (token, user_id, name, function, group_id, muted_users, last_active)
                          VALUES (?, ?, ?, ?, ?, ?, ?)''',
-                      (token, user_id, name, function, group_id, muted_users_str, last_active))
+                      rows)
 
 def load_session(token: str) -> Optional[Dict]:
     with db_connection() as conn:
@@ -371,485 +912,3065 @@ def load_session(token: str) -> Optional[Dict]:
         }
     return None
 
+def session_exists(token: str) -> bool:
+    with db_connection() as conn:
+        c = conn.cursor()
+        c.execute(q("SELECT 1 FROM sessions WHERE token = ?"), (token,))
+        return c.fetchone() is not None
+
 def delete_session(token: str):
     with db_connection() as conn:
         c = conn.cursor()
         c.execute(q("DELETE FROM sessions WHERE token = ?"), (token,))
 
-def save_message(user_id: str, audio_data: str, text: str, timestamp: str, duration: Optional[int] = None) -> int:
+def _store_audio_blob(c, audio_bytes: bytes, mime: str, analysis: Optional[Dict] = None) -> str:
+    """Guarda el clip (si no estaba ya) dentro de la transacción del cursor `c`."""
+    audio_hash = hashlib.sha256(audio_bytes).hexdigest()
+    created_at = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+    analysis = analysis or {}
+    size, original = len(audio_bytes), analysis.get("original")
+    if USE_POSTGRES:
+        audio_bytes, original = psycopg2.Binary(audio_bytes), original and psycopg2.Binary(original)
+    params = (audio_hash, mime, size, audio_bytes, created_at, analysis.get("duration"),
+              analysis.get("loudness_db"), analysis.get("gain_db"), analysis.get("original_mime"), original)
+    columns = "hash, mime, size, data, created_at, duration, loudness_db, gain_db, original_mime, original_data"
+    if USE_POSTGRES:
+        c.execute(f"INSERT INTO audio_blobs ({columns}) "
+                  "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s) ON CONFLICT (hash) DO NOTHING", params)
+    else:
+        c.execute(f"INSERT OR IGNORE INTO audio_blobs ({columns}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", params)
+    return audio_hash
+
+def save_message(user_id: str, audio_bytes: bytes, text: str, timestamp: str, duration: Optional[int] = None,
+                 mime: str = "audio/webm", analysis: Optional[Dict] = None, client_key: Optional[str] = None,
+                 group_id: Optional[str] = None) -> Dict:
+    """Guarda el mensaje y su audio. Devuelve id, hash y tamaño del clip (y la forma de
+    onda, si el clip pasó por la ingesta). Si ya había un mensaje de ese usuario con la
+    misma `client_key`, devuelve ese con "duplicate": True y no inserta nada."""
+    with db_connection() as conn:
+        c = conn.cursor()
+        stored = _insert_message(c, user_id, audio_bytes, text, timestamp, duration, mime, analysis, client_key,
+                                 group_id)
+    if not stored.get("duplicate"):
+        audio_cache.put(stored["audio_hash"], mime, audio_bytes)
+    return stored
+
+def _claim_client_key(c, user_id: str, client_key: str, date: str) -> Optional[tuple]:
+    """(id, audio_hash, audio_size, audio_mime) del mensaje ya guardado con esa clave, o
+    None si no hay ninguno y el que se está por insertar queda como dueño de la clave."""
+    if not USE_POSTGRES:
+        c.execute("SELECT id, audio_hash, audio_size, audio_mime FROM messages WHERE user_id = ? AND client_key = ?",
+                  (user_id, client_key))
+        return c.fetchone()
+    # La clave se reserva antes de insertar: un reintento concurrente espera acá a que
+    # termine esta transacción y después encuentra el mensaje (ver migración 11).
+    c.execute("INSERT INTO message_client_keys (user_id, client_key, date) VALUES (%s, %s, %s) "
+              "ON CONFLICT DO NOTHING", (user_id, client_key, date))
+    if c.rowcount:
+        return None
+    c.execute("SELECT m.id, m.audio_hash, m.audio_size, m.audio_mime FROM message_client_keys k "
+              "JOIN messages m ON m.id = k.message_id AND m.date = k.date "
+              "WHERE k.user_id = %s AND k.client_key = %s", (user_id, client_key))
+    row = c.fetchone()
+    if row is None:
+        # El mensaje de esa clave ya lo borró la retención: la clave vuelve a quedar libre
+        c.execute("UPDATE message_client_keys SET message_id = NULL, date = %s WHERE user_id = %s AND client_key = %s",
+                  (date, user_id, client_key))
+    return row
+
+def _insert_message(c, user_id: str, audio_bytes: bytes, text: str, timestamp: str,
+                    duration: Optional[int], mime: str, analysis: Optional[Dict] = None,
+                    client_key: Optional[str] = None, group_id: Optional[str] = None) -> Dict:
     date = datetime.utcnow().strftime("%Y-%m-%d")
+    if client_key:
+        row = _claim_client_key(c, user_id, client_key, date)
+        if row:
+            return {"id": row[0], "audio_hash": row[1], "audio_size": row[2], "audio_mime": row[3], "duplicate": True}
+    audio_hash = _store_audio_blob(c, audio_bytes, mime, analysis)
+    waveform = analysis.get("waveform") if analysis else None
+    params = (user_id, text, timestamp, date, duration, audio_hash, len(audio_bytes), mime,
+              json.dumps(waveform) if waveform else None, client_key, group_id)
+    if USE_POSTGRES:
+        # psycopg2 no tiene cursor.lastrowid (eso es propio de sqlite3);
+        # en Postgres se pide el id insertado con RETURNING.
+        c.execute(
+            "INSERT INTO messages (user_id, text, timestamp, date, duration, audio_hash, audio_size, audio_mime, waveform, client_key, group_id) "
+            "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s) RETURNING id",
+            params
+        )
+        msg_id = c.fetchone()[0]
+        if client_key:
+            c.execute("UPDATE message_client_keys SET message_id = %s WHERE user_id = %s AND client_key = %s",
+                      (msg_id, user_id, client_key))
+    else:
+        c.execute("INSERT INTO messages (user_id, text, timestamp, date, duration, audio_hash, audio_size, audio_mime, waveform, client_key, group_id) "
+                  "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                  params)
+        msg_id = c.lastrowid
+    stored = {"id": msg_id, "audio_hash": audio_hash, "audio_size": len(audio_bytes), "audio_mime": mime}
+    if waveform:
+        stored["waveform"] = waveform
+    return stored
+
+def append_stream_chunk(stream_key: str, seq: int, data: bytes):
+    created_at = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
     with db_connection() as conn:
         c = conn.cursor()
-        if USE_POSTGRES:
-            # psycopg2 no tiene cursor.lastrowid (eso es propio de sqlite3);
-            # en Postgres se pide el id insertado con RETURNING.
-            c.execute(
-                "INSERT INTO messages (user_id, audio, text, timestamp, date, duration) VALUES (%s, %s, %s, %s, %s, %s) RETURNING id",
-                (user_id, audio_data, text, timestamp, date, duration)
-            )
-            return c.fetchone()[0]
-        else:
-            c.execute("INSERT INTO messages (user_id, audio, text, timestamp, date, duration) VALUES (?, ?, ?, ?, ?, ?)",
-                      (user_id, audio_data, text, timestamp, date, duration))
-            return c.lastrowid
+        c.execute(q("INSERT INTO audio_stream_chunks (stream_key, seq, data, created_at) VALUES (?, ?, ?, ?)"),
+                  (stream_key, seq, psycopg2.Binary(data) if USE_POSTGRES else data, created_at))
 
-def get_history() -> List[Dict]:
+def load_stream_audio(stream_key: str) -> bytes:
+    """Los pedazos de una transmisión, en orden, como un solo clip."""
     with db_connection() as conn:
         c = conn.cursor()
-        c.execute("SELECT id, user_id, audio, text, timestamp, date, duration FROM messages ORDER BY date, timestamp")
-        rows = c.fetchall()
-    return [{"id": row[0], "user_id": row[1], "audio": row[2], "text": row[3], "timestamp": row[4], "date": row[5], "duration": row[6]} for row in rows]
+        c.execute(q("SELECT data FROM audio_stream_chunks WHERE stream_key = ? ORDER BY seq"), (stream_key,))
+        return b"".join(bytes(row[0]) for row in c.fetchall())
 
-# Transcribir audio a texto (Google Speech Recognition con fallback sf)
-async def transcribe_audio(audio_data: str) -> str:
-    try:
-        audio_bytes = base64.b64decode(audio_data)
-        
-        # 1. Intentar con soundfile primero para evitar dependencia de ffmpeg/Pydub
-        try:
-            with io.BytesIO(audio_bytes) as audio_file:
-                data, samplerate = sf.read(audio_file)
-                # Exportar a WAV en memoria
-                with io.BytesIO() as wav_io:
-                    sf.write(wav_io, data, samplerate, format='WAV', subtype='PCM_16')
-                    wav_io.seek(0)
-                    recognizer = sr.Recognizer()
-                    with sr.AudioFile(wav_io) as source:
-                        recorded_audio = recognizer.record(source)
-                        text = recognizer.recognize_google(recorded_audio, language="es-ES")
-                        logger.info("Audio transcrito exitosamente usando SoundFile.")
-                        return text
-        except Exception as sf_err:
-            logger.warn(f"SoundFile no pudo transcribir, intentando Pydub: {sf_err}")
-            
-        # 2. Fallback a Pydub/FFmpeg tradicional
-        with io.BytesIO(audio_bytes) as audio_file:
-            audio_segment = AudioSegment.from_file(audio_file, format="webm")
-            audio_segment = audio_segment.set_channels(1).set_frame_rate(16000)
-            with io.BytesIO() as wav_io:
-                audio_segment.export(wav_io, format="wav")
-                wav_io.seek(0)
-                recognizer = sr.Recognizer()
-                with sr.AudioFile(wav_io) as source:
-                    recorded_audio = recognizer.record(source)
-                    text = recognizer.recognize_google(recorded_audio, language="es-ES")
-                    logger.info("Audio transcrito exitosamente usando Pydub.")
-                    return text
-    except Exception as e:
-        logger.error(f"Error al transcribir el audio en todos los métodos: {e}")
-        return "Transcripción no disponible"
+def finish_stream_message(stream_key: str, user_id: str, audio_bytes: bytes, text: str, timestamp: str,
+                          duration: Optional[int], mime: str, analysis: Optional[Dict] = None,
+                          group_id: Optional[str] = None, client_key: Optional[str] = None) -> Dict:
+    """Guarda el clip ya armado de una transmisión como un mensaje normal (mismo almacén
+    por hash y misma deduplicación por `client_key` que save_message) y borra sus
+    pedazos, en la misma transacción."""
+    with db_connection() as conn:
+        c = conn.cursor()
+        stored = _insert_message(c, user_id, audio_bytes, text, timestamp, duration, mime, analysis,
+                                 client_key, group_id)
+        c.execute(q("DELETE FROM audio_stream_chunks WHERE stream_key = ?"), (stream_key,))
+    if not stored.get("duplicate"):
+        audio_cache.put(stored["audio_hash"], mime, audio_bytes)
+    return stored
 
-# Procesar cola de audio de WebSockets
-async def process_audio_queue():
-    while True:
-        try:
-            item = await audio_queue.get()
-            token, audio_data, message = item
+def delete_stream_chunks(stream_key: str):
+    with db_connection() as conn:
+        conn.cursor().execute(q("DELETE FROM audio_stream_chunks WHERE stream_key = ?"), (stream_key,))
 
-            sender = message.get("sender", "Unknown")
-            function = message.get("function", "Unknown")
-            text = message.get("text", "Sin transcripción")
-            timestamp = message.get("timestamp", datetime.utcnow().strftime("%H:%M"))
+def load_audio_blob(audio_hash: str, original: bool = False) -> Optional[tuple]:
+    """(mime, bytes) del clip, o None si no existe. Con `original`, el clip tal como se
+    subió si se guardó aparte (si no, el mismo de siempre)."""
+    cache_key = f"{audio_hash}:original" if original else audio_hash
+    cached = audio_cache.get(cache_key)
+    if cached:
+        return cached
+    with db_connection() as conn:
+        c = conn.cursor()
+        if original:
+            c.execute(q("SELECT COALESCE(original_mime, mime), COALESCE(original_data, data) FROM audio_blobs "
+                        "WHERE hash = ?"), (audio_hash,))
+        else:
+            c.execute(q("SELECT mime, data FROM audio_blobs WHERE hash = ?"), (audio_hash,))
+        row = c.fetchone()
+    if not row:
+        return None
+    mime, data = row[0], bytes(row[1])
+    audio_cache.put(cache_key, mime, data)
+    return mime, data
 
-            if app_state["global_mute_active"]:
-                continue
+def audio_url(audio_hash: str) -> str:
+    return f"/audio/{audio_hash}"
 
-            if text == "Sin transcripción" or text == "Pendiente de transcripción":
-                text = await transcribe_audio(audio_data)
+def update_message_text(message_id: int, text: str):
+    with db_connection() as conn:
+        c = conn.cursor()
+        c.execute(q("UPDATE messages SET text = ? WHERE id = ?"), (text, message_id))
 
-            user_id = f"{sender}_{function}"
-            duration = message.get("duration")
-            msg_db_id = save_message(user_id, audio_data, text, timestamp, duration)
+# Columnas de metadatos de un mensaje; la versión completa agrega al final la columna
+# `audio` (base64 de los mensajes guardados antes del almacén de audio).
+HISTORY_META_COLUMNS = "id, user_id, text, timestamp, date, duration, audio_hash, audio_size, audio_mime, waveform"
+HISTORY_FULL_COLUMNS = HISTORY_META_COLUMNS + ", audio"
 
-            group_id = message.get("group_id")
-            target_user_id = message.get("target_user_id")
-            
-            is_group = message.get("type") == "group_message" or group_id is not None
-            is_direct = message.get("type") == "direct_message" or target_user_id is not None
-            
-            # Include sender_id so clients can properly detect if message is theirs
-            sender_id = f"{sender}_{function}"
-            sender_token = message.get("sender_token", token)
-            broadcast_payload = {
-                "type": "group_message" if is_group else ("direct_message" if is_direct else "message"),
-                "id": msg_db_id,
-                "sender": sender,
-                "sender_id": sender_id,
-                "sender_token": sender_token,
-                "function": function,
-                "text": text,
-                "timestamp": timestamp,
-                "duration": duration,
-                "audio": audio_data
-            }
-            if is_group:
-                broadcast_payload["group_id"] = group_id
-            if is_direct:
-                broadcast_payload["target_user_id"] = target_user_id
-            
-            disconnected_users = []
-            for user_token, user in list(users.items()):
-                # Only broadcast to users who have an active socket.
-                # If they are logged_in but websocket is None, we don't drop them, we just skip transmitting.
-                if not user["logged_in"]:
-                    continue
-                if not user["websocket"]:
-                    continue
-                # If it's a group message, send only to group members
-                if is_group and user.get("group_id") != group_id:
-                    continue
-                # If it's a direct message, send only to the sender and the target operator
-                if is_direct:
-                    dest_user_id = f"{user['name']}_{user['function']}"
-                    is_dest = (dest_user_id == target_user_id)
-                    is_src = (user_token == token)
-                    if not is_dest and not is_src:
-                        continue
-                
-                muted_users = user.get("muted_users", set())
-                # Only skip if this user muted the sender (not if they are the sender)
-                if sender_id in muted_users and user_token != token:
-                    continue
-                try:
-                    await user["websocket"].send_json(broadcast_payload)
-                except Exception as e:
-                    logger.error(f"Error al enviar audio a {user['name']}: {e}")
-                    disconnected_users.append(user_token)
-
-            for user_token in disconnected_users:
-                if user_token in users:
-                    users[user_token]["websocket"] = None
-                    users[user_token]["active"] = False
-            if disconnected_users:
-                await broadcast_users()
+def _history_row(row) -> Dict:
+    msg = {"id": row[0], "user_id": row[1], "text": row[2], "timestamp": row[3], "date": row[4], "duration": row[5]}
+    if row[6]:
+        msg.update({"audio_url": audio_url(row[6]), "audio_size": row[7], "audio_mime": row[8]})
+    elif len(row) > 10:
+        msg["audio"] = row[10]  # mensaje guardado antes del almacén de audio
+    if row[9]:
+        msg["waveform"] = json.loads(row[9])
+    return msg
 
-            audio_queue.task_done()
-        except asyncio.CancelledError:
-            break
-        except Exception as e:
-            logger.error(f"Error procesando la cola de audio: {e}")
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", "100"))
+HISTORY_MAX_PAGE_SIZE = int(os.getenv("HISTORY_MAX_PAGE_SIZE", "500"))
 
-# Limpiar mensajes antiguos
-async def clear_messages():
-    while True:
-        try:
-            now = datetime.utcnow()
-            # Programar a las 5:30 UTC todos los días
-            start_time = now.replace(hour=5, minute=30, second=0, microsecond=0)
-            if now >= start_time:
-                start_time += timedelta(days=1)
-            await asyncio.sleep((start_time - now).total_seconds())
-            
-            with db_connection() as conn:
-                c = conn.cursor()
-                expiration_time = (datetime.utcnow() - timedelta(hours=24)).strftime("%Y-%m-%d %H:%M:%S")
-                c.execute(q("DELETE FROM messages WHERE date < ?"), (expiration_time,))
-                logger.info(f"Mensajes anteriores a 24 horas eliminados.")
-        except Exception as e:
-            logger.error(f"Error al limpiar mensajes: {e}")
+def get_history_page(before_id: Optional[int] = None, after_id: Optional[int] = None,
+                     limit: int = HISTORY_PAGE_SIZE, meta_only: bool = False) -> List[tuple]:
+    """Una página de mensajes en orden cronológico (por id), como filas crudas.
 
-# Empuja la lista de usuarios conectados a todo el mundo cada pocos segundos, sin
-# depender de que cada cliente pida el refresco por su cuenta (ver 'refresh_users').
-# En el celular que está en segundo plano o con la pantalla apagada, el navegador puede
-# frenar sus propios timers (el ping/refresh_users periódico del cliente) durante un
-# buen rato -- este loop del lado del servidor asegura que, apenas ese cliente vuelva a
-# primer plano y su socket despierte, el resto ya lo vea activo sin esperar a que su
-# propio ping se dispare de nuevo.
-async def periodic_broadcast_users():
-    while True:
-        try:
-            await asyncio.sleep(6)
-            await broadcast_users()
-        except Exception as e:
-            logger.error(f"Error en broadcast periódico de usuarios: {e}")
+    - after_id: los `limit` mensajes siguientes a ese id.
+    - before_id: los `limit` mensajes anteriores a ese id.
+    - ninguno: los `limit` más recientes.
+    """
+    limit = max(1, min(limit, HISTORY_MAX_PAGE_SIZE))
+    columns = HISTORY_META_COLUMNS if meta_only else HISTORY_FULL_COLUMNS
+    with db_connection() as conn:
+        c = conn.cursor()
+        if after_id is not None:
+            c.execute(q(f"SELECT {columns} FROM messages WHERE id > ? ORDER BY id LIMIT ?"), (after_id, limit))
+        elif before_id is not None:
+            c.execute(q(f"SELECT * FROM (SELECT {columns} FROM messages WHERE id < ? ORDER BY id DESC LIMIT ?) page "
+                        "ORDER BY id"), (before_id, limit))
+        else:
+            c.execute(q(f"SELECT * FROM (SELECT {columns} FROM messages ORDER BY id DESC LIMIT ?) page "
+                        "ORDER BY id"), (limit,))
+        return c.fetchall()
 
-# Limpiar sesiones expiradas
-async def clean_expired_sessions():
-    while True:
-        try:
-            # Sesiones ya no expiran automáticamente por inactividad. Solo se cierran si se presiona 'Salir'.
-            pass
-        except Exception as e:
-            logger.error(f"Error al limpiar sesiones: {e}")
-        await asyncio.sleep(3600)
+# --- Búsqueda en las transcripciones ---
+# Antes, para saber quién había dicho "puerta 12" había que recorrer el historial entero.
+# search_messages usa el índice de texto de la migración 9 (FTS5 en SQLite, tsvector en
+# Postgres). Del texto buscado solo se toman las palabras: todas tienen que aparecer, y la
+# última vale como prefijo (así "puer" ya encuentra "puerta" mientras se escribe). Los
+# resultados vienen del más nuevo al más viejo, paginados con el mismo cursor before_id
+# que el historial.
+SEARCH_PAGE_SIZE = int(os.getenv("SEARCH_PAGE_SIZE", "20"))
+SEARCH_MAX_PAGE_SIZE = int(os.getenv("SEARCH_MAX_PAGE_SIZE", "100"))
+SEARCH_TEXT_CONFIG = os.getenv("SEARCH_TEXT_CONFIG", "spanish")  # configuración de texto de Postgres
+SEARCH_MAX_TERMS = 8
+SNIPPET_START, SNIPPET_END = "«", "»"
 
-# Registra al usuario como miembro del canal (ya validado por create_group/join_group)
-# y le confirma el ingreso. group_name es siempre el nombre EXACTO guardado en la tabla
-# channels (no necesariamente lo que la persona tipeó esta vez si venía de join_group),
-# para que todos los que entren al mismo canal -- aunque lo escriban con distinta
-# capitalización -- compartan el mismo group_id puertas adentro.
-async def add_user_to_group(token: str, websocket: WebSocket, group_name: str):
-    if group_name not in groups:
-        groups[group_name] = []
-    if token not in groups[group_name]:
-        groups[group_name].append(token)
-    users[token]["group_id"] = group_name
-    save_session(
-        token,
-        users[token]["user_id"],
-        users[token]["name"],
-        users[token]["function"],
-        group_name,
-        users[token]["muted_users"]
-    )
-    await websocket.send_json({"type": "group_joined", "group_id": group_name})
-    await broadcast_users()
+def search_terms(query: str) -> List[str]:
+    return re.findall(r"\w+", query.lower())[:SEARCH_MAX_TERMS]
 
-# Busca el token de un usuario a partir de su user_id ("nombre_funcion")
-def find_token_by_user_id(target_user_id: str) -> Optional[str]:
-    for tk, u in users.items():
-        if f"{u['name']}_{u['function']}" == target_user_id:
-            return tk
-    return None
+def _match_expression(terms: List[str]) -> str:
+    if USE_POSTGRES:
+        return " & ".join(terms[:-1] + [terms[-1] + ":*"])
+    return " ".join(f'"{term}"' for term in terms[:-1]) + f' "{terms[-1]}"*'
 
-# Saca a un usuario de cualquier sala de "Cámara Familiar" en la que esté y avisa al resto
-async def leave_monitor_room(token: str):
-    if token not in users:
-        return
-    user_id = f"{users[token]['name']}_{users[token]['function']}"
-    for group_id, participants in list(monitor_rooms.items()):
-        if token in participants:
-            del participants[token]
-            if not participants:
-                del monitor_rooms[group_id]
-            for other_token in list(participants.keys()):
-                other_ws = users.get(other_token, {}).get("websocket")
-                if other_ws:
-                    try:
-                        await other_ws.send_json({"type": "monitor_peer_left", "user_id": user_id})
-                    except Exception as e:
-                        logger.error(f"Error avisando salida de sala familiar a {other_token}: {e}")
-
-# Envío masivo de la lista de usuarios conectados
-async def broadcast_users():
-    user_list = []
-    for token in users:
-        if users[token]["logged_in"]:
-            decoded_token = base64.b64decode(token).decode('utf-8', errors='ignore')
-            legajo, name, _ = decoded_token.split('_', 2) if '_' in decoded_token else (token, "Anónimo", "Desconocida")
-            user_id = f"{users[token]['name']}_{users[token]['function']}"
-            
-            # Active means the user has a live websocket connection
-            is_active = users[token].get("websocket") is not None
-            user_list.append({
-                "display": f"{users[token]['name']} ({legajo})",
-                "user_id": user_id,
-                "group_id": users[token]["group_id"],
-                "active": is_active
-            })
-            
-    for token, user in list(users.items()):
-        if user["logged_in"] and user["websocket"]:
-            try:
-                await user["websocket"].send_json({
-                    "type": "user_list",
-                    "users": user_list
-                })
-            except Exception as e:
-                logger.error(f"Error enviando lista de usuarios a {user['name']}: {e}")
+def search_messages(terms: List[str], user_id: Optional[str] = None, group_id: Optional[str] = None,
+                    since: Optional[str] = None, until: Optional[str] = None, before_id: Optional[int] = None,
+                    limit: int = SEARCH_PAGE_SIZE) -> List[tuple]:
+    """Mensajes cuya transcripción contiene todos los `terms`, como filas crudas: las
+    columnas de HISTORY_META_COLUMNS seguidas de group_id y el fragmento con las
+    coincidencias marcadas. `since`/`until` son "YYYY-MM-DD" o "YYYY-MM-DD HH:MM" (UTC),
+    comparados contra la fecha y hora del mensaje, ambos inclusive."""
+    limit = max(1, min(limit, SEARCH_MAX_PAGE_SIZE))
+    columns = ", ".join(f"m.{column}" for column in HISTORY_META_COLUMNS.split(", "))
+    match = _match_expression(terms)
+    if USE_POSTGRES:
+        sql = (f"SELECT {columns}, m.group_id, ts_headline('{SEARCH_TEXT_CONFIG}', m.text, query, "
+               f"'StartSel={SNIPPET_START}, StopSel={SNIPPET_END}, MaxWords=18, MinWords=8') "
+               f"FROM messages m, to_tsquery('{SEARCH_TEXT_CONFIG}', ?) query WHERE m.text_tsv @@ query")
+    else:
+        sql = (f"SELECT {columns}, m.group_id, snippet(messages_fts, 0, '{SNIPPET_START}', '{SNIPPET_END}', '…', 12) "
+               "FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid WHERE messages_fts MATCH ?")
+    # En SQLite se ordena y se pagina por el rowid del índice (que es el id del mensaje):
+    # así FTS5 recorre las coincidencias de la más nueva hacia atrás y corta al llenar la
+    # página, en vez de juntarlas todas para ordenarlas por m.id.
+    id_column = "m.id" if USE_POSTGRES else "messages_fts.rowid"
+    params: List = [match]
+    if user_id:
+        sql += " AND m.user_id = ?"
+        params.append(user_id)
+    if group_id:
+        sql += " AND m.group_id = ?"
+        params.append(group_id)
+    # El filtro por fecha sola acota por el índice (y en Postgres, por partición); el que
+    # incluye la hora termina de recortar los extremos.
+    if since:
+        sql += " AND m.date >= ? AND m.date || ' ' || COALESCE(m.timestamp, '') >= ?"
+        params += [since[:10], since]
+    if until:
+        sql += " AND m.date <= ? AND m.date || ' ' || COALESCE(m.timestamp, '') <= ?"
+        params += [until[:10], until if len(until) > 10 else until + " 99:99"]
+    if before_id is not None:
+        sql += f" AND {id_column} < ?"
+        params.append(before_id)
+    sql += f" ORDER BY {id_column} DESC LIMIT ?"
+    params.append(limit)
+    with db_connection() as conn:
+        c = conn.cursor()
+        c.execute(q(sql), params)
+        return c.fetchall()
 
-async def broadcast_message(message: Dict):
-    disconnected_users = []
-    for token, user in list(users.items()):
-        if not user["logged_in"] or not user["websocket"]:
-            disconnected_users.append(token)
-            continue
-        try:
-            await user["websocket"].send_json(message)
-        except Exception as e:
-            logger.error(f"Error al enviar mensaje general: {e}")
-            disconnected_users.append(token)
-            
-    for token in disconnected_users:
-        if token in users:
-            users[token]["websocket"] = None
-            users[token]["logged_in"] = False
-    if disconnected_users:
-        await broadcast_users()
+def get_user(surname: str) -> Optional[tuple]:
+    with db_connection() as conn:
+        c = conn.cursor()
+        c.execute(q("SELECT surname, employee_id, sector, password FROM users WHERE surname = ?"),
+                  (surname,))
+        return c.fetchone()
 
-# Endpoint de WebSockets principal
-@app.websocket("/ws/{token}")
-async def websocket_endpoint(websocket: WebSocket, token: str):
-    await websocket.accept()
-    logger.info(f"Cliente intentando conectar con WebSocket: {token[:15]}...")
+def upsert_user(surname: str, employee_id: str, sector: str, hashed_password: str) -> bool:
+    """Registra al usuario, o le pisa la contraseña si ya existía. Devuelve True si era nuevo."""
+    with db_connection() as conn:
+        c = conn.cursor()
+        c.execute(q("SELECT employee_id FROM users WHERE surname = ?"), (surname,))
+        if c.fetchone():
+            c.execute(q("UPDATE users SET sector = ?, password = ? WHERE surname = ?"),
+                      (sector, hashed_password, surname))
+            return False
+        c.execute(q("INSERT INTO users (surname, employee_id, sector, password) VALUES (?, ?, ?, ?)"),
+                  (surname, employee_id, sector, hashed_password))
+        return True
 
-    try:
-        try:
-            decoded_token = base64.b64decode(token).decode('utf-8')
-            parts = decoded_token.split('_')
-            if len(parts) == 3:
-                employee_id, surname, sector = parts
-            else:
-                employee_id = "99999"
-                surname = decoded_token if decoded_token else "Invitado"
-                sector = "Operador"
-                decoded_token = f"{employee_id}_{surname}_{sector}"
-        except Exception as e:
-            logger.error(f"Error decodificando token WebSocket fallback: {str(e)}")
-            employee_id = "99999"
-            surname = "Invitado"
-            sector = "Operador"
-            decoded_token = f"{employee_id}_{surname}_{sector}"
+def find_channel(name: str) -> Optional[tuple]:
+    """(nombre exacto guardado, password_hash) del canal, sin importar mayúsculas."""
+    with db_connection() as conn:
+        c = conn.cursor()
+        c.execute(q("SELECT name, password_hash FROM channels WHERE LOWER(name) = LOWER(?)"), (name,))
+        return c.fetchone()
 
-        # Dynamically restore valid token inside set to prevent disconnect rejection on reboot
-        valid_tokens.add(token)
+def create_channel(name: str, password_hash: str) -> bool:
+    """Crea el canal; devuelve False si ya existía uno con ese nombre."""
+    with db_connection() as conn:
+        c = conn.cursor()
+        c.execute(q("SELECT name FROM channels WHERE LOWER(name) = LOWER(?)"), (name,))
+        if c.fetchone():
+            return False
+        c.execute(
+            q("INSERT INTO channels (name, password_hash, created_at) VALUES (?, ?, ?)"),
+            (name, password_hash, datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"))
+        )
+        return True
 
-        session = load_session(token)
-        user_id = decoded_token
-        
-        if session:
-            users[token] = {
-                "user_id": session["user_id"],
-                "name": session["name"],
-                "function": session["function"],
-                "logged_in": True,
-                "websocket": websocket,
-                "muted_users": session["muted_users"],
-                "subscription": None,
-                "group_id": session["group_id"],
-                "active": True
-            }
-            logger.info(f"Sesión restaurada para: {session['name']}")
-        else:
-            users[token] = {
-                "user_id": user_id,
-                "name": surname,
-                "function": sector,
-                "logged_in": True,
-                "websocket": websocket,
-                "muted_users": set(),
-                "subscription": None,
-                "group_id": None,
-                "active": True
-            }
-            save_session(token, user_id, surname, sector)
-            logger.info(f"Sesión nueva para: {surname}")
+def list_channel_names() -> List[str]:
+    with db_connection() as conn:
+        c = conn.cursor()
+        c.execute("SELECT name FROM channels ORDER BY LOWER(name)")
+        return [row[0] for row in c.fetchall()]
 
-        # Confirmación de conexión exitosa
-        await websocket.send_json({"type": "connection_success", "message": "Conectado"})
+# --- Retención de mensajes ---
+# Antes un loop se despertaba a las 5:30 UTC y corría un único DELETE sin límite
+# comparando la columna `date` (YYYY-MM-DD) contra un texto con hora, que por orden de
+# strings se llevaba también los mensajes del día anterior completo. Ahora la retención
+# corre cada pocos minutos y borra por lotes acotados, cada uno en su propia transacción,
+# comparando fecha contra fecha: vence todo día anterior al de (ahora - retención).
+MESSAGE_RETENTION_HOURS = float(os.getenv("MESSAGE_RETENTION_HOURS", "24"))
+RETENTION_INTERVAL_SECONDS = float(os.getenv("RETENTION_INTERVAL_SECONDS", "300"))
+RETENTION_BATCH_SIZE = int(os.getenv("RETENTION_BATCH_SIZE", "500"))
+RETENTION_BATCH_PAUSE_SECONDS = float(os.getenv("RETENTION_BATCH_PAUSE_SECONDS", "0.05"))
+RETENTION_VACUUM_PAGES = int(os.getenv("RETENTION_VACUUM_PAGES", "2000"))  # SQLite, por corrida
+PARTITION_DAYS_AHEAD = int(os.getenv("PARTITION_DAYS_AHEAD", "2"))  # Postgres: particiones creadas de antemano
+# Carpeta local donde, antes de borrarlos, se guardan los mensajes vencidos (texto y
+# audio) en un archivo comprimido por día. Vacía = no se archiva.
+RETENTION_ARCHIVE_DIR = os.getenv("RETENTION_ARCHIVE_DIR", "")
 
-        # Si ya era miembro de un canal (persistido en la sesión), se lo reintegra
-        # directamente al reconectar -- no hace falta pedirle de nuevo el nombre ni la
-        # contraseña del canal cada vez, la contraseña ya se validó la primera vez que
-        # entró y el token/sesión identifica que es la misma persona.
-        if users[token]["group_id"]:
-            await websocket.send_json({"type": "group_joined", "group_id": users[token]["group_id"]})
+_ARCHIVE_COLUMNS = ("m.id, m.user_id, m.text, m.timestamp, m.date, m.duration, m.audio_mime, "
+                    "m.audio_hash, m.audio, b.data")
 
-        # Enviar historial al usuario en segundo plano: si esto se hiciera con await acá
-        # mismo, el mensaje de Cámara Familiar (monitor_join) que el cliente ya mandó
+def retention_cutoff() -> str:
+    """Primer día que se conserva; los mensajes con `date` anterior están vencidos."""
+    return (datetime.utcnow() - timedelta(hours=MESSAGE_RETENTION_HOURS)).strftime("%Y-%m-%d")
+
+def _retention_lock(c) -> bool:
+    # Con varios workers (ver backplane) cada uno corre su propio loop de retención; el
+    # lock de transacción evita que dos archiven y borren el mismo lote a la vez.
+    if not USE_POSTGRES:
+        return True
+    c.execute("SELECT pg_try_advisory_xact_lock(724002)")
+    return c.fetchone()[0]
+
+def _archive_rows(rows: List[tuple]):
+    """Agrega las filas (columnas de _ARCHIVE_COLUMNS) al segmento del día de cada una,
+    messages-YYYY-MM-DD.jsonl.gz: un miembro gzip por lote, que es un gzip válido al
+    concatenarse. Se escribe antes del DELETE; si la transacción falla después, el lote
+    se vuelve a archivar en la próxima corrida (puede repetirse, nunca perderse)."""
+    by_day: Dict[str, List[str]] = {}
+    for msg_id, user_id, text, timestamp, date, duration, mime, audio_hash, legacy_audio, data in rows:
+        day = date if date and re.fullmatch(r"\d{4}-\d{2}-\d{2}", date) else "sin-fecha"
+        by_day.setdefault(day, []).append(json.dumps({
+            "id": msg_id, "user_id": user_id, "text": text, "timestamp": timestamp, "date": date,
+            "duration": duration, "audio_mime": mime, "audio_hash": audio_hash,
+            "audio": base64.b64encode(bytes(data)).decode() if data is not None else legacy_audio,
+        }))
+    os.makedirs(RETENTION_ARCHIVE_DIR, exist_ok=True)
+    for day, lines in by_day.items():
+        with open(os.path.join(RETENTION_ARCHIVE_DIR, f"messages-{day}.jsonl.gz"), "ab") as f:
+            f.write(gzip.compress(("\n".join(lines) + "\n").encode("utf-8")))
+            f.flush()
+            os.fsync(f.fileno())
+
+def expire_messages_batch(cutoff: str, limit: int) -> int:
+    """Archiva (si corresponde) y borra hasta `limit` mensajes vencidos. En Postgres solo
+    quedan acá los de la partición DEFAULT o de un día cuya partición todavía no se
+    descartó. Devuelve cuántos borró (0 si otro worker tiene la retención tomada)."""
+    with db_connection() as conn:
+        c = conn.cursor()
+        if not _retention_lock(c):
+            return 0
+        if RETENTION_ARCHIVE_DIR:
+            c.execute(q(f"SELECT {_ARCHIVE_COLUMNS} FROM messages m LEFT JOIN audio_blobs b ON b.hash = m.audio_hash "
+                        "WHERE m.date < ? ORDER BY m.date, m.timestamp, m.id LIMIT ?"), (cutoff, limit))
+            rows = c.fetchall()
+            if rows:
+                _archive_rows(rows)
+            ids = [row[0] for row in rows]
+        else:
+            # Mismo orden que idx_messages_date_timestamp: con ORDER BY id el planificador
+            # prefería recorrer la tabla entera por id, aunque no hubiera nada vencido
+            c.execute(q("SELECT id FROM messages WHERE date < ? ORDER BY date, timestamp, id LIMIT ?"),
+                      (cutoff, limit))
+            ids = [row[0] for row in c.fetchall()]
+        if ids:
+            placeholders = ", ".join("?" * len(ids))
+            c.execute(q(f"DELETE FROM messages WHERE date < ? AND id IN ({placeholders})"), (cutoff, *ids))
+    return len(ids)
+
+def expire_client_keys_batch(cutoff: str, limit: int) -> int:
+    """Postgres: borra hasta `limit` claves de idempotencia de mensajes vencidos."""
+    with db_connection() as conn:
+        c = conn.cursor()
+        c.execute("DELETE FROM message_client_keys WHERE ctid IN "
+                  "(SELECT ctid FROM message_client_keys WHERE date < %s LIMIT %s)", (cutoff, limit))
+        return c.rowcount
+
+def ensure_day_partitions():
+    """Postgres: crea las particiones de hoy y de los próximos PARTITION_DAYS_AHEAD días.
+    Si una no se puede crear (p. ej. la DEFAULT ya tiene filas de ese día) se avisa y
+    esos mensajes siguen yendo a la DEFAULT."""
+    today = datetime.utcnow().date()
+    with db_connection() as conn:
+        c = conn.cursor()
+        for n in range(PARTITION_DAYS_AHEAD + 1):
+            day = (today + timedelta(days=n)).isoformat()
+            c.execute("SAVEPOINT day_partition")
+            try:
+                _create_day_partition(c, day)
+                c.execute("RELEASE SAVEPOINT day_partition")
+            except Exception as e:
+                c.execute("ROLLBACK TO SAVEPOINT day_partition")
+                logger.warning(f"No se pudo crear la partición de mensajes del {day}: {e}")
+
+def expired_day_partitions(cutoff: str) -> List[str]:
+    with db_connection() as conn:
+        c = conn.cursor()
+        c.execute("SELECT child.relname FROM pg_inherits "
+                  "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+                  "JOIN pg_class parent ON parent.oid = pg_inherits.inhparent "
+                  "WHERE parent.relname = 'messages'")
+        names = [row[0] for row in c.fetchall() if re.fullmatch(r"messages_\d{8}", row[0])]
+    return sorted(name for name in names if f"{name[9:13]}-{name[13:15]}-{name[15:17]}" < cutoff)
+
+def drop_day_partition(name: str, batch_size: int) -> Optional[int]:
+    """Archiva (si corresponde) y descarta entera una partición diaria vencida. Devuelve
+    cuántos mensajes tenía, o None si otro worker tiene la retención tomada."""
+    with db_connection() as conn:
+        c = conn.cursor()
+        if not _retention_lock(c):
+            return None
+        count = 0
+        if RETENTION_ARCHIVE_DIR:
+            last_id = -1
+            while True:
+                c.execute(f"SELECT {_ARCHIVE_COLUMNS} FROM {name} m LEFT JOIN audio_blobs b ON b.hash = m.audio_hash "
+                          "WHERE m.id > %s ORDER BY m.id LIMIT %s", (last_id, batch_size))
+                rows = c.fetchall()
+                if not rows:
+                    break
+                _archive_rows(rows)
+                count += len(rows)
+                last_id = rows[-1][0]
+        else:
+            c.execute(f"SELECT COUNT(*) FROM {name}")
+            count = c.fetchone()[0]
+        c.execute(f"ALTER TABLE messages DETACH PARTITION {name}")
+        c.execute(f"DROP TABLE {name}")
+    return count
+
+def delete_orphan_blobs_batch(limit: int) -> int:
+    """Borra hasta `limit` clips que ya no referencia ningún mensaje."""
+    with db_connection() as conn:
+        c = conn.cursor()
+        if not _retention_lock(c):
+            return 0
+        c.execute(q("SELECT hash FROM audio_blobs WHERE NOT EXISTS "
+                    "(SELECT 1 FROM messages m WHERE m.audio_hash = audio_blobs.hash) LIMIT ?"), (limit,))
+        hashes = [row[0] for row in c.fetchall()]
+        if hashes:
+            placeholders = ", ".join("?" * len(hashes))
+            # Se repite el NOT EXISTS: entre el SELECT y el DELETE pudo llegar un mensaje
+            # nuevo con el mismo clip.
+            c.execute(q(f"DELETE FROM audio_blobs WHERE hash IN ({placeholders}) AND NOT EXISTS "
+                        "(SELECT 1 FROM messages m WHERE m.audio_hash = audio_blobs.hash)"), hashes)
+    return len(hashes)
+
+def incremental_vacuum(pages: int) -> int:
+    """SQLite: devuelve al disco hasta `pages` páginas libres. Devuelve cuántas liberó."""
+    with db_connection() as conn:
+        c = conn.cursor()
+        c.execute("PRAGMA freelist_count")
+        free = c.fetchone()[0]
+        if free:
+            c.execute(f"PRAGMA incremental_vacuum({int(pages)})")
+            c.fetchall()
+    return min(free, pages)
+
+def delete_stale_stream_chunks(before: str):
+    # Pedazos de transmisiones que nunca se cerraron (p. ej. el servidor se reinició)
+    with db_connection() as conn:
+        c = conn.cursor()
+        c.execute(q("DELETE FROM audio_stream_chunks WHERE created_at < ?"), (before,))
+
+# --- Capa de acceso a datos asíncrona ---
+# Todos los helpers de arriba son bloqueantes (psycopg2/sqlite3). Llamados directamente
+# desde un handler async congelaban el event loop mientras durara la consulta: una
+# consulta lenta dejaba sin atender a todos los sockets, señalización WebRTC incluida.
+# Las versiones *_async los corren en un pool de threads acotado; el tamaño por defecto
+# coincide con el del pool de conexiones, así ningún thread queda esperando conexión.
+DB_EXECUTOR_WORKERS = int(os.getenv("DB_EXECUTOR_WORKERS", str(DB_POOL_MAX)))
+_db_executor: Optional[ThreadPoolExecutor] = None
+
+def get_db_executor() -> ThreadPoolExecutor:
+    """Como get_db_pool: se crea al usarlo por primera vez y, si el shutdown lo cerró, el
+    próximo arranque en el mismo proceso (p. ej. otro TestClient) crea uno nuevo."""
+    global _db_executor
+    if _db_executor is None:
+        _db_executor = ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix="db")
+    return _db_executor
+
+def close_db_executor():
+    global _db_executor
+    if _db_executor is not None:
+        _db_executor.shutdown(wait=True)
+        _db_executor = None
+
+async def run_db(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_db_executor(), functools.partial(func, *args, **kwargs))
+
+async def run_blocking(func, *args, **kwargs):
+    """Para trabajo bloqueante que no es de base de datos: executor por defecto."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, functools.partial(func, *args, **kwargs))
+
+async def save_session_async(*args, **kwargs):
+    return await run_db(save_session, *args, **kwargs)
+
+async def load_session_async(token: str) -> Optional[Dict]:
+    return await run_db(load_session, token)
+
+async def session_exists_async(token: str) -> bool:
+    return await run_db(session_exists, token)
+
+async def delete_session_async(token: str):
+    return await run_db(delete_session, token)
+
+async def save_message_async(*args, **kwargs) -> Dict:
+    return await run_db(save_message, *args, **kwargs)
+
+async def get_user_async(surname: str) -> Optional[tuple]:
+    return await run_db(get_user, surname)
+
+async def upsert_user_async(*args) -> bool:
+    return await run_db(upsert_user, *args)
+
+async def find_channel_async(name: str) -> Optional[tuple]:
+    return await run_db(find_channel, name)
+
+async def create_channel_async(name: str, password_hash: str) -> bool:
+    return await run_db(create_channel, name, password_hash)
+
+async def list_channel_names_async() -> List[str]:
+    return await run_db(list_channel_names)
+
+# --- Sesiones con escritura diferida (write-behind) ---
+# Cada 'ping', mute/unmute, cambio de canal y desconexión reescribía la fila entera de
+# `sessions`: con el ping del cliente cada 10 s, eso era una escritura por usuario cada
+# pocos segundos. El estado de verdad ya vive en `users`, así que alcanza con marcar la
+# sesión como "sucia" y volcar todas las sucias juntas, en un solo upsert en lote, cada
+# SESSION_FLUSH_INTERVAL segundos (o antes, si se juntan SESSION_FLUSH_BATCH).
+SESSION_FLUSH_INTERVAL = float(os.getenv("SESSION_FLUSH_INTERVAL", "30"))
+SESSION_FLUSH_BATCH = int(os.getenv("SESSION_FLUSH_BATCH", "200"))
+
+class SessionWriteBehind:
+    def __init__(self, interval: float, batch_size: int):
+        self.interval = interval
+        self.batch_size = batch_size
+        self._dirty: Dict[str, str] = {}  # token -> last_active al momento de marcarla
+        self.flushes = 0
+        self.rows_written = 0
+        self.bind_loop()
+
+    def bind_loop(self):
+        """Crea de nuevo el Event y el Lock; el startup lo llama en cada arranque porque
+        quedan atados al event loop en el que se usaron por primera vez."""
+        self._wakeup = asyncio.Event()
+        # Serializa los volcados entre sí y contra delete(): sin esto, un volcado que
+        # ya había leído la sesión podía escribirla DESPUÉS del DELETE de un logout y
+        # "resucitarla".
+        self._lock = asyncio.Lock()
+
+    def mark_dirty(self, token: str):
+        self._dirty[token] = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+        if len(self._dirty) >= self.batch_size:
+            self._wakeup.set()
+
+    def is_dirty(self, token: str) -> bool:
+        return token in self._dirty
+
+    async def flush(self) -> int:
+        async with self._lock:
+            if not self._dirty:
+                return 0
+            pending, self._dirty = self._dirty, {}
+            rows = []
+            for token, last_active in pending.items():
+                user = users.get(token)
+                if not user:
+                    continue  # cerró sesión mientras tanto
+                rows.append((token, user.user_id, user.name, user.function, user.group_id,
+                             json.dumps(list(user.muted_users)), last_active))
+            try:
+                await run_db(save_sessions, rows)
+            except Exception:
+                # Se vuelven a marcar para el próximo intento, sin pisar marcas más nuevas
+                for token, last_active in pending.items():
+                    self._dirty.setdefault(token, last_active)
+                raise
+            self.flushes += 1
+            self.rows_written += len(rows)
+            return len(rows)
+
+    async def delete(self, token: str):
+        """Logout: descarta lo pendiente de esa sesión y la borra de la base ya mismo."""
+        async with self._lock:
+            self._dirty.pop(token, None)
+            await delete_session_async(token)
+
+    async def run(self):
+        while True:
+            try:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+                await self.flush()
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                logger.error(f"Error volcando sesiones a la base de datos: {e}")
+
+session_store = SessionWriteBehind(SESSION_FLUSH_INTERVAL, SESSION_FLUSH_BATCH)
+
+# Transcripción en paralelo. Antes había una sola corrutina que hacía await de
+# transcribe_audio mensaje por mensaje, y tanto la decodificación (soundfile/pydub) como
+# recognize_google son bloqueantes: un clip lento demoraba el audio de todos los demás
+# canales. Ahora hay TRANSCRIBE_WORKERS corrutinas tomando de la cola; la decodificación
+# y el remuestreo (CPU) corren en un pool de procesos y la llamada a Google (red) en un
+# pool de threads. DECODE_PROCESSES=0 decodifica en threads (entornos sin fork).
+TRANSCRIBE_WORKERS = int(os.getenv("TRANSCRIBE_WORKERS", str(os.cpu_count() or 2)))
+DECODE_PROCESSES = int(os.getenv("DECODE_PROCESSES", str(os.cpu_count() or 2)))
+TWO_PHASE_DELIVERY = os.getenv("TWO_PHASE_DELIVERY", "1") == "1"
+PENDING_TRANSCRIPT = "Pendiente de transcripción"
+
+# Los dos pools se crean en el startup y se cierran en el shutdown del mismo arranque;
+# fuera de un arranque (scripts, benchmarks) quedan en None y run_in_executor usa el
+# pool por defecto del loop.
+decode_executor: Optional[ProcessPoolExecutor] = None
+recognize_executor: Optional[ThreadPoolExecutor] = None
+
+# --- Ingesta de audio ---
+# Antes transcribe_audio decodificaba cada clip para el reconocedor y tiraba el resultado,
+# mientras se guardaba y reenviaba tal cual lo que hubiera grabado el teléfono (con el
+# bitrate y contenedor que le tocara) con la duración que informaba el cliente. Ahora la
+# ingesta decodifica una sola vez y de ese PCM saca todo:
+#   - duración real y sonoridad (RMS y pico en dBFS);
+#   - normalización de volumen hacia AUDIO_TARGET_LOUDNESS_DB (sin pasar de
+#     AUDIO_MAX_GAIN_DB de ganancia ni dejar el pico por encima de -1 dBFS);
+#   - el clip recodificado a Opus mono a AUDIO_TARGET_RATE (perfil de voz; si por algún
+#     motivo no queda más chico que el original, se guarda el original). Si el original
+#     no era Opus se guarda también, para los clientes que no reproducen Opus;
+#   - WAVEFORM_PEAKS picos para dibujar la forma de onda en la interfaz;
+#   - el WAV PCM 16 bits mono (recortado al tramo con voz, ver voiced_span) que después
+#     usa el reconocedor, sin volver a decodificar.
+# Corre en el pool de procesos (decode_executor), así que no puede tocar nada del
+# estado del servidor.
+AUDIO_INGEST = os.getenv("AUDIO_INGEST", "1") == "1"
+AUDIO_TARGET_RATE = int(os.getenv("AUDIO_TARGET_RATE", "16000"))  # Opus: 8000/12000/16000/24000/48000
+AUDIO_TARGET_LOUDNESS_DB = float(os.getenv("AUDIO_TARGET_LOUDNESS_DB", "-20"))
+AUDIO_MAX_GAIN_DB = float(os.getenv("AUDIO_MAX_GAIN_DB", "20"))
+WAVEFORM_PEAKS = int(os.getenv("WAVEFORM_PEAKS", "64"))
+INGEST_MIME = "audio/ogg; codecs=opus"
+AUDIO_KEEP_ORIGINAL = os.getenv("AUDIO_KEEP_ORIGINAL", "1") == "1"
+OPUS_CONTAINERS = {"webm", "ogg"}
+
+# Contenedor por los primeros bytes del clip. Antes se probaba siempre soundfile y, al
+# fallar (todo lo que graba Chrome es webm), recién ahí pydub: cada clip pagaba una
+# excepción y un warning en el log. Ahora cada contenedor va directo a su decodificador;
+# el desconocido sigue el camino de antes (soundfile y si no, ffmpeg adivinando).
+SOUNDFILE_CONTAINERS = {"wav", "ogg", "flac", "mp3"}
+
+def sniff_container(audio_bytes: bytes) -> Optional[str]:
+    head = audio_bytes[:12]
+    if head[:4] == b"RIFF" and head[8:12] == b"WAVE":
+        return "wav"
+    if head[:4] == b"OggS":
+        return "ogg"
+    if head[:4] == b"fLaC":
+        return "flac"
+    if head[:4] == b"\x1a\x45\xdf\xa3":  # EBML: webm/matroska (MediaRecorder de Chrome/Android)
+        return "webm"
+    if head[4:8] == b"ftyp":  # MP4/M4A (MediaRecorder de Safari)
+        return "mp4"
+    if head[:3] == b"ID3" or (len(head) > 1 and head[0] == 0xFF and head[1] & 0xE0 == 0xE0):
+        return "mp3"
+    return None
+
+def _average_columns(matrix: np.ndarray) -> np.ndarray:
+    # Promedio de cada fila. Con pocas columnas (canales, factor de decimación) un
+    # producto matriz-vector es varias veces más rápido que matrix.mean(axis=1).
+    if matrix.shape[1] == 1:
+        return matrix[:, 0]
+    return matrix @ np.full(matrix.shape[1], 1 / matrix.shape[1], dtype=np.float32)
+
+def _decode_clip_pcm(audio_bytes: bytes) -> Tuple[np.ndarray, int]:
+    """PCM mono en float32 (-1..1) y su frecuencia de muestreo."""
+    container = sniff_container(audio_bytes)
+    if container in SOUNDFILE_CONTAINERS or container is None:
+        try:
+            with io.BytesIO(audio_bytes) as audio_file:
+                data, samplerate = sf.read(audio_file, dtype="float32", always_2d=True)
+            return _average_columns(data), samplerate
+        except Exception as sf_err:
+            if container is not None:
+                raise
+            logger.warning(f"Formato de audio desconocido, intentando con ffmpeg: {sf_err}")
+
+    # webm/mp4 (o desconocido): pydub/ffmpeg solo decodifica; la mezcla a mono y la
+    # conversión a float se hacen acá con numpy de una vez sobre todo el clip.
+    with io.BytesIO(audio_bytes) as audio_file:
+        audio_segment = AudioSegment.from_file(audio_file, format=container)
+    full_scale = float(1 << (8 * audio_segment.sample_width - 1))
+    samples = np.asarray(audio_segment.get_array_of_samples(), dtype=np.float32) / full_scale
+    if audio_segment.channels > 1:
+        samples = _average_columns(samples.reshape(-1, audio_segment.channels))
+    return samples, audio_segment.frame_rate
+
+def _resample(samples: np.ndarray, rate: int, target_rate: int) -> np.ndarray:
+    # Interpolación lineal (si no es un múltiplo exacto): alcanza para voz a 16 kHz y no
+    # suma dependencias
+    if rate == target_rate or len(samples) == 0:
+        return samples
+    if rate % target_rate == 0:
+        # Caso común (48 kHz -> 16 kHz): promedio de cada bloque de `factor` muestras, que
+        # además filtra algo de lo que se plegaría por encima de la nueva Nyquist
+        factor = rate // target_rate
+        usable = len(samples) - len(samples) % factor
+        return _average_columns(samples[:usable].reshape(-1, factor))
+    target_length = int(round(len(samples) * target_rate / rate))
+    positions = np.linspace(0, len(samples) - 1, target_length)
+    return np.interp(positions, np.arange(len(samples)), samples).astype(np.float32)
+
+def _dbfs(value: float) -> float:
+    return round(20 * np.log10(value), 2) if value > 1e-5 else -100.0
+
+def _encode_pcm(samples: np.ndarray, rate: int, fmt: str, subtype: str) -> bytes:
+    with io.BytesIO() as out:
+        sf.write(out, samples, rate, format=fmt, subtype=subtype)
+        return out.getvalue()
+
+# Recorte de silencio para el reconocedor: los clips de PTT suelen tener medio segundo o
+# más de nada al principio (el tiempo hasta empezar a hablar) y al final (hasta soltar
+# el botón), y eso también se sube y se procesa. Detector por energía en ventanas de
+# VAD_FRAME_MS: es voz lo que supera VAD_THRESHOLD_DB y además está a menos de
+# VAD_RELATIVE_DB del tramo más fuerte del clip; se deja VAD_PAD_MS de margen para no
+# comerse el principio de la primera palabra. Solo se recorta lo que ve el reconocedor;
+# el clip guardado y su duración quedan completos.
+VAD_TRIM = os.getenv("VAD_TRIM", "1") == "1"
+VAD_FRAME_MS = int(os.getenv("VAD_FRAME_MS", "20"))
+VAD_THRESHOLD_DB = float(os.getenv("VAD_THRESHOLD_DB", "-45"))
+VAD_RELATIVE_DB = float(os.getenv("VAD_RELATIVE_DB", "35"))
+VAD_PAD_MS = int(os.getenv("VAD_PAD_MS", "200"))
+
+def voiced_span(samples: np.ndarray, rate: int) -> Tuple[int, int]:
+    """(inicio, fin) en muestras del tramo con voz; (0, 0) si no hay voz."""
+    frame = max(1, int(rate * VAD_FRAME_MS / 1000))
+    count = len(samples) // frame
+    if count == 0:
+        return 0, len(samples)
+    frames = samples[:count * frame].reshape(count, frame)
+    frame_db = 20 * np.log10(np.sqrt(np.mean(np.square(frames), axis=1)) + 1e-10)
+    voiced = np.flatnonzero(frame_db > max(VAD_THRESHOLD_DB, frame_db.max() - VAD_RELATIVE_DB))
+    if len(voiced) == 0:
+        return 0, 0
+    pad = int(rate * VAD_PAD_MS / 1000)
+    return max(0, voiced[0] * frame - pad), min(len(samples), (voiced[-1] + 1) * frame + pad)
+
+def _speech_wav(samples: np.ndarray, rate: int, span: Optional[Tuple[int, int]] = None) -> bytes:
+    """WAV para el reconocedor, recortado al tramo con voz. b"" si no hay voz: en ese
+    caso transcribe_audio ni llama al backend."""
+    if VAD_TRIM:
+        start, end = span or voiced_span(samples, rate)
+        if start == end:
+            return b""
+        samples = samples[start:end]
+    return _encode_pcm(samples, rate, "WAV", "PCM_16")
+
+def ingest_clip(audio_bytes: bytes, mime: str) -> Dict:
+    samples, rate = _decode_clip_pcm(audio_bytes)
+    duration = len(samples) / rate if rate else 0.0
+    samples = _resample(samples, rate, AUDIO_TARGET_RATE)
+
+    rms = float(np.sqrt(np.mean(np.square(samples)))) if len(samples) else 0.0
+    peak = float(np.max(np.abs(samples))) if len(samples) else 0.0
+    loudness_db, peak_db = _dbfs(rms), _dbfs(peak)
+    # Antes de la ganancia: normalizado, el ruido de fondo de un clip mudo pasaría el umbral
+    span = voiced_span(samples, AUDIO_TARGET_RATE)
+    gain_db = 0.0
+    if rms > 1e-5:
+        gain_db = min(AUDIO_TARGET_LOUDNESS_DB - loudness_db, AUDIO_MAX_GAIN_DB, -1.0 - peak_db)
+        samples = np.clip(samples * (10 ** (gain_db / 20)), -1.0, 1.0)
+
+    buckets = np.array_split(np.abs(samples), WAVEFORM_PEAKS) if len(samples) else []
+    waveform = [round(float(b.max()), 3) if len(b) else 0.0 for b in buckets]
+
+    encoded, encoded_mime = _encode_pcm(samples, AUDIO_TARGET_RATE, "OGG", "OPUS"), INGEST_MIME
+    if len(encoded) >= len(audio_bytes):
+        encoded, encoded_mime = audio_bytes, mime
+    # Opus no lo reproduce Safari de iOS anterior a la 17. Lo que graba ese Safari (mp4/AAC)
+    # u otro formato que no sea Opus se guarda también tal como llegó, para los clientes
+    # que no lo pueden reproducir; un webm/ogg ya era Opus y no les serviría.
+    keep_original = (AUDIO_KEEP_ORIGINAL and encoded is not audio_bytes
+                     and sniff_container(audio_bytes) not in OPUS_CONTAINERS)
+    return {
+        "audio": encoded,
+        "mime": encoded_mime,
+        "original": audio_bytes if keep_original else None,
+        "original_mime": mime if keep_original else None,
+        "wav": _speech_wav(samples, AUDIO_TARGET_RATE, span),
+        "duration": round(duration, 2),
+        "loudness_db": loudness_db,
+        "peak_db": peak_db,
+        "gain_db": round(gain_db, 2),
+        "waveform": waveform,
+    }
+
+def _decode_clip_to_wav(audio_bytes: bytes) -> bytes:
+    """Decodifica el clip a WAV PCM 16 bits mono (para clips que no pasaron por la ingesta)."""
+    samples, rate = _decode_clip_pcm(audio_bytes)
+    return _speech_wav(_resample(samples, rate, AUDIO_TARGET_RATE), AUDIO_TARGET_RATE)
+
+# --- Backends de transcripción ---
+# transcribe_audio estaba atado a recognize_google y sin timeout: una llamada colgada
+# dejaba a un worker de audio_queue esperando para siempre. Ahora el reconocedor es un
+# backend elegible con TRANSCRIBE_BACKEND:
+#   google  Google Web Speech (el de siempre; necesita red).
+#   vosk    Vosk local (offline; dependencia opcional, el modelo en español que indica
+#           el README, en VOSK_MODEL_PATH).
+#   whisper faster-whisper local (offline; dependencia opcional, modelo WHISPER_MODEL).
+#   stub    texto fijo derivado del audio, sin red ni modelo: para pruebas y benchmarks
+#           (TRANSCRIBE_STUB_DELAY_MS simula la latencia del reconocedor).
+# Cada llamada tiene un plazo (TRANSCRIBE_TIMEOUT_SECONDS) y TRANSCRIBE_RETRIES
+# reintentos. Si fallan TRANSCRIBE_BREAKER_FAILURES llamadas seguidas, el circuito se
+# abre y durante TRANSCRIBE_BREAKER_COOLDOWN_SECONDS no se intenta transcribir (los
+# mensajes salen con "Transcripción no disponible" en vez de esperar el plazo cada
+# uno); después pasa una sola llamada de prueba y según cómo le vaya se cierra o se
+# vuelve a abrir. "No se entendió nada" (UnknownValueError) es una respuesta válida
+# del backend, no una falla.
+TRANSCRIBE_BACKEND = os.getenv("TRANSCRIBE_BACKEND", "google")
+TRANSCRIBE_LANGUAGE = os.getenv("TRANSCRIBE_LANGUAGE", "es-ES")
+TRANSCRIBE_TIMEOUT_SECONDS = float(os.getenv("TRANSCRIBE_TIMEOUT_SECONDS", "15"))
+TRANSCRIBE_RETRIES = int(os.getenv("TRANSCRIBE_RETRIES", "1"))
+TRANSCRIBE_BREAKER_FAILURES = int(os.getenv("TRANSCRIBE_BREAKER_FAILURES", "5"))
+TRANSCRIBE_BREAKER_COOLDOWN_SECONDS = float(os.getenv("TRANSCRIBE_BREAKER_COOLDOWN_SECONDS", "60"))
+TRANSCRIBE_STUB_DELAY_MS = int(os.getenv("TRANSCRIBE_STUB_DELAY_MS", "0"))
+VOSK_MODEL_PATH = os.getenv("VOSK_MODEL_PATH", os.path.join("Model", "vosk-model-es-0.42"))
+WHISPER_MODEL = os.getenv("WHISPER_MODEL", "base")
+WHISPER_COMPUTE_TYPE = os.getenv("WHISPER_COMPUTE_TYPE", "int8")
+LATENCY_BUCKETS = (0.25, 0.5, 1, 2, 5, 10, 20)
+NO_SPEECH_TRANSCRIPT = "Sin voz reconocible"
+
+class TranscriptionUnavailable(Exception):
+    """El circuito del backend está abierto: no se intentó transcribir."""
+
+def _recognize_google(wav_bytes: bytes) -> str:
+    recognizer = sr.Recognizer()
+    # Sin esto urlopen no tiene timeout y el thread queda colgado aunque el plazo de
+    # TranscriptionBackend ya haya vencido.
+    recognizer.operation_timeout = TRANSCRIBE_TIMEOUT_SECONDS
+    with io.BytesIO(wav_bytes) as wav_io:
+        with sr.AudioFile(wav_io) as source:
+            recorded_audio = recognizer.record(source)
+    return recognizer.recognize_google(recorded_audio, language=TRANSCRIBE_LANGUAGE)
+
+_vosk_model = None
+_vosk_lock = threading.Lock()
+
+def _recognize_vosk(wav_bytes: bytes) -> str:
+    global _vosk_model
+    from vosk import KaldiRecognizer, Model
+    with _vosk_lock:
+        # El modelo pesa más de 1 GB: se carga una sola vez y se comparte entre threads
+        if _vosk_model is None:
+            _vosk_model = Model(VOSK_MODEL_PATH)
+    with io.BytesIO(wav_bytes) as wav_io:
+        samples, rate = sf.read(wav_io, dtype="int16")  # ya viene mono a AUDIO_TARGET_RATE
+    recognizer = KaldiRecognizer(_vosk_model, rate)
+    recognizer.AcceptWaveform(samples.tobytes())
+    text = json.loads(recognizer.FinalResult()).get("text", "").strip()
+    if not text:
+        raise sr.UnknownValueError()
+    return text
+
+_whisper_model = None
+_whisper_lock = threading.Lock()
+
+def _recognize_whisper(wav_bytes: bytes) -> str:
+    global _whisper_model
+    with _whisper_lock:
+        # El modelo se carga una sola vez (tarda segundos) y se comparte entre threads
+        if _whisper_model is None:
+            from faster_whisper import WhisperModel
+            _whisper_model = WhisperModel(WHISPER_MODEL, compute_type=WHISPER_COMPUTE_TYPE)
+    with io.BytesIO(wav_bytes) as wav_io:
+        samples, _ = sf.read(wav_io, dtype="float32")  # ya viene mono a AUDIO_TARGET_RATE
+    segments, _ = _whisper_model.transcribe(samples, language=TRANSCRIBE_LANGUAGE.split("-")[0])
+    text = " ".join(segment.text.strip() for segment in segments).strip()
+    if not text:
+        raise sr.UnknownValueError()
+    return text
+
+def _recognize_stub(wav_bytes: bytes) -> str:
+    if TRANSCRIBE_STUB_DELAY_MS:
+        time.sleep(TRANSCRIBE_STUB_DELAY_MS / 1000)
+    with io.BytesIO(wav_bytes) as wav_io:
+        info = sf.info(wav_io)
+    return f"Transcripción de prueba ({info.duration:.1f} s, {hashlib.sha256(wav_bytes).hexdigest()[:8]})"
+
+TRANSCRIBE_BACKENDS = {
+    "google": _recognize_google,
+    "vosk": _recognize_vosk,
+    "whisper": _recognize_whisper,
+    "stub": _recognize_stub,
+}
+
+class TranscriptionBackend:
+    def __init__(self, name: str, recognize, timeout: float, retries: int, breaker_failures: int,
+                 breaker_cooldown: float):
+        self.name = name
+        self.recognize = recognize
+        self.timeout = timeout
+        self.retries = retries
+        self.breaker_failures = breaker_failures
+        self.breaker_cooldown = breaker_cooldown
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self.probing = False
+        self.stats = {"calls": 0, "ok": 0, "no_speech": 0, "errors": 0, "timeouts": 0, "retries": 0,
+                      "skipped": 0, "saturated": 0, "breaker_opened": 0}
+        self.latency_buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.latency_sum = 0.0
+        self.in_flight = 0
+        self.bind_loop()
+
+    def bind_loop(self):
+        # Un lugar por thread de recognize_executor. Una llamada que vence el plazo sigue
+        # corriendo en su thread (no se puede interrumpir) y conserva el lugar hasta que
+        # termina de verdad: así los reintentos y los clips siguientes esperan un thread
+        # libre en vez de encolarse detrás de llamadas colgadas.
+        self.slots = asyncio.Semaphore(TRANSCRIBE_WORKERS)
+
+    @property
+    def state(self) -> str:
+        if self.open_until and time.monotonic() < self.open_until:
+            return "open"
+        return "half_open" if self.open_until else "closed"
+
+    def _allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half_open" and not self.probing:
+            self.probing = True  # una sola llamada de prueba a la vez
+            return True
+        return False
+
+    def _observe(self, seconds: float):
+        self.latency_sum += seconds
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                self.latency_buckets[i] += 1
+                return
+        self.latency_buckets[-1] += 1
+
+    def _record(self, healthy: bool):
+        self.probing = False
+        if healthy:
+            self.consecutive_failures = 0
+            self.open_until = 0.0
+            return
+        self.consecutive_failures += 1
+        if self.open_until or self.consecutive_failures >= self.breaker_failures:
+            if self.state != "open":
+                self.stats["breaker_opened"] += 1
+                logger.warning(f"Transcripción ({self.name}) con fallas: se pausa {self.breaker_cooldown:.0f}s")
+            self.open_until = time.monotonic() + self.breaker_cooldown
+
+    def _submit(self, wav_bytes: bytes):
+        """Lanza el reconocedor en recognize_executor; el lugar tomado en `slots` se
+        devuelve cuando el thread termina, no cuando se deja de esperarlo."""
+        loop, slots = asyncio.get_running_loop(), self.slots
+        call = recognize_executor.submit(self.recognize, wav_bytes)
+        self.in_flight += 1
+
+        def release():
+            self.in_flight -= 1
+            slots.release()
+
+        def done(_):
+            try:
+                loop.call_soon_threadsafe(release)
+            except RuntimeError:
+                pass  # el loop ya se cerró (apagado)
+
+        call.add_done_callback(done)
+        return call
+
+    async def transcribe(self, wav_bytes: bytes) -> str:
+        if recognize_executor is None or not self._allow():
+            self.stats["skipped"] += 1
+            raise TranscriptionUnavailable(self.name)
+        error: Optional[Exception] = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                self.stats["retries"] += 1
+            started = time.monotonic()
+            try:
+                await asyncio.wait_for(self.slots.acquire(), self.timeout)
+            except asyncio.TimeoutError as e:
+                # Todos los threads siguen ocupados con llamadas anteriores
+                self.stats["saturated"] += 1
+                error = e
+                break
+            except asyncio.CancelledError:
+                self.probing = False
+                raise
+            self.stats["calls"] += 1
+            call = self._submit(wav_bytes)
+            try:
+                # El plazo libera al worker; el thread del reconocedor termina por su
+                # cuenta (Google tiene su propio timeout de red).
+                remaining = max(0.0, self.timeout - (time.monotonic() - started))
+                text = await asyncio.wait_for(asyncio.wrap_future(call), remaining)
+            except asyncio.CancelledError:
+                self.probing = False
+                raise
+            except sr.UnknownValueError:
+                self._observe(time.monotonic() - started)
+                self.stats["no_speech"] += 1
+                self._record(True)
+                return NO_SPEECH_TRANSCRIPT
+            except asyncio.TimeoutError as e:
+                self.stats["timeouts"] += 1
+                error = e
+            except Exception as e:
+                self.stats["errors"] += 1
+                error = e
+            else:
+                self._observe(time.monotonic() - started)
+                self.stats["ok"] += 1
+                self._record(True)
+                return text
+            self._observe(time.monotonic() - started)
+            if not call.done():
+                # Sigue colgada y con su lugar: un reintento sería otra llamada al mismo
+                # backend que no responde
+                break
+        self._record(False)
+        raise error
+
+    def metrics(self) -> Dict:
+        histogram = {f"le_{bound}": count for bound, count in zip(LATENCY_BUCKETS, self.latency_buckets)}
+        histogram["le_inf"] = self.latency_buckets[-1]
+        observed = sum(self.latency_buckets)
+        return {
+            **self.stats,
+            "state": self.state,
+            "in_flight": self.in_flight,
+            "consecutive_failures": self.consecutive_failures,
+            "latency_seconds": histogram,
+            "latency_avg_seconds": round(self.latency_sum / observed, 3) if observed else None,
+        }
+
+if TRANSCRIBE_BACKEND not in TRANSCRIBE_BACKENDS:
+    logger.error(f"TRANSCRIBE_BACKEND '{TRANSCRIBE_BACKEND}' desconocido, se usa 'google'")
+    TRANSCRIBE_BACKEND = "google"
+transcription = TranscriptionBackend(TRANSCRIBE_BACKEND, TRANSCRIBE_BACKENDS[TRANSCRIBE_BACKEND],
+                                     TRANSCRIBE_TIMEOUT_SECONDS, TRANSCRIBE_RETRIES,
+                                     TRANSCRIBE_BREAKER_FAILURES, TRANSCRIBE_BREAKER_COOLDOWN_SECONDS)
+
+ingest_stats = {"clips": 0, "failed": 0, "bytes_in": 0, "bytes_out": 0, "transcoded": 0, "originals_kept": 0}
+
+async def ingest_audio(audio_bytes: bytes, mime: str) -> Optional[Dict]:
+    """Corre la ingesta en el pool de procesos. None si el clip no se pudo decodificar:
+    en ese caso se guarda y entrega tal cual, como antes."""
+    if not AUDIO_INGEST:
+        return None
+    loop = asyncio.get_running_loop()
+    try:
+        result = await loop.run_in_executor(decode_executor or recognize_executor, ingest_clip, audio_bytes, mime)
+    except Exception as e:
+        ingest_stats["failed"] += 1
+        logger.error(f"No se pudo procesar el audio en la ingesta: {e}")
+        return None
+    ingest_stats["clips"] += 1
+    ingest_stats["bytes_in"] += len(audio_bytes)
+    ingest_stats["bytes_out"] += len(result["audio"])
+    if result["audio"] is not audio_bytes:
+        ingest_stats["transcoded"] += 1
+    if result.get("original"):
+        ingest_stats["originals_kept"] += 1
+        ingest_stats["bytes_out"] += len(result["original"])
+    return result
+
+# --- Ingesta idempotente ---
+# El service worker (handlysw.js) encola los mensajes que no se pudieron mandar y los
+# reintenta al volver la conexión; con conectividad inestable el mismo clip llegaba dos
+# o tres veces y cada vez se transcribía, se insertaba otra fila y se reenviaba a todos.
+# Ahora el cliente manda una `client_key` por mensaje (la misma en cada reintento) y
+# antes de encolar se descarta lo que ya se vio, por esa clave o por el hash del audio
+# (claim_ingest). La caché vive IDEMPOTENCY_TTL_SECONDS; pasado eso (o tras un
+# reinicio) el índice único de messages.client_key (en Postgres, la tabla
+# message_client_keys) sigue evitando la fila repetida.
+# Aparte, transcript_cache guarda el resultado del reconocedor por hash del audio
+# decodificado: un clip repetido no vuelve a pasar por recognize_google.
+IDEMPOTENCY_TTL_SECONDS = int(os.getenv("IDEMPOTENCY_TTL_SECONDS", "600"))
+IDEMPOTENCY_MAX_KEYS = int(os.getenv("IDEMPOTENCY_MAX_KEYS", "4096"))
+TRANSCRIPT_CACHE_SIZE = int(os.getenv("TRANSCRIPT_CACHE_SIZE", "512"))
+TRANSCRIPT_CACHE_TTL_SECONDS = int(os.getenv("TRANSCRIPT_CACHE_TTL_SECONDS", "3600"))
+
+class TTLCache:
+    """LRU acotado por cantidad de entradas, con vencimiento por entrada. Solo se usa
+    desde el loop de asyncio, así que no necesita lock."""
+
+    def __init__(self, max_items: int, ttl: float):
+        self.max_items = max_items
+        self.ttl = ttl
+        self._items: "OrderedDict[str, tuple]" = OrderedDict()
+
+    def get(self, key: str):
+        item = self._items.get(key)
+        if item is None:
+            return None
+        expires, value = item
+        if expires < time.monotonic():
+            del self._items[key]
+            return None
+        self._items.move_to_end(key)
+        return value
+
+    def put(self, key: str, value):
+        self._items[key] = (time.monotonic() + self.ttl, value)
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_items:
+            self._items.popitem(last=False)
+
+    def pop(self, key: str):
+        self._items.pop(key, None)
+
+    @property
+    def size(self) -> int:
+        return len(self._items)
+
+ingest_keys = TTLCache(IDEMPOTENCY_MAX_KEYS, IDEMPOTENCY_TTL_SECONDS)
+transcript_cache = TTLCache(TRANSCRIPT_CACHE_SIZE, TRANSCRIPT_CACHE_TTL_SECONDS)
+dedup_stats = {"accepted": 0, "duplicates": 0, "stored_duplicates": 0, "transcript_hits": 0, "transcript_misses": 0}
+
+def claim_ingest(token: str, message: Dict, audio_bytes: bytes) -> Optional[Dict]:
+    """Registra el mensaje como visto. Si ya se había visto (misma client_key o mismo
+    audio del mismo usuario), devuelve la entrada anterior y el mensaje se descarta.
+    La entrada es compartida por sus claves y guarda el id cuando se termina de guardar."""
+    user_id = f"{users[token].name}_{users[token].function}"
+    keys = [f"{user_id}#{hashlib.sha256(audio_bytes).hexdigest()}"]
+    if message.get("client_key"):
+        keys.insert(0, f"{user_id}:{message['client_key']}")
+    for key in keys:
+        entry = ingest_keys.get(key)
+        if entry is not None:
+            dedup_stats["duplicates"] += 1
+            return entry
+    entry = {"id": None, "keys": keys}
+    for key in keys:
+        ingest_keys.put(key, entry)
+    message["ingest"] = entry
+    dedup_stats["accepted"] += 1
+    return None
+
+def release_ingest(message: Dict):
+    """El mensaje no se llegó a guardar: un reintento tiene que poder entrar."""
+    entry = message.pop("ingest", None)
+    if entry is not None:
+        for key in entry["keys"]:
+            ingest_keys.pop(key)
+
+# --- Credenciales ---
+# bcrypt tarda a propósito (~250 ms por hash) y en un cambio de turno llegan decenas de
+# logins y reingresos a canales a la vez. Corría en el executor por defecto, compartido y
+# sin tope: una tanda de logins podía ocupar todos los núcleos y dejar sin CPU al audio y
+# la señalización. Ahora:
+#   - los hashes corren en un pool propio de HASH_WORKERS threads (bcrypt suelta el GIL,
+#     así que el tope de threads es el tope de núcleos que se lleva), con a lo sumo
+#     HASH_MAX_PENDING pedidos en curso; pasado eso se rechaza de entrada (HashingBusy)
+#     en lugar de acumular esperas;
+#   - una contraseña de canal ya verificada no se vuelve a verificar durante
+#     CHANNEL_VERIFY_TTL_SECONDS: al reconectarse todos a la vez cada reingreso al canal
+#     costaba un checkpw. La clave de la caché es un HMAC con un secreto del proceso, así
+#     la memoria no guarda contraseñas ni un hash rápido que se pueda atacar por fuerza
+#     bruta; incluye el hash guardado, de modo que cambiar la contraseña invalida lo cacheado;
+#   - los intentos fallidos se limitan por IP (AttemptThrottle) y se cortan antes de
+#     gastar un hash. Por apellido no se corta: con un bloqueo duro cualquiera dejaba
+#     afuera a otro con cinco contraseñas malas; pasados LOGIN_MAX_FAILURES fallos cada
+#     intento sobre ese apellido espera un poco más (login_delay), lo que frena la fuerza
+#     bruta repartida entre muchas IP sin trabar al dueño de la cuenta.
+HASH_WORKERS = int(os.getenv("HASH_WORKERS", "2"))
+HASH_MAX_PENDING = int(os.getenv("HASH_MAX_PENDING", "32"))
+CHANNEL_VERIFY_TTL_SECONDS = int(os.getenv("CHANNEL_VERIFY_TTL_SECONDS", "900"))
+CHANNEL_VERIFY_MAX_ENTRIES = int(os.getenv("CHANNEL_VERIFY_MAX_ENTRIES", "2048"))
+LOGIN_MAX_FAILURES = int(os.getenv("LOGIN_MAX_FAILURES", "5"))  # por apellido, antes de demorar
+LOGIN_FAILURE_DELAY_SECONDS = float(os.getenv("LOGIN_FAILURE_DELAY_SECONDS", "1"))  # se duplica por fallo
+LOGIN_MAX_DELAY_SECONDS = float(os.getenv("LOGIN_MAX_DELAY_SECONDS", "15"))
+LOGIN_MAX_FAILURES_PER_IP = int(os.getenv("LOGIN_MAX_FAILURES_PER_IP", "20"))
+LOGIN_FAILURE_WINDOW_SECONDS = float(os.getenv("LOGIN_FAILURE_WINDOW_SECONDS", "300"))
+REGISTER_MAX_PER_IP = int(os.getenv("REGISTER_MAX_PER_IP", "10"))  # cada registro cuesta un hash
+# Cuántos proxies propios hay delante (Render: 1). Cada uno agrega a la derecha de
+# X-Forwarded-For la IP de la que recibió la conexión; lo que está más a la izquierda lo
+# escribe el cliente y no sirve para limitar. Con 0 se ignora el encabezado.
+TRUSTED_PROXY_HOPS = int(os.getenv("TRUSTED_PROXY_HOPS", "0"))
+
+class HashingBusy(Exception):
+    """Ya hay HASH_MAX_PENDING hashes en curso."""
+
+class CredentialHasher:
+    def __init__(self, workers: int, max_pending: int):
+        self.max_pending = max(workers, max_pending)
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="hash")
+        self._pending = 0
+        self.stats = {"hashed": 0, "checked": 0, "rejected": 0, "busy_seconds": 0.0}
+
+    async def _run(self, kind: str, func, *args):
+        if self._pending >= self.max_pending:
+            self.stats["rejected"] += 1
+            raise HashingBusy(f"{self._pending} hashes en curso")
+        self.stats[kind] += 1
+        self._pending += 1
+        started = time.monotonic()
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, functools.partial(func, *args))
+        finally:
+            self._pending -= 1
+            self.stats["busy_seconds"] += time.monotonic() - started
+
+    async def hash(self, password: str) -> str:
+        return await self._run("hashed", _hash_password, password)
+
+    async def check(self, password: str, stored_hash) -> bool:
+        return await self._run("checked", _check_password, password, stored_hash)
+
+    def metrics(self) -> Dict:
+        return {**self.stats, "pending": self._pending, "busy_seconds": round(self.stats["busy_seconds"], 3)}
+
+def _hash_password(password: str) -> str:
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+
+def _check_password(password: str, stored_hash) -> bool:
+    stored_bytes = stored_hash.encode('utf-8') if isinstance(stored_hash, str) else stored_hash
+    return bcrypt.checkpw(password.encode('utf-8'), stored_bytes)
+
+class AttemptThrottle:
+    """Cuenta intentos por clave en una ventana deslizante. Cuántas claves recuerda está
+    acotado (se olvidan primero las que hace más que no intentan). Solo se usa desde el
+    loop de asyncio."""
+
+    def __init__(self, window: float, max_keys: int = 10000):
+        self.window = window
+        self.max_keys = max_keys
+        self._attempts: "OrderedDict[str, deque]" = OrderedDict()
+        self.blocked_count = 0
+
+    def count(self, key: str) -> int:
+        """Intentos de `key` dentro de la ventana."""
+        attempts = self._attempts.get(key)
+        if not attempts:
+            return 0
+        cutoff = time.monotonic() - self.window
+        while attempts and attempts[0] <= cutoff:
+            attempts.popleft()
+        return len(attempts)
+
+    def retry_after(self, key: str, limit: int) -> float:
+        """Segundos hasta que `key` pueda volver a intentar (0 = puede ya)."""
+        if self.count(key) < limit:
+            return 0.0
+        self.blocked_count += 1
+        return self._attempts[key][-limit] + self.window - time.monotonic()
+
+    def record(self, key: str):
+        attempts = self._attempts.setdefault(key, deque())
+        attempts.append(time.monotonic())
+        self._attempts.move_to_end(key)
+        while len(self._attempts) > self.max_keys:
+            self._attempts.popitem(last=False)
+
+    def reset(self, key: str):
+        self._attempts.pop(key, None)
+
+    @property
+    def size(self) -> int:
+        return len(self._attempts)
+
+hasher = CredentialHasher(HASH_WORKERS, HASH_MAX_PENDING)
+channel_verifications = TTLCache(CHANNEL_VERIFY_MAX_ENTRIES, CHANNEL_VERIFY_TTL_SECONDS)
+_channel_verify_secret = os.urandom(32)
+login_throttle = AttemptThrottle(LOGIN_FAILURE_WINDOW_SECONDS)
+register_throttle = AttemptThrottle(LOGIN_FAILURE_WINDOW_SECONDS)
+credential_stats = {"channel_cache_hits": 0, "channel_cache_misses": 0, "login_delayed": 0}
+
+def client_ip(headers, client) -> str:
+    """La IP que vio el primero de nuestros TRUSTED_PROXY_HOPS proxies (ver arriba)."""
+    if TRUSTED_PROXY_HOPS and headers.get("x-forwarded-for"):
+        hops = [hop.strip() for hop in headers["x-forwarded-for"].split(",")]
+        if len(hops) >= TRUSTED_PROXY_HOPS and hops[-TRUSTED_PROXY_HOPS]:
+            return hops[-TRUSTED_PROXY_HOPS]
+    return client.host if client else "?"
+
+def ip_throttle_key(ip: str) -> str:
+    """Clave de login_throttle por IP, común a logins y canales."""
+    return f"ip:{ip}"
+
+def throttled_for(ip_key: str) -> float:
+    return login_throttle.retry_after(ip_key, LOGIN_MAX_FAILURES_PER_IP)
+
+def login_delay(surname_key: str) -> float:
+    """Segundos que espera un intento sobre un apellido con LOGIN_MAX_FAILURES o más
+    fallos en la ventana; se duplica con cada fallo hasta LOGIN_MAX_DELAY_SECONDS."""
+    excess = login_throttle.count(surname_key) - LOGIN_MAX_FAILURES
+    if excess < 0:
+        return 0.0
+    return min(LOGIN_MAX_DELAY_SECONDS, LOGIN_FAILURE_DELAY_SECONDS * 2 ** excess)
+
+def record_failure(*keys: str):
+    for key in keys:
+        login_throttle.record(key)
+
+def too_many_attempts(wait: float) -> HTTPException:
+    return HTTPException(status_code=429, detail="Demasiados intentos, esperá un momento",
+                         headers={"Retry-After": str(max(1, int(wait + 0.999)))})
+
+def hashing_busy() -> HTTPException:
+    return HTTPException(status_code=503, detail="Servidor ocupado, probá de nuevo en unos segundos",
+                         headers={"Retry-After": "2"})
+
+async def hash_password_async(password: str) -> str:
+    return await hasher.hash(password)
+
+async def check_password_async(password: str, stored_hash) -> bool:
+    return await hasher.check(password, stored_hash)
+
+async def check_channel_password(channel: str, password: str, stored_hash) -> bool:
+    """check_password_async con la caché de verificaciones exitosas de canales."""
+    key = hmac.new(_channel_verify_secret, "\0".join((channel.lower(), str(stored_hash), password)).encode("utf-8"),
+                   hashlib.sha256).hexdigest()
+    if channel_verifications.get(key):
+        credential_stats["channel_cache_hits"] += 1
+        return True
+    credential_stats["channel_cache_misses"] += 1
+    if not await hasher.check(password, stored_hash):
+        return False
+    channel_verifications.put(key, True)
+    return True
+
+# Transcribir audio a texto con el backend configurado (ver TranscriptionBackend). Si el clip ya
+# pasó por la ingesta se le pasa `wav` y no se vuelve a decodificar.
+async def transcribe_audio(audio_bytes: bytes, wav: Optional[bytes] = None) -> str:
+    loop = asyncio.get_running_loop()
+    try:
+        if wav == b"":
+            return NO_SPEECH_TRANSCRIPT  # la ingesta no encontró voz en el clip
+        cache_key = hashlib.sha256(wav if wav is not None else audio_bytes).hexdigest()
+        cached = transcript_cache.get(cache_key)
+        if cached is not None:
+            dedup_stats["transcript_hits"] += 1
+            return cached
+        dedup_stats["transcript_misses"] += 1
+        wav_bytes = wav
+        if wav_bytes is None:
+            wav_bytes = await loop.run_in_executor(decode_executor or recognize_executor, _decode_clip_to_wav, audio_bytes)
+            if not wav_bytes:
+                return NO_SPEECH_TRANSCRIPT
+        text = await transcription.transcribe(wav_bytes)
+        logger.info("Audio transcrito exitosamente.")
+        transcript_cache.put(cache_key, text)
+        return text
+    except TranscriptionUnavailable:
+        return "Transcripción no disponible"
+    except Exception as e:
+        logger.error(f"Error al transcribir el audio en todos los métodos: {e}")
+        return "Transcripción no disponible"
+
+# Con varios workers, dos clips del mismo canal pueden terminar de transcribirse en
+# cualquier orden. Para que igual se entreguen en el orden en que llegaron, cada mensaje
+# queda encadenado al anterior de su misma conversación (grupo, directo entre dos
+# personas, o general) y no se guarda/entrega hasta que ese anterior se entregó.
+_conversation_tails: Dict[str, asyncio.Future] = {}
+
+def claim_conversation_turn(key: str) -> Tuple[Optional[asyncio.Future], asyncio.Future]:
+    """Encadena un mensaje al último de su conversación. Devuelve (anterior, propio): hay
+    que esperar `anterior` antes de guardar/entregar y resolver `propio` al entregar (o
+    llamar a release_conversation_turn si el mensaje no llega a entregarse). Se llama sin
+    await de por medio desde que llegó el mensaje, así la cadena sigue el orden de llegada."""
+    previous = _conversation_tails.get(key)
+    done = asyncio.get_running_loop().create_future()
+    _conversation_tails[key] = done
+    return previous, done
+
+def release_conversation_turn(key: str, done: asyncio.Future):
+    if not done.done():
+        done.set_result(None)
+    if _conversation_tails.get(key) is done:
+        del _conversation_tails[key]
+
+# Transcripciones de la segunda fase en curso; el semáforo limita cuántas corren a la vez
+transcription_slots = asyncio.Semaphore(TRANSCRIBE_WORKERS)
+_transcript_tasks: Set[asyncio.Task] = set()
+
+# Mensajes enviados al conectarse, con y sin cursor de reanudación. Se cuentan en el mismo
+# bucle que los manda: medir lo que se ahorró exigiría recorrer la tabla en cada reconexión.
+resume_stats = {"resumes": 0, "full_loads": 0, "resumed_messages": 0, "full_messages": 0}
+
+audio_pipeline_stats = {
+    "workers": TRANSCRIBE_WORKERS,
+    "busy": 0,
+    "processed": 0,
+    "busy_seconds": 0.0,
+    "started_at": time.monotonic(),
+}
+
+def conversation_key(token: str, message: Dict) -> str:
+    group_id = message.get("group_id")
+    target_user_id = message.get("target_user_id")
+    if message.get("type") == "group_message" or group_id is not None:
+        return f"group:{group_id}"
+    if message.get("type") == "direct_message" or target_user_id is not None:
+        sender_id = f"{message.get('sender', 'Unknown')}_{message.get('function', 'Unknown')}"
+        return "direct:" + "|".join(sorted([sender_id, str(target_user_id)]))
+    return "general"
+
+def audio_recipients(token: str, message: Dict) -> List[str]:
+    """Tokens con socket abierto a los que hay que entregar este mensaje de audio."""
+    sender_id = f"{message.get('sender', 'Unknown')}_{message.get('function', 'Unknown')}"
+    group_id = message.get("group_id")
+    target_user_id = message.get("target_user_id")
+    is_group = message.get("type") == "group_message" or group_id is not None
+    is_direct = message.get("type") == "direct_message" or target_user_id is not None
+
+    # Solo se entrega a quien tiene socket abierto (routing.online); los que tienen sesión
+    # pero están sin socket no se pierden, simplemente no se les transmite.
+    # Mensaje de grupo: solo los miembros conectados de ese grupo.
+    candidates = routing.groups.get(group_id, set()) if is_group and group_id else routing.online
+    # Mensaje directo: solo el que lo manda y el operador destino
+    if is_direct:
+        candidates = candidates & ({token} | routing.user_tokens.get(target_user_id, set()))
+
+    recipients = []
+    for user_token in list(candidates):
+        user = users[user_token]
+        # group_message sin group_id: como siempre, va a los que no están en ningún grupo
+        if is_group and user.group_id != group_id:
+            continue
+        muted_users = user.muted_users
+        # Only skip if this user muted the sender (not if they are the sender)
+        if sender_id in muted_users and user_token != token:
+            continue
+        recipients.append(user_token)
+    return recipients
+
+# --- Colas de salida por conexión ---
+# Antes cada corrutina que quería mandarle algo a un cliente (historial, audio, lista de
+# usuarios, señalización de la Cámara Familiar) hacía send_json directo sobre el socket:
+# sin límite de lo que se acumulaba y sin orden entre productores. Ahora cada conexión
+# tiene una cola acotada y una única tarea que escribe en el socket, con prioridades:
+# control/señalización primero, después presencia, y por último historial y audio.
+# Si la cola se llena (teléfono trabado), OUTBOX_FULL_POLICY decide:
+#   - "drop_presence": se descarta el aviso de presencia más viejo en cola (el cliente
+#     detecta el hueco por la versión y pide la lista entera de nuevo); si no hay ninguno
+#     para descartar, se desconecta al cliente.
+#   - "disconnect": se desconecta al cliente directamente.
+OUTBOX_MAX_FRAMES = int(os.getenv("OUTBOX_MAX_FRAMES", "256"))
+OUTBOX_FULL_POLICY = os.getenv("OUTBOX_FULL_POLICY", "drop_presence")
+FANOUT_SEND_TIMEOUT = float(os.getenv("FANOUT_SEND_TIMEOUT", "5"))
+
+PRIORITY_CONTROL = 0
+PRIORITY_PRESENCE = 1
+PRIORITY_BULK = 2
+
+outbox_stats = {
+    "frames_sent": 0,
+    "presence_dropped": 0,
+    "slow_disconnects": 0,
+    "send_failures": 0,
+    "delivery_ms_total": 0.0,
+    "delivery_ms_max": 0.0,
+}
+
+class Outbox:
+    def __init__(self, token: str, websocket: WebSocket, max_frames: int = OUTBOX_MAX_FRAMES,
+                 policy: str = OUTBOX_FULL_POLICY, send_timeout: float = FANOUT_SEND_TIMEOUT,
+                 binary: bool = False):
+        self.token = token
+        self.websocket = websocket
+        self.binary = binary  # el cliente entiende frames binarios de audio
+        self.max_frames = max_frames
+        self.policy = policy
+        self.send_timeout = send_timeout
+        self.closed = False
+        # Una cola por prioridad; cada elemento es (frame, momento en que se encoló)
+        self._queues = (deque(), deque(), deque())
+        self._has_frames = asyncio.Event()
+        self._has_space = asyncio.Event()
+        self._has_space.set()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._writer_task = asyncio.create_task(self._writer())
+
+    @property
+    def queued(self) -> int:
+        return sum(len(queue) for queue in self._queues)
+
+    def put(self, frame, priority: int = PRIORITY_CONTROL, broadcast: Optional["Broadcast"] = None) -> bool:
+        """Encola sin esperar. Devuelve False si la conexión está (o quedó) cerrada. Si el
+        frame es parte de una difusión, se le avisa a `broadcast` cuando sale o se pierde."""
+        if self.closed:
+            _settle(broadcast, False)
+            return False
+        if self.queued >= self.max_frames:
+            if self.policy == "drop_presence" and self._queues[PRIORITY_PRESENCE]:
+                _settle(self._queues[PRIORITY_PRESENCE].popleft()[2], False)
+                outbox_stats["presence_dropped"] += 1
+            elif self.policy == "drop_presence" and priority == PRIORITY_PRESENCE:
+                outbox_stats["presence_dropped"] += 1
+                _settle(broadcast, False)
+                return True
+            else:
+                logger.warning(f"Cola de salida llena para {self.token[:15]}...: desconectando cliente lento")
+                outbox_stats["slow_disconnects"] += 1
+                self.close(code=1013)
+                _settle(broadcast, False)
+                return False
+        self._queues[priority].append((frame, time.monotonic(), broadcast))
+        self._idle.clear()
+        self._has_frames.set()
+        self._update_space()
+        return True
+
+    async def put_wait(self, frame, priority: int = PRIORITY_BULK) -> bool:
+        """Para productores que pueden esperar (el historial): no encola mientras la cola
+        esté por encima de la mitad, así siempre queda lugar para el tráfico en vivo."""
+        while not self.closed and self.queued >= self.max_frames // 2:
+            await self._has_space.wait()
+        return self.put(frame, priority)
+
+    async def drain(self, timeout: float):
+        """Espera (hasta `timeout`) a que se haya enviado todo lo encolado."""
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def close(self, code: int = 1000, close_socket: bool = True):
+        if self.closed:
+            return
+        self.closed = True
+        for queue in self._queues:
+            for _, _, broadcast in queue:
+                _settle(broadcast, False)
+            queue.clear()
+        self._has_space.set()
+        self._idle.set()
+        if self._writer_task is not asyncio.current_task():
+            self._writer_task.cancel()
+        if close_socket:
+            # Cerrar el socket hace que el bucle de recepción de esa conexión salga por
+            # WebSocketDisconnect y haga la limpieza de siempre.
+            asyncio.create_task(self._close_socket(code))
+
+    async def _close_socket(self, code: int):
+        try:
+            await self.websocket.close(code=code)
+        except Exception:
+            pass
+
+    def _update_space(self):
+        if self.queued < self.max_frames // 2:
+            self._has_space.set()
+        else:
+            self._has_space.clear()
+
+    def _pop(self):
+        for queue in self._queues:
+            if queue:
+                item = queue.popleft()
+                self._update_space()
+                return item
+        return None
+
+    async def _writer(self):
+        broadcast = None
+        try:
+            while True:
+                await self._has_frames.wait()
+                item = self._pop()
+                if item is None:
+                    self._has_frames.clear()
+                    self._idle.set()
+                    continue
+                frame, enqueued_at, broadcast = item
+                if isinstance(frame, bytes):
+                    await asyncio.wait_for(self.websocket.send_bytes(frame), timeout=self.send_timeout)
+                else:
+                    await asyncio.wait_for(self.websocket.send_text(frame), timeout=self.send_timeout)
+                delivery_ms = (time.monotonic() - enqueued_at) * 1000
+                outbox_stats["frames_sent"] += 1
+                outbox_stats["delivery_ms_total"] += delivery_ms
+                outbox_stats["delivery_ms_max"] = max(outbox_stats["delivery_ms_max"], delivery_ms)
+                _settle(broadcast, True)
+                broadcast = None
+        except asyncio.CancelledError:
+            _settle(broadcast, False)
+        except Exception as e:
+            _settle(broadcast, False)
+            reason = "timeout" if isinstance(e, asyncio.TimeoutError) else e
+            outbox_stats["send_failures"] += 1
+            logger.error(f"Error enviando a {self.token[:15]}...: {reason}")
+            self.close(code=1011)
+
+def outbox_metrics() -> Dict:
+    sent = outbox_stats["frames_sent"]
+    return {
+        "queued_frames": sum(u.outbox.queued for u in users.values() if u.outbox),
+        "frames_sent": sent,
+        "presence_dropped": outbox_stats["presence_dropped"],
+        "slow_disconnects": outbox_stats["slow_disconnects"],
+        "send_failures": outbox_stats["send_failures"],
+        "avg_delivery_ms": round(outbox_stats["delivery_ms_total"] / sent, 2) if sent else 0.0,
+        "max_delivery_ms": round(outbox_stats["delivery_ms_max"], 2),
+    }
+
+def send_to(token: str, payload: Dict, priority: int = PRIORITY_CONTROL) -> bool:
+    """Encola un mensaje para una sola conexión."""
+    user = users.get(token)
+    if not user or not user.outbox:
+        return False
+    return user.outbox.put(encode_frame(payload), priority)
+
+def detach_socket(token: str, websocket: Optional[WebSocket] = None) -> bool:
+    """Marca al usuario como sin socket y cierra su cola de salida. Si se pasa
+    `websocket`, solo lo hace si sigue siendo el socket actual de ese token (si el
+    teléfono ya se reconectó con otro socket, la desconexión vieja no lo pisa)."""
+    user = users.get(token)
+    if not user or (websocket is not None and user.websocket is not websocket):
+        return False
+    if user.outbox:
+        user.outbox.close(close_socket=False)
+    user.outbox = None
+    user.websocket = None
+    user.active = False
+    user.idle_since = time.monotonic()
+    routing.update(token)
+    return True
+
+# --- Fan-out ---
+# Antes cada broadcast hacía send_json destinatario por destinatario: el mismo payload
+# (audio incluido) se volvía a serializar para cada uno, y un teléfono lento demoraba a
+# todos los que venían después en la lista. Ahora el payload se codifica una sola vez y
+# el mismo frame se deja en la cola de salida de cada destinatario; cada cola se vacía
+# por su cuenta, con un tiempo máximo por envío (FANOUT_SEND_TIMEOUT).
+# La latencia de cada difusión se mide desde que se encola hasta que el writer del último
+# destinatario terminó de mandarla (o la dio por perdida): encolar es instantáneo y no
+# dice nada de cuándo les llegó a todos. "failed" cuenta tanto los que no se pudieron
+# encolar como los envíos que fallaron o vencieron después.
+fanout_stats: Dict[str, Dict[str, float]] = {}
+
+class Broadcast:
+    """Una difusión de fanout en curso: cuántos envíos faltan, cuántos fallaron."""
+    __slots__ = ("stats", "started", "pending", "failed")
+
+    def __init__(self, stats: Dict, pending: int):
+        self.stats = stats
+        self.started = time.monotonic()
+        self.pending = pending
+        self.failed = 0
+
+    def settle(self, sent: bool):
+        if not sent:
+            self.failed += 1
+            self.stats["failed"] += 1
+        self.pending -= 1
+        if self.pending:
+            return
+        latency_ms = (time.monotonic() - self.started) * 1000
+        self.stats["completed"] += 1
+        self.stats["last_latency_ms"] = round(latency_ms, 3)
+        self.stats["max_latency_ms"] = round(max(self.stats["max_latency_ms"], latency_ms), 3)
+        self.stats["total_latency_ms"] += latency_ms
+
+def _settle(broadcast: Optional[Broadcast], sent: bool):
+    if broadcast is not None:
+        broadcast.settle(sent)
+
+def encode_frame(payload: Dict) -> str:
+    # Mismo formato que WebSocket.send_json de Starlette
+    return json.dumps(payload, separators=(",", ":"), ensure_ascii=False)
+
+# Frames binarios para audio, en los dos sentidos: 4 bytes con el largo del encabezado
+# (big-endian), el encabezado en JSON (type, id, group_id/target_user_id, duration, ...)
+# y después el audio crudo. Antes el clip viajaba en base64 adentro de un JSON de texto:
+# un tercio más de bytes, más codificar/decodificar base64 y parsear un string de varios
+# megas en el bucle de recepción. Los clientes que los entienden se conectan con
+# ?binary=1; el camino JSON sigue funcionando igual para los viejos (y para la cola
+# offline del service worker).
+BINARY_HEADER_LENGTH = struct.Struct(">I")
+MAX_BINARY_HEADER_BYTES = 16 * 1024
+
+def encode_binary_frame(header: Dict, body: bytes) -> bytes:
+    header_bytes = encode_frame(header).encode("utf-8")
+    return BINARY_HEADER_LENGTH.pack(len(header_bytes)) + header_bytes + body
+
+def decode_binary_frame(frame: bytes) -> Tuple[Dict, bytes]:
+    if len(frame) < BINARY_HEADER_LENGTH.size:
+        raise ValueError("frame binario demasiado corto")
+    (header_length,) = BINARY_HEADER_LENGTH.unpack_from(frame)
+    if header_length > MAX_BINARY_HEADER_BYTES or BINARY_HEADER_LENGTH.size + header_length > len(frame):
+        raise ValueError(f"largo de encabezado inválido: {header_length}")
+    start = BINARY_HEADER_LENGTH.size
+    try:
+        header = json.loads(frame[start:start + header_length])
+    except (json.JSONDecodeError, UnicodeDecodeError) as e:
+        raise ValueError(f"encabezado ilegible: {e}")
+    if not isinstance(header, dict):
+        raise ValueError("el encabezado no es un objeto JSON")
+    return header, frame[start + header_length:]
+
+async def fanout(tokens: List[str], payload: Dict, kind: str = "message",
+                 priority: int = PRIORITY_BULK, frame=None) -> List[str]:
+    """Encola `payload` para todos los `tokens` con socket abierto. Devuelve los que no
+    lo pudieron recibir (conexión cerrada o desconectada por lenta). Si se pasa `frame`
+    (ya codificado, p. ej. binario) se encola ese en lugar de codificar `payload`."""
+    targets = [tk for tk in tokens if tk in users and users[tk].outbox]
+    if not targets:
+        return []
+    if frame is None:
+        frame = encode_frame(payload)
+    stats = fanout_stats.setdefault(kind, {"broadcasts": 0, "completed": 0, "recipients": 0, "failed": 0,
+                                           "last_latency_ms": 0.0, "max_latency_ms": 0.0,
+                                           "total_latency_ms": 0.0})
+    stats["broadcasts"] += 1
+    stats["recipients"] += len(targets)
+    broadcast = Broadcast(stats, len(targets))
+    failed = [tk for tk in targets if not users[tk].outbox.put(frame, priority, broadcast)]
+    for tk in failed:
+        logger.error(f"No se pudo encolar '{kind}' para {users[tk].name}")
+    return failed
+
+def fanout_metrics() -> Dict:
+    return {
+        kind: {**{k: v for k, v in stats.items() if k != "total_latency_ms"},
+               "avg_latency_ms": round(stats["total_latency_ms"] / stats["completed"], 2) if stats["completed"] else 0.0}
+        for kind, stats in fanout_stats.items()
+    }
+
+async def send_to_tokens(tokens: List[str], payload: Dict, kind: str = "audio", frame=None):
+    disconnected_users = await fanout(tokens, payload, kind, frame=frame)
+
+    for user_token in disconnected_users:
+        detach_socket(user_token)
+        presence.touch(user_token)
+
+async def handle_audio_message(token: str, audio_data, message: Dict,
+                               previous: Optional[asyncio.Future], delivered: asyncio.Future):
+    sender = message.get("sender", "Unknown")
+    function = message.get("function", "Unknown")
+    text = message.get("text", "Sin transcripción")
+    timestamp = message.get("timestamp", datetime.utcnow().strftime("%H:%M"))
+
+    if app_state["global_mute_active"]:
+        release_ingest(message)
+        return
+
+    if isinstance(audio_data, bytes):
+        audio_bytes = audio_data  # llegó en un frame binario (o ya decodificado al recibirlo)
+    else:
+        try:
+            audio_bytes = base64.b64decode(audio_data)
+        except Exception:
+            logger.error(f"Audio base64 inválido de {sender}")
+            return
+    mime = message.get("mime") or "audio/webm"
+
+    ingested = await ingest_audio(audio_bytes, mime)
+    wav = None
+    if ingested:
+        audio_bytes, mime, wav = ingested["audio"], ingested["mime"], ingested["wav"]
+        message["duration"] = max(1, round(ingested["duration"]))  # la real, no la del cliente
+
+    needs_transcript = text == "Sin transcripción" or text == PENDING_TRANSCRIPT
+    # Entrega en dos fases: el audio sale ya mismo con el texto "pendiente" y la
+    # transcripción llega después como 'transcript_update'. Sin esto nadie escuchaba
+    # el clip hasta que terminaba transcribe_audio, segundos más tarde.
+    two_phase = needs_transcript and TWO_PHASE_DELIVERY
+    if needs_transcript:
+        text = PENDING_TRANSCRIPT if two_phase else await transcribe_audio(audio_bytes, wav)
+
+    # Esperar a que se haya entregado el mensaje anterior de esta misma conversación
+    if previous is not None:
+        await previous
+
+    user_id = f"{sender}_{function}"
+    duration = message.get("duration")
+    stored = await save_message_async(user_id, audio_bytes, text, timestamp, duration, mime, ingested,
+                                      message.get("client_key"), message.get("group_id"))
+    entry = message.pop("ingest", None)
+    if entry is not None:
+        entry["id"] = stored["id"]
+    if stored.get("duplicate"):
+        # Reintento que llegó cuando la caché en memoria ya no lo tenía (vencido o reinicio)
+        dedup_stats["stored_duplicates"] += 1
+        send_to(token, {"type": "message_ack", "client_key": message.get("client_key"), "id": stored["id"],
+                        "duplicate": True})
+        return
+    await deliver_audio_message(token, message, stored, audio_bytes, text, timestamp, two_phase, delivered,
+                                wav=wav)
+
+async def deliver_audio_message(token: str, message: Dict, stored: Dict, audio_bytes: bytes, text: str,
+                                timestamp: str, two_phase: bool, delivered: Optional[asyncio.Future] = None,
+                                extra: Optional[Dict] = None, heard_live: Optional[List[str]] = None,
+                                wav: Optional[bytes] = None):
+    """Entrega un mensaje de audio ya guardado y, en dos fases, lanza la transcripción.
+    `heard_live`: los que ya lo escucharon en una transmisión en vivo; a esos no hace
+    falta mandarles el audio de nuevo en un frame binario."""
+    sender = message.get("sender", "Unknown")
+    function = message.get("function", "Unknown")
+    duration = message.get("duration")
+    mime = stored["audio_mime"]
+    msg_db_id = stored["id"]
+
+    group_id = message.get("group_id")
+    target_user_id = message.get("target_user_id")
+    
+    is_group = message.get("type") == "group_message" or group_id is not None
+    is_direct = message.get("type") == "direct_message" or target_user_id is not None
+    
+    # Include sender_id so clients can properly detect if message is theirs
+    sender_id = f"{sender}_{function}"
+    sender_token = message.get("sender_token", token)
+    broadcast_payload = {
+        "type": "group_message" if is_group else ("direct_message" if is_direct else "message"),
+        "id": msg_db_id,
+        "sender": sender,
+        "sender_id": sender_id,
+        "sender_token": sender_token,
+        "function": function,
+        "text": text,
+        "timestamp": timestamp,
+        "duration": duration,
+        "audio_url": audio_url(stored["audio_hash"]),
+        "audio_size": stored["audio_size"],
+        "audio_mime": mime
+    }
+    if two_phase:
+        broadcast_payload["transcript_pending"] = True
+    if stored.get("waveform"):
+        broadcast_payload["waveform"] = stored["waveform"]
+    if message.get("client_key"):
+        broadcast_payload["client_key"] = message["client_key"]
+    if is_group:
+        broadcast_payload["group_id"] = group_id
+    if is_direct:
+        broadcast_payload["target_user_id"] = target_user_id
+    if extra:
+        broadcast_payload.update(extra)
+
+    recipients = audio_recipients(token, message)
+    if is_direct:
+        for target_token in routing.user_tokens.get(target_user_id, ()):
+            presence.add_contact(token, target_token)
+    # Los clientes binarios reciben el audio en el mismo frame (sin ir a buscarlo a
+    # /audio/{hash}); el resto, el JSON de siempre con audio_url.
+    binary_recipients = {tk for tk in recipients if users[tk].outbox and users[tk].outbox.binary
+                         and tk not in (heard_live or ())}
+    if binary_recipients:
+        await send_to_tokens(list(binary_recipients), broadcast_payload,
+                             frame=encode_binary_frame(broadcast_payload, audio_bytes))
+    await send_to_tokens([tk for tk in recipients if tk not in binary_recipients], broadcast_payload)
+    audience = message_audience({**message, "sender_token": sender_token})
+    await backplane.publish({"kind": "deliver", "message": audience, "payload": broadcast_payload})
+    # Ya entregado: el siguiente mensaje de la conversación no tiene que esperar a que
+    # termine la transcripción de este.
+    if delivered is not None and not delivered.done():
+        delivered.set_result(None)
+
+    if two_phase:
+        # La transcripción sigue en segundo plano (acotada por transcription_slots) y el
+        # worker queda libre para entregar el próximo clip de la cola.
+        update_payload = {"type": "transcript_update", "id": msg_db_id}
+        if is_group:
+            update_payload["group_id"] = group_id
+        task = asyncio.create_task(finish_transcript(msg_db_id, audio_bytes, recipients, update_payload, wav,
+                                                     audience))
+        _transcript_tasks.add(task)
+        task.add_done_callback(_transcript_tasks.discard)
+
+async def finish_transcript(msg_db_id: int, audio_bytes: bytes, recipients: List[str], update_payload: Dict,
+                            wav: Optional[bytes] = None, audience: Optional[Dict] = None):
+    try:
+        async with transcription_slots:
+            text = await transcribe_audio(audio_bytes, wav)
+        await run_db(update_message_text, msg_db_id, text)
+        # Solo a quienes recibieron el audio y siguen conectados
+        await send_to_tokens([tk for tk in recipients if tk in users], {**update_payload, "text": text},
+                             kind="transcript_update")
+        if audience is not None:
+            await backplane.publish({"kind": "transcript", "message": audience,
+                                     "payload": {**update_payload, "text": text}})
+    except Exception as e:
+        logger.error(f"Error completando la transcripción del mensaje {msg_db_id}: {e}")
+
+# --- Push-to-talk en vivo ---
+# Hasta ahora un clip recién se procesaba cuando el que hablaba soltaba el botón y
+# terminaba de subirlo entero: el que escucha oía "duración del clip + subida +
+# transcripción" después. En modo transmisión el cliente (binario) manda pedazos de
+# STREAM_CHUNK_MS mientras mantiene apretado:
+#   stream_start {stream_id, message_type, group_id/target_user_id, mime, client_key}
+#   stream_chunk {stream_id, seq} + audio
+#   stream_end   {stream_id, duration}
+# Cada pedazo se reenvía en el acto a los oyentes binarios del grupo/destinatario (con la
+# prioridad del audio en su cola de salida, detrás del control y la presencia) y se
+# guarda en audio_stream_chunks. Al soltar, los pedazos se juntan en un mensaje normal
+# (mismo almacén por hash, mismo orden por conversación que la ingesta), que sale a todos
+# como siempre con "stream" para que los que ya lo escucharon en vivo no lo vuelvan a
+# reproducir; la transcripción sigue el camino de dos fases. Los clientes que no son
+# binarios solo reciben ese mensaje final.
+# Si la transmisión no se completa (pedazo inválido, o el socket se cae antes del
+# stream_end) se descarta entera: el cliente manda el clip completo por el camino normal
+# con la misma client_key, así no queda un mensaje cortado además del completo.
+STREAM_MAX_BYTES = int(os.getenv("STREAM_MAX_BYTES", str(10 * 1024 * 1024)))
+STREAM_MAX_SEQ = 2 ** 31 - 1  # seq es INTEGER en audio_stream_chunks
+
+stream_stats = {"started": 0, "finished": 0, "empty": 0, "aborted": 0, "rejected_chunks": 0, "chunks": 0,
+                "bytes": 0, "relayed_frames": 0}
+
+def _stream_key(token: str, stream_id) -> str:
+    # Identifica la transmisión ante los oyentes sin exponer el token del que habla
+    return f"{hashlib.sha1(token.encode()).hexdigest()[:12]}:{str(stream_id or '')[:64]}"
+
+class LiveStream:
+    def __init__(self, token: str, stream_id: str, message: Dict, listeners: List[str]):
+        self.token = token
+        self.stream_id = stream_id
+        self.key = _stream_key(token, stream_id)
+        self.message = message
+        self.listeners = listeners
+        self.bytes = 0
+        self.writes: Set[asyncio.Task] = set()
+
+live_streams: Dict[str, LiveStream] = {}  # LiveStream.key -> transmisión abierta
+_stream_tasks: Set[asyncio.Task] = set()  # cierres de transmisión (stream_end) en curso
+
+async def start_live_stream(token: str, header: Dict):
+    stream_id = str(header.get("stream_id") or "")[:64]
+    if not stream_id or app_state["global_mute_active"]:
+        return
+    # Una sola transmisión por usuario: si quedó otra abierta, se cierra primero
+    for other in [st for st in live_streams.values() if st.token == token]:
+        await end_live_stream(token, other.stream_id)
+    user = users[token]
+    message = {
+        "type": header.get("message_type") or "message",
+        "group_id": header.get("group_id"),
+        "target_user_id": header.get("target_user_id"),
+        "sender": user.name,
+        "function": user.function,
+        "sender_token": token,
+        "mime": header.get("mime") or "audio/webm",
+        "text": header.get("text"),
+        "timestamp": header.get("timestamp"),
+        "client_key": str(header["client_key"])[:128] if header.get("client_key") else None,
+    }
+    message = {k: v for k, v in message.items() if v is not None}
+    listeners = [tk for tk in audio_recipients(token, message)
+                 if tk != token and users[tk].outbox and users[tk].outbox.binary]
+    stream = LiveStream(token, stream_id, message, listeners)
+    live_streams[stream.key] = stream
+    stream_stats["started"] += 1
+    announce = {"type": "stream_start", "stream": stream.key, "sender": message["sender"],
+                "sender_id": f"{message['sender']}_{message['function']}", "function": message["function"],
+                "message_type": message["type"], "mime": message["mime"]}
+    if message.get("group_id"):
+        announce["group_id"] = message["group_id"]
+    await fanout(listeners, announce, kind="stream_start", priority=PRIORITY_CONTROL)
+
+async def relay_stream_chunk(token: str, header: Dict, chunk: bytes):
+    stream = live_streams.get(_stream_key(token, header.get("stream_id")))
+    if stream is None or not chunk:
+        return
+    try:
+        seq = int(header.get("seq"))
+    except (TypeError, ValueError):
+        seq = -1
+    if not 0 <= seq <= STREAM_MAX_SEQ:
+        stream_stats["rejected_chunks"] += 1
+        send_to(token, {"type": "stream_error", "stream_id": stream.stream_id,
+                        "message": "Pedazo de audio inválido: se envía el mensaje completo."})
+        await abort_live_stream(stream)
+        return
+    stream.bytes += len(chunk)
+    stream_stats["chunks"] += 1
+    stream_stats["bytes"] += len(chunk)
+    frame = encode_binary_frame({"type": "stream_chunk", "stream": stream.key, "seq": seq}, chunk)
+    await fanout(stream.listeners, {}, kind="stream_chunk", priority=PRIORITY_BULK, frame=frame)
+    stream_stats["relayed_frames"] += len(stream.listeners)
+    # Se guarda en segundo plano: el orden lo da seq, no el orden de escritura
+    write = asyncio.create_task(run_db(append_stream_chunk, stream.key, seq, chunk))
+    stream.writes.add(write)
+    write.add_done_callback(stream.writes.discard)
+    if stream.bytes > STREAM_MAX_BYTES:
+        logger.warning(f"Transmisión {stream.key} superó {STREAM_MAX_BYTES} bytes: se cierra")
+        close_live_stream_later(token, stream.stream_id)
+
+async def end_live_stream(token: str, stream_id, duration: Optional[int] = None):
+    stream = live_streams.pop(_stream_key(token, stream_id), None)
+    if stream is None:
+        return
+    await _finish_live_stream(stream, duration, *claim_conversation_turn(conversation_key(token, stream.message)))
+
+async def _finish_live_stream(stream: LiveStream, duration: Optional[int], previous: Optional[asyncio.Future],
+                              done: asyncio.Future):
+    token = stream.token
+    try:
+        if stream.writes:
+            await asyncio.gather(*stream.writes, return_exceptions=True)
+        message = dict(stream.message, duration=duration)
+        timestamp = message.get("timestamp") or datetime.utcnow().strftime("%H:%M")
+        # Misma regla que handle_audio_message: solo se transcribe si el cliente no mandó texto
+        text = message.get("text") or "Sin transcripción"
+        needs_transcript = text == "Sin transcripción" or text == PENDING_TRANSCRIPT
+        two_phase = needs_transcript and TWO_PHASE_DELIVERY
+        user_id = f"{message['sender']}_{message['function']}"
+        audio_bytes = await run_db(load_stream_audio, stream.key)
+        if not audio_bytes:
+            stream_stats["empty"] += 1
+            return
+        mime = message["mime"]
+        ingested = await ingest_audio(audio_bytes, mime)
+        wav = None
+        if ingested:
+            audio_bytes, mime, wav = ingested["audio"], ingested["mime"], ingested["wav"]
+            message["duration"] = duration = max(1, round(ingested["duration"]))
+        if needs_transcript:
+            text = PENDING_TRANSCRIPT if two_phase else await transcribe_audio(audio_bytes, wav)
+        if previous is not None:
+            await previous
+        stored = await run_db(finish_stream_message, stream.key, user_id, audio_bytes, text,
+                              timestamp, duration, mime, ingested, message.get("group_id"),
+                              message.get("client_key"))
+        if stored.get("duplicate"):
+            # El cliente ya lo había mandado completo por el camino normal
+            dedup_stats["stored_duplicates"] += 1
+            send_to(token, {"type": "message_ack", "client_key": message.get("client_key"), "id": stored["id"],
+                            "duplicate": True})
+            return
+        stream_stats["finished"] += 1
+        await deliver_audio_message(token, message, stored, audio_bytes, text, timestamp, two_phase, done,
+                                    extra={"stream": stream.key}, heard_live=stream.listeners, wav=wav)
+    except Exception as e:
+        logger.error(f"Error cerrando la transmisión {stream.key}: {e}")
+    finally:
+        release_conversation_turn(conversation_key(token, stream.message), done)
+
+def close_live_stream_later(token: str, stream_id, duration: Optional[int] = None):
+    """end_live_stream en segundo plano: juntar y guardar el clip no frena el bucle de
+    recepción. La transmisión sale ya de live_streams (los pedazos que sigan llegando se
+    ignoran) y toma ya su turno en la conversación, así un mensaje posterior no se adelanta."""
+    stream = live_streams.pop(_stream_key(token, stream_id), None)
+    if stream is None:
+        return
+    previous, done = claim_conversation_turn(conversation_key(token, stream.message))
+    task = asyncio.create_task(_finish_live_stream(stream, duration, previous, done))
+    _stream_tasks.add(task)
+    task.add_done_callback(_stream_tasks.discard)
+
+async def abort_live_stream(stream: LiveStream):
+    """Descarta una transmisión incompleta sin armar el mensaje."""
+    if live_streams.get(stream.key) is stream:
+        del live_streams[stream.key]
+    stream_stats["aborted"] += 1
+    try:
+        if stream.writes:
+            await asyncio.gather(*stream.writes, return_exceptions=True)
+        await run_db(delete_stream_chunks, stream.key)
+    except Exception as e:
+        logger.error(f"Error descartando la transmisión {stream.key}: {e}")
+
+async def end_live_streams_of(token: str):
+    """Cierra con lo que haya llegado las transmisiones abiertas del usuario (logout)."""
+    for stream in [st for st in live_streams.values() if st.token == token]:
+        close_live_stream_later(token, stream.stream_id)
+
+async def abort_live_streams_of(token: str):
+    """El que transmitía se desconectó antes del stream_end: su cliente reenvía el clip
+    completo al reconectar."""
+    for stream in [st for st in live_streams.values() if st.token == token]:
+        await abort_live_stream(stream)
+
+# Procesar cola de audio de WebSockets (se lanzan TRANSCRIBE_WORKERS de estas)
+async def process_audio_queue():
+    while True:
+        try:
+            item = await audio_queue.get()
+        except asyncio.CancelledError:
+            break
+        token, audio_data, message = item
+
+        # Se encadena apenas se saca de la cola (sin await de por medio), así el orden
+        # de la cadena es el mismo orden de llegada aunque haya varios workers.
+        key = conversation_key(token, message)
+        previous, done = claim_conversation_turn(key)
+
+        audio_pipeline_stats["busy"] += 1
+        started = time.monotonic()
+        try:
+            await handle_audio_message(token, audio_data, message, previous, done)
+        except asyncio.CancelledError:
+            break
+        except Exception as e:
+            logger.error(f"Error procesando la cola de audio: {e}")
+            release_ingest(message)
+        finally:
+            release_conversation_turn(key, done)
+            audio_pipeline_stats["busy"] -= 1
+            audio_pipeline_stats["busy_seconds"] += time.monotonic() - started
+            audio_pipeline_stats["processed"] += 1
+            audio_queue.task_done()
+
+def audio_pipeline_metrics() -> Dict:
+    workers = audio_pipeline_stats["workers"]
+    elapsed = max(time.monotonic() - audio_pipeline_stats["started_at"], 1e-9)
+    return {
+        "queue_depth": audio_queue.qsize(),
+        "workers": workers,
+        "busy_workers": audio_pipeline_stats["busy"],
+        "processed": audio_pipeline_stats["processed"],
+        "pending_transcripts": len(_transcript_tasks),
+        "utilization": round(audio_pipeline_stats["busy_seconds"] / (elapsed * workers), 4),
+        "decode_processes": DECODE_PROCESSES if decode_executor else 0,
+    }
+
+# Retención de mensajes (ver retention_cutoff): cada corrida descarta los días vencidos y
+# después vacía por lotes lo que quede, con una pausa entre lotes para que las
+# transacciones de la retención no acaparen la base (en SQLite, la única conexión).
+retention_stats = {"runs": 0, "deleted": 0, "archived": 0, "partitions_dropped": 0, "blobs_deleted": 0,
+                   "pages_vacuumed": 0, "last_cutoff": None, "last_run_ms": 0.0}
+
+async def _drain(batch_func, *args) -> int:
+    total = 0
+    while True:
+        removed = await run_db(batch_func, *args, RETENTION_BATCH_SIZE)
+        total += removed
+        if removed < RETENTION_BATCH_SIZE:
+            return total
+        await asyncio.sleep(RETENTION_BATCH_PAUSE_SECONDS)
+
+async def run_retention():
+    started = time.monotonic()
+    cutoff = retention_cutoff()
+    deleted = 0
+    if USE_POSTGRES:
+        await run_db(ensure_day_partitions)
+        for name in await run_db(expired_day_partitions, cutoff):
+            count = await run_db(drop_day_partition, name, RETENTION_BATCH_SIZE)
+            if count is None:
+                break
+            deleted += count
+            retention_stats["partitions_dropped"] += 1
+            await asyncio.sleep(RETENTION_BATCH_PAUSE_SECONDS)
+    deleted += await _drain(expire_messages_batch, cutoff)
+    if USE_POSTGRES:
+        await _drain(expire_client_keys_batch, cutoff)
+    blobs = await _drain(delete_orphan_blobs_batch)
+    if not USE_POSTGRES:
+        retention_stats["pages_vacuumed"] += await run_db(incremental_vacuum, RETENTION_VACUUM_PAGES)
+    stale_before = (datetime.utcnow() - timedelta(hours=MESSAGE_RETENTION_HOURS)).strftime("%Y-%m-%d %H:%M:%S")
+    await run_db(delete_stale_stream_chunks, stale_before)
+
+    retention_stats["runs"] += 1
+    retention_stats["deleted"] += deleted
+    if RETENTION_ARCHIVE_DIR:
+        retention_stats["archived"] += deleted
+    retention_stats["blobs_deleted"] += blobs
+    retention_stats["last_cutoff"] = cutoff
+    retention_stats["last_run_ms"] = round((time.monotonic() - started) * 1000, 1)
+    if deleted or blobs:
+        logger.info(f"Retención: {deleted} mensajes anteriores al {cutoff} y {blobs} clips huérfanos eliminados.")
+
+async def retention_loop():
+    while True:
+        try:
+            await run_retention()
+        except Exception as e:
+            logger.error(f"Error al limpiar mensajes: {e}")
+        await asyncio.sleep(RETENTION_INTERVAL_SECONDS)
+
+# Barrido de vivacidad: pasa a inactivos a los que dejaron de mandar ping. Antes este
+# loop mandaba la lista completa de usuarios a todos cada 6 segundos, cambiara algo o
+# no; ahora solo genera un delta cuando alguien efectivamente pasa a inactivo.
+async def presence_liveness_loop():
+    while True:
+        try:
+            await asyncio.sleep(max(1.0, LIVENESS_TIMEOUT_SECONDS / 5))
+            presence.expire()
+        except Exception as e:
+            logger.error(f"Error revisando vivacidad de usuarios: {e}")
+
+# Residencia de sesiones en memoria. Antes el arranque cargaba en `users` todas las filas
+# de sessions (y aparte todos los tokens en valid_tokens), y como las sesiones no vencen
+# (solo se cierran con 'Salir'), el tiempo de arranque y la memoria crecían con cada
+# teléfono que alguna vez inició sesión. Ahora la sesión se lee de la base cuando su token
+# se conecta, y una que quedó sin socket se descarga de memoria cuando lleva
+# SESSION_IDLE_TTL_SECONDS así, o antes -- empezando por la que hace más que está sin
+# socket -- si hay más de SESSION_MAX_RESIDENT en memoria. La fila en la base no se toca:
+# al volver a conectarse se recupera igual, con su canal y sus silenciados.
+SESSION_IDLE_TTL_SECONDS = float(os.getenv("SESSION_IDLE_TTL_SECONDS", "1800"))
+SESSION_MAX_RESIDENT = int(os.getenv("SESSION_MAX_RESIDENT", "2000"))
+SESSION_EVICTION_INTERVAL_SECONDS = float(os.getenv("SESSION_EVICTION_INTERVAL_SECONDS", "60"))
+session_stats = {"loaded": 0, "evicted": 0}
+
+async def evict_idle_sessions() -> int:
+    now = time.monotonic()
+    idle = sorted((user.idle_since, token) for token, user in users.items() if user.websocket is None)
+    excess = len(users) - SESSION_MAX_RESIDENT
+    victims = [token for n, (idle_since, token) in enumerate(idle)
+               if n < excess or idle_since <= now - SESSION_IDLE_TTL_SECONDS]
+    if not victims:
+        return 0
+    # Lo que todavía no se volcó a la base tiene que llegar antes de soltar el registro
+    if any(session_store.is_dirty(token) for token in victims):
+        await session_store.flush()
+    evicted = 0
+    for token in victims:
+        user = users.get(token)
+        if user is None or user.websocket is not None:
+            continue  # se reconectó mientras se volcaba
+        del users[token]
+        routing.update(token)
+        presence.local_pids.pop(presence.pid_of(token), None)
+        presence.touch(token)
+        evicted += 1
+    session_stats["evicted"] += evicted
+    return evicted
+
+async def session_eviction_loop():
+    while True:
+        await asyncio.sleep(SESSION_EVICTION_INTERVAL_SECONDS)
+        try:
+            evicted = await evict_idle_sessions()
+            if evicted:
+                logger.info(f"{evicted} sesiones inactivas descargadas de memoria ({len(users)} residentes)")
+        except Exception as e:
+            logger.error(f"Error al descargar sesiones inactivas: {e}")
+
+# Registra al usuario como miembro del canal (ya validado por create_group/join_group)
+# y le confirma el ingreso. group_name es siempre el nombre EXACTO guardado en la tabla
+# channels (no necesariamente lo que la persona tipeó esta vez si venía de join_group),
+# para que todos los que entren al mismo canal -- aunque lo escriban con distinta
+# capitalización -- compartan el mismo group_id puertas adentro.
+async def add_user_to_group(token: str, group_name: str):
+    users[token].group_id = group_name
+    routing.update(token)
+    session_store.mark_dirty(token)
+    send_to(token, {"type": "group_joined", "group_id": group_name})
+    presence.send_snapshot(token)
+    presence.touch(token)
+
+# Busca el token de un usuario a partir de su user_id ("nombre_funcion")
+def find_token_by_user_id(target_user_id: str) -> Optional[str]:
+    tokens = routing.user_tokens.get(target_user_id)
+    if not tokens:
+        return None
+    # Si hay más de una sesión con el mismo nombre_funcion, se prefiere la conectada
+    return next((tk for tk in tokens if tk in routing.online), next(iter(tokens)))
+
+# Saca a un usuario de cualquier sala de "Cámara Familiar" en la que esté y avisa al resto
+async def leave_monitor_room(token: str):
+    if token not in users:
+        return
+    user_id = f"{users[token].name}_{users[token].function}"
+    for group_id, participants in list(monitor_rooms.items()):
+        if token in participants:
+            del participants[token]
+            if not participants:
+                del monitor_rooms[group_id]
+            for other_token in list(participants.keys()):
+                send_to(other_token, {"type": "monitor_peer_left", "user_id": user_id})
+            await backplane.publish({"kind": "room", "event": "left", "group_id": group_id, "user_id": user_id})
+
+# Presencia (lista de usuarios). Antes broadcast_users() decodificaba el token de todos,
+# armaba la lista completa y se la mandaba entera a todos los conectados, en cada
+# conexión/desconexión/cambio, en cada refresh_users de cada cliente y cada 6 segundos:
+# O(n²) por evento.
+#
+# Ahora cada cliente ve solo su "alcance": los miembros de su canal (o, si no está en
+# ninguno, los demás que están en la pantalla principal) más sus contactos directos
+# (con quienes intercambió mensajes directos en esta sesión). Cada alcance tiene su
+# versión: al conectarse o cambiar de canal el cliente recibe la lista completa de su
+# alcance una vez ("user_list" con scope y version) y de ahí en más solo deltas
+# ("presence_delta": base -> version, con altas/cambios y bajas). Los cambios que llegan
+# juntos (reconexión masiva cuando vuelve el wifi) se agrupan en un solo delta durante
+# PRESENCE_DEBOUNCE_MS. Si a un cliente le falta un delta (se descartó por cola llena o
+# llegó fuera de orden), lo detecta porque `base` no coincide con la versión que tiene y
+# pide la lista entera con refresh_users; solo ahí se le manda de nuevo. Los contactos
+# de otro alcance llegan aparte como "presence_contact" (la entrada completa, sin
+# versión) y se vuelven a mandar enteros con cada lista completa.
+#
+# "Activo" ya no es "tiene el socket abierto" sino "mandó un ping hace menos de
+# LIVENESS_TIMEOUT_SECONDS" (el cliente hace ping cada 10 s y él mismo da la conexión por
+# muerta a los 25 s sin pong). Así un teléfono que cambia de wifi a datos y reconecta en
+# dos segundos no aparece y desaparece de la lista de todos. Un barrido revisa solo a los
+# que están vivos; si nadie cambia de estado no se manda nada: un canal quieto no
+# genera tráfico periódico.
+PRESENCE_DEBOUNCE_MS = int(os.getenv("PRESENCE_DEBOUNCE_MS", "250"))
+LIVENESS_TIMEOUT_SECONDS = float(os.getenv("LIVENESS_TIMEOUT_SECONDS", "25"))
+
+class Presence:
+    def __init__(self, debounce: float, liveness_timeout: float):
+        self.debounce = debounce
+        self.liveness_timeout = liveness_timeout
+        self.versions: Dict[str, int] = {}  # alcance ("" = pantalla principal) -> versión
+        self.entries: Dict[str, Dict] = {}  # token -> entrada ya publicada
+        self.scopes: Dict[str, Set[str]] = {}  # alcance -> tokens con entrada publicada ahí
+        self.entry_scope: Dict[str, str] = {}  # token -> alcance donde está publicada su entrada
+        self.contacts: Dict[str, Set[str]] = {}  # token -> tokens de sus contactos directos
+        self.last_ping: Dict[str, float] = {}  # solo los vivos: token -> último ping
+        # Con backplane: usuarios conectados a otros workers, que se publican acá con la
+        # clave "@<pid>" en lugar de un token (ver apply_remote).
+        self.remote: Dict[str, Tuple[str, str, Dict]] = {}  # pid -> (nodo, alcance, entrada)
+        self.local_pids: Dict[str, str] = {}  # pid -> token local
+        self.announced: Dict[str, Tuple[str, Dict]] = {}  # token conectado acá -> (alcance, entrada) anunciados
+        self._dirty: Set[str] = set()
+        self._flush_task: Optional[asyncio.Task] = None
+        self.stats = {"deltas_sent": 0, "contact_updates": 0, "snapshots_sent": 0, "resyncs": 0,
+                      "expired": 0}
+
+    @staticmethod
+    def scope_of(token: str) -> str:
+        return users[token].group_id or ""
+
+    @staticmethod
+    def viewers(scope: str) -> Set[str]:
+        return routing.groups.get(scope, set()) if scope else routing.lobby
+
+    @staticmethod
+    def pid_of(token: str) -> str:
+        # Identificador estable de la fila sin exponer el token
+        return hashlib.sha1(token.encode()).hexdigest()[:12]
+
+    def _entry(self, token: str) -> Optional[Dict]:
+        user = users.get(token)
+        if not user or not user.logged_in:
+            return None
+        decoded_token = base64.b64decode(token).decode('utf-8', errors='ignore')
+        legajo, name, _ = decoded_token.split('_', 2) if '_' in decoded_token else (token, "Anónimo", "Desconocida")
+        return {
+            "pid": self.pid_of(token),
+            "display": f"{user.name} ({legajo})",
+            "user_id": f"{user.name}_{user.function}",
+            "group_id": user.group_id,
+            "active": token in self.last_ping,
+        }
+
+    def touch(self, token: str):
+        """Marca que algo de ese usuario pudo haber cambiado; el delta sale agrupado."""
+        self._dirty.add(token)
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    def heartbeat(self, token: str):
+        if token not in self.last_ping:
+            self.touch(token)
+        self.last_ping[token] = time.monotonic()
+
+    def expire(self) -> int:
+        """Da por inactivos a los que no mandan ping hace más de liveness_timeout."""
+        deadline = time.monotonic() - self.liveness_timeout
+        expired = [token for token, seen in self.last_ping.items() if seen < deadline]
+        for token in expired:
+            del self.last_ping[token]
+            self.touch(token)
+        self.stats["expired"] += len(expired)
+        return len(expired)
+
+    def add_contact(self, token: str, other: str):
+        """Registra el contacto directo en los dos sentidos; si están en distinto alcance,
+        cada uno recibe la entrada del otro."""
+        if token == other or other in self.contacts.get(token, ()):
+            return
+        self.contacts.setdefault(token, set()).add(other)
+        self.contacts.setdefault(other, set()).add(token)
+        for viewer, seen in ((token, other), (other, token)):
+            if viewer in users and seen in self.entries and self.scope_of(viewer) != self.scope_of(seen):
+                self.stats["contact_updates"] += 1
+                send_to(viewer, {"type": "presence_contact", "users": [self.entries[seen]], "remove": []},
+                        priority=PRIORITY_PRESENCE)
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.debounce)
+        await self.flush()
+
+    def _resolve(self, key: str) -> Tuple[Optional[Dict], Optional[str]]:
+        """Entrada y alcance actuales de un token local o de una clave remota "@<pid>"."""
+        if key.startswith("@"):
+            item = self.remote.get(key[1:])
+            return (item[2], item[1]) if item else (None, None)
+        entry = self._entry(key)
+        if entry is None:
+            return None, None
+        self.local_pids[entry["pid"]] = key
+        if key not in routing.online and entry["pid"] in self.remote:
+            # Sesión residente acá (sin socket) pero conectada a otro worker: vale la entrada de allá
+            return None, None
+        return entry, self.scope_of(key)
+
+    async def flush(self):
+        dirty, self._dirty = self._dirty, set()
+        changes: Dict[str, Dict[str, List]] = {}  # alcance -> {"upsert": [...], "remove": [...]}
+        contact_changes = []  # (token, entrada nueva o None, pid)
+        for token in dirty:
+            old = self.entries.get(token)
+            old_scope = self.entry_scope.get(token)
+            new, new_scope = self._resolve(token)
+            if new == old and new_scope == old_scope:
+                continue
+            if old and old_scope != new_scope:
+                changes.setdefault(old_scope, {"upsert": [], "remove": []})["remove"].append(old["pid"])
+                self.scopes[old_scope].discard(token)
+                if not self.scopes[old_scope]:
+                    del self.scopes[old_scope]
+            if new:
+                self.entries[token] = new
+                self.entry_scope[token] = new_scope
+                self.scopes.setdefault(new_scope, set()).add(token)
+                changes.setdefault(new_scope, {"upsert": [], "remove": []})["upsert"].append(new)
+            else:
+                self.entries.pop(token, None)
+                self.entry_scope.pop(token, None)
+                if not token.startswith("@"):
+                    self.last_ping.pop(token, None)
+            if not token.startswith("@"):
+                contact_changes.append((token, new, (new or old)["pid"]))
+
+        announce = self._announcements(dirty)
+        if announce:
+            await backplane.publish({"kind": "presence", "changes": announce})
+
+        for scope, delta in changes.items():
+            # Mismo pid que sale y entra en el mismo alcance (la sesión local cede su lugar
+            # a la del otro worker, o al revés): el cliente aplica remove después de upsert
+            upserted = {entry["pid"] for entry in delta["upsert"]}
+            delta["remove"] = [pid for pid in delta["remove"] if pid not in upserted]
+            version = self.versions.get(scope, 0) + 1
+            self.versions[scope] = version
+            self.stats["deltas_sent"] += 1
+            await fanout(list(self.viewers(scope)), {"type": "presence_delta", "scope": scope,
+                                                     "base": version - 1, "version": version, **delta},
+                         kind="presence_delta", priority=PRIORITY_PRESENCE)
+
+        for token, entry, pid in contact_changes:
+            for viewer in list(self.contacts.get(token, ())):
+                if viewer not in users:
+                    continue
+                if entry and self.scope_of(viewer) == self.scope_of(token):
+                    continue  # ya lo recibió en el delta de su alcance
+                self.stats["contact_updates"] += 1
+                send_to(viewer, {"type": "presence_contact", "users": [entry] if entry else [],
+                                 "remove": [] if entry else [pid]}, priority=PRIORITY_PRESENCE)
+            if not entry:
+                for other in self.contacts.pop(token, set()):
+                    self.contacts.get(other, set()).discard(token)
+
+    def _announcements(self, dirty: Set[str]) -> Dict[str, Dict[str, List]]:
+        """Cambios para los otros workers: solo de los usuarios con socket en este."""
+        changes: Dict[str, Dict[str, List]] = {}
+        for token in dirty:
+            if token.startswith("@"):
+                continue
+            entry = self.entries.get(token) if token in routing.online else None
+            current = (self.entry_scope[token], entry) if entry else None
+            previous = self.announced.get(token)
+            if current == previous:
+                continue
+            if previous and (not current or previous[0] != current[0]):
+                changes.setdefault(previous[0], {"upsert": [], "remove": []})["remove"].append(previous[1]["pid"])
+            if current:
+                self.announced[token] = current
+                changes.setdefault(current[0], {"upsert": [], "remove": []})["upsert"].append(entry)
+            else:
+                del self.announced[token]
+        return changes
+
+    def announced_batches(self, size: int = 40) -> List[Dict[str, Dict[str, List]]]:
+        """Todo lo anunciado, en tandas chicas (NOTIFY admite hasta 8000 bytes): para un
+        worker que recién aparece."""
+        items = list(self.announced.values())
+        batches = []
+        for start in range(0, len(items), size):
+            changes: Dict[str, Dict[str, List]] = {}
+            for scope, entry in items[start:start + size]:
+                changes.setdefault(scope, {"upsert": [], "remove": []})["upsert"].append(entry)
+            batches.append(changes)
+        return batches
+
+    def _touch_pid(self, pid: str):
+        self.touch("@" + pid)
+        if pid in self.local_pids:
+            self.touch(self.local_pids[pid])
+
+    def apply_remote(self, node: str, changes: Dict[str, Dict[str, List]]):
+        """Cambios anunciados por otro worker. Un remove solo cuenta si ese nodo tenía al
+        usuario en ese alcance (puede haber llegado antes el upsert en el alcance nuevo)."""
+        for scope, delta in changes.items():
+            for pid in delta.get("remove", ()):
+                item = self.remote.get(pid)
+                if item and item[0] == node and item[1] == scope:
+                    del self.remote[pid]
+                    self._touch_pid(pid)
+            for entry in delta.get("upsert", ()):
+                if self.remote.get(entry["pid"]) != (node, scope, entry):
+                    self.remote[entry["pid"]] = (node, scope, entry)
+                    self._touch_pid(entry["pid"])
+
+    def drop_node(self, node: str):
+        for pid in [pid for pid, item in self.remote.items() if item[0] == node]:
+            del self.remote[pid]
+            self._touch_pid(pid)
+
+    def send_snapshot(self, token: str):
+        scope = self.scope_of(token)
+        members = self.scopes.get(scope, set())
+        contacts = [self.entries[tk] for tk in self.contacts.get(token, ())
+                    if tk in self.entries and tk not in members]
+        self.stats["snapshots_sent"] += 1
+        send_to(token, {"type": "user_list", "scope": scope, "version": self.versions.get(scope, 0),
+                        "users": [self.entries[tk] for tk in members], "contacts": contacts},
+                priority=PRIORITY_PRESENCE)
+
+    def is_current(self, token: str, scope, version) -> bool:
+        return scope == self.scope_of(token) and version == self.versions.get(scope, 0)
+
+    def metrics(self) -> Dict:
+        return {"scopes": len(self.scopes), "users": len(self.entries), "live": len(self.last_ping),
+                "remote": len(self.remote), "pending": len(self._dirty), **self.stats}
+
+presence = Presence(PRESENCE_DEBOUNCE_MS / 1000, LIVENESS_TIMEOUT_SECONDS)
+
+async def broadcast_message(message: Dict):
+    disconnected_users = [token for token in users if token not in routing.online]
+    disconnected_users += await fanout(list(routing.online), message, kind="general")
+
+    for token in disconnected_users:
+        if token in users:
+            detach_socket(token)
+            users[token].logged_in = False
+            routing.update(token)
+            presence.touch(token)
+
+# --- Backplane entre workers / nodos ---
+# Todo el estado vivo (users, routing, presence, monitor_rooms, app_state,
+# audio_queue) es del proceso: con un solo worker alcanza, pero dos workers de uvicorn (o
+# dos máquinas) no se veían entre sí. El backplane es un canal pub/sub por el que cada
+# worker avisa a los demás lo que los otros necesitan saber:
+#   presence    altas/bajas de los usuarios conectados a él (Presence.apply_remote)
+#   deliver     un mensaje de audio ya guardado; cada worker lo entrega a sus conectados
+#   transcript  la transcripción de la segunda fase de un mensaje
+#   signal      señalización WebRTC para un usuario conectado a otro worker
+#   room        entradas/salidas/cámara de las salas de la Cámara Familiar
+#   state       interruptores de app_state
+#   hello/bye   latido y apagado: si un nodo deja de latir se olvida su estado
+# Cada worker sigue procesando su propia audio_queue. El audio viaja como audio_url (la
+# base y el almacén por hash son compartidos) y los pedazos de las transmisiones en vivo
+# no se reenvían: los demás workers reciben el mensaje final.
+# BACKPLANE: "" (un solo proceso, no publica nada), "postgres" (LISTEN/NOTIFY sobre
+# DATABASE_URL) o "memory" (varios workers dentro de un mismo proceso; para pruebas).
+BACKPLANE = os.getenv("BACKPLANE", "")
+BACKPLANE_CHANNEL = os.getenv("BACKPLANE_CHANNEL", "handyhandle")
+BACKPLANE_HEARTBEAT_SECONDS = float(os.getenv("BACKPLANE_HEARTBEAT_SECONDS", "10"))
+BACKPLANE_NODE_TIMEOUT_SECONDS = float(os.getenv("BACKPLANE_NODE_TIMEOUT_SECONDS", "35"))
+NOTIFY_MAX_BYTES = 7900  # Postgres corta el payload de NOTIFY en 8000 bytes
+NODE_ID = os.getenv("NODE_ID") or f"{os.getpid()}-{os.urandom(3).hex()}"
+
+class Backplane:
+    """Sin otros workers: no publica nada."""
+    name = "local"
+
+    def __init__(self):
+        self.handler = None
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.stats = {"published": 0, "received": 0, "too_large": 0, "errors": 0}
+        self._tasks: Set[asyncio.Task] = set()
+
+    @property
+    def enabled(self) -> bool:
+        return self.name != "local"
+
+    async def start(self, handler):
+        self.handler = handler
+        self.loop = asyncio.get_running_loop()
+
+    async def stop(self):
+        pass
+
+    async def publish(self, event: Dict):
+        if not self.enabled:
+            return
+        data = json.dumps({**event, "node": NODE_ID})
+        if len(data.encode()) > NOTIFY_MAX_BYTES:
+            self.stats["too_large"] += 1
+            logger.error(f"Evento '{event.get('kind')}' demasiado grande para el backplane ({len(data)} bytes)")
+            return
+        try:
+            await self._send(data)
+            self.stats["published"] += 1
+        except Exception as e:
+            self.stats["errors"] += 1
+            logger.error(f"No se pudo publicar en el backplane: {e}")
+
+    async def _send(self, data: str):
+        pass  # publish no llega hasta acá; InMemoryBackplane y PostgresBackplane entregan
+
+    def _deliver(self, data: str):
+        """Corre en el loop del worker que recibe."""
+        event = json.loads(data)
+        if event.get("node") == NODE_ID:
+            return  # NOTIFY también le llega al que publicó
+        self.stats["received"] += 1
+        task = asyncio.create_task(self.handler(event))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def metrics(self) -> Dict:
+        return {"name": self.name, "node": NODE_ID, "nodes": len(backplane_nodes), **self.stats}
+
+class InMemoryHub:
+    """El "servidor" del backplane en memoria: los workers que comparten un hub se ven."""
+    def __init__(self):
+        self.members: List["InMemoryBackplane"] = []
+
+class InMemoryBackplane(Backplane):
+    name = "memory"
+
+    def __init__(self, hub: InMemoryHub):
+        super().__init__()
+        self.hub = hub
+
+    async def start(self, handler):
+        await super().start(handler)
+        self.hub.members.append(self)
+
+    async def stop(self):
+        if self in self.hub.members:
+            self.hub.members.remove(self)
+
+    async def _send(self, data: str):
+        # Cada worker puede tener su propio loop (y thread): se entrega con
+        # call_soon_threadsafe, serializado igual que por Postgres
+        for member in list(self.hub.members):
+            if member is not self:
+                member.loop.call_soon_threadsafe(member._deliver, data)
+
+class PostgresBackplane(Backplane):
+    name = "postgres"
+
+    def __init__(self, dsn: str, channel: str):
+        super().__init__()
+        self.dsn = dsn
+        self.channel = channel
+        self.conn = None
+        self._reconnect_task: Optional[asyncio.Task] = None
+
+    async def start(self, handler):
+        await super().start(handler)
+        await self._connect()
+
+    async def _connect(self):
+        # Conexión propia, fuera del pool: queda escuchando todo el tiempo. El loop la
+        # vigila con add_reader, sin un thread bloqueado esperando notificaciones.
+        def connect():
+            conn = psycopg2.connect(self.dsn)
+            conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            conn.cursor().execute(f"LISTEN {self.channel}")
+            return conn
+        self.conn = await run_db(connect)
+        self.loop.add_reader(self.conn.fileno(), self._on_readable)
+        logger.info(f"Backplane Postgres escuchando '{self.channel}' (nodo {NODE_ID})")
+
+    def _on_readable(self):
+        try:
+            self.conn.poll()
+        except Exception as e:
+            self.stats["errors"] += 1
+            logger.error(f"Se cortó la conexión del backplane: {e}")
+            self._drop_connection()
+            if self._reconnect_task is None or self._reconnect_task.done():
+                self._reconnect_task = asyncio.create_task(self._reconnect())
+            return
+        while self.conn.notifies:
+            self._deliver(self.conn.notifies.pop(0).payload)
+
+    def _drop_connection(self):
+        if self.conn is None:
+            return
+        with contextlib.suppress(Exception):
+            self.loop.remove_reader(self.conn.fileno())
+        with contextlib.suppress(Exception):
+            self.conn.close()
+        self.conn = None
+
+    async def _reconnect(self):
+        while self.conn is None:
+            await asyncio.sleep(5)
+            try:
+                await self._connect()
+                await self.publish({"kind": "hello"})  # que los demás nos manden su estado
+            except Exception as e:
+                logger.error(f"No se pudo reconectar el backplane: {e}")
+
+    async def stop(self):
+        self._drop_connection()
+
+    async def _send(self, data: str):
+        def notify():
+            with db_connection() as conn:
+                conn.cursor().execute("SELECT pg_notify(%s, %s)", (self.channel, data))
+        await run_db(notify)
+
+def create_backplane() -> Backplane:
+    if BACKPLANE == "postgres":
+        if USE_POSTGRES:
+            return PostgresBackplane(DATABASE_URL, BACKPLANE_CHANNEL)
+        logger.error("BACKPLANE=postgres necesita DATABASE_URL; se sigue con un solo worker")
+    elif BACKPLANE == "memory":
+        return InMemoryBackplane(InMemoryHub())
+    elif BACKPLANE:
+        logger.error(f"BACKPLANE '{BACKPLANE}' desconocido; se sigue con un solo worker")
+    return Backplane()
+
+backplane = create_backplane()
+backplane_nodes: Dict[str, float] = {}  # nodo -> último evento recibido
+# Participantes de salas de Cámara Familiar conectados a otros workers:
+# group_id -> {user_id: (nodo, camera_on)}
+monitor_remote: Dict[str, Dict[str, Tuple[str, bool]]] = {}
+
+def message_audience(message: Dict) -> Dict:
+    """Lo que necesita audio_recipients en otro worker para elegir a sus destinatarios."""
+    return {key: message.get(key) for key in ("type", "group_id", "target_user_id", "sender", "function",
+                                              "sender_token")}
+
+def notify_monitor_room(group_id: str, payload: Dict, exclude: Optional[str] = None):
+    for other_token in list(monitor_rooms.get(group_id, {})):
+        if other_token != exclude:
+            send_to(other_token, payload)
+
+def forget_node(node: str):
+    backplane_nodes.pop(node, None)
+    presence.drop_node(node)
+    for group_id, participants in list(monitor_remote.items()):
+        for user_id in [uid for uid, (owner, _) in participants.items() if owner == node]:
+            del participants[user_id]
+            notify_monitor_room(group_id, {"type": "monitor_peer_left", "user_id": user_id})
+        if not participants:
+            del monitor_remote[group_id]
+
+async def announce_state():
+    """Todo lo propio que otro worker necesita para ponerse al día."""
+    for changes in presence.announced_batches():
+        await backplane.publish({"kind": "presence", "changes": changes})
+    for group_id, participants in list(monitor_rooms.items()):
+        for tk, camera_on in list(participants.items()):
+            if tk in users:
+                await backplane.publish({"kind": "room", "event": "joined", "group_id": group_id,
+                                         "user_id": f"{users[tk].name}_{users[tk].function}",
+                                         "camera_on": camera_on})
+
+async def handle_backplane_event(event: Dict):
+    node = event["node"]
+    kind = event.get("kind")
+    try:
+        is_new = node not in backplane_nodes
+        backplane_nodes[node] = time.monotonic()
+        if kind == "bye":
+            forget_node(node)
+            return
+        if is_new:
+            logger.info(f"Backplane: nuevo nodo {node}")
+            await announce_state()
+        if kind == "presence":
+            presence.apply_remote(node, event["changes"])
+        elif kind in ("deliver", "transcript"):
+            recipients = audio_recipients(event["message"].get("sender_token"), event["message"])
+            await send_to_tokens(recipients, event["payload"], kind="audio" if kind == "deliver" else "transcript_update")
+        elif kind == "signal":
+            target_token = find_token_by_user_id(event["target_user_id"])
+            if target_token in routing.online:
+                send_to(target_token, event["message"])
+        elif kind == "room":
+            group_id, user_id = event["group_id"], event["user_id"]
+            participants = monitor_remote.setdefault(group_id, {})
+            if event["event"] == "left":
+                participants.pop(user_id, None)
+                notify_monitor_room(group_id, {"type": "monitor_peer_left", "user_id": user_id})
+            else:
+                known = user_id in participants
+                participants[user_id] = (node, event["camera_on"])
+                notify_monitor_room(group_id, {
+                    "type": "monitor_camera_state" if known else "monitor_peer_joined",
+                    "user_id": user_id,
+                    "camera_on": event["camera_on"],
+                })
+            if not participants:
+                monitor_remote.pop(group_id, None)
+        elif kind == "state":
+            app_state.update(event["state"])
+    except Exception as e:
+        backplane.stats["errors"] += 1
+        logger.error(f"Error procesando evento '{kind}' del backplane: {e}")
+
+async def backplane_loop():
+    while True:
+        try:
+            await backplane.publish({"kind": "hello"})
+            await asyncio.sleep(BACKPLANE_HEARTBEAT_SECONDS)
+            deadline = time.monotonic() - BACKPLANE_NODE_TIMEOUT_SECONDS
+            for node in [n for n, seen in backplane_nodes.items() if seen < deadline]:
+                logger.warning(f"Backplane: el nodo {node} dejó de latir, se olvida su estado")
+                forget_node(node)
+        except asyncio.CancelledError:
+            break
+        except Exception as e:
+            logger.error(f"Error en el latido del backplane: {e}")
+
+# Endpoint de WebSockets principal
+@app.websocket("/ws/{token}")
+async def websocket_endpoint(websocket: WebSocket, token: str, last_seen_id: Optional[int] = None,
+                             binary: bool = False):
+    await websocket.accept()
+    logger.info(f"Cliente intentando conectar con WebSocket: {token[:15]}...")
+
+    try:
+        try:
+            decoded_token = base64.b64decode(token).decode('utf-8')
+            parts = decoded_token.split('_')
+            if len(parts) == 3:
+                employee_id, surname, sector = parts
+            else:
+                employee_id = "99999"
+                surname = decoded_token if decoded_token else "Invitado"
+                sector = "Operador"
+                decoded_token = f"{employee_id}_{surname}_{sector}"
+        except Exception as e:
+            logger.error(f"Error decodificando token WebSocket fallback: {str(e)}")
+            employee_id = "99999"
+            surname = "Invitado"
+            sector = "Operador"
+            decoded_token = f"{employee_id}_{surname}_{sector}"
+
+        # Si la sesión tiene cambios todavía sin volcar (p. ej. entró a un canal y el
+        # teléfono se reconectó antes del próximo volcado), se vuelca antes de leerla:
+        # si no, la reconexión levantaba de la base el group_id viejo.
+        if session_store.is_dirty(token):
+            await session_store.flush()
+        session = await load_session_async(token)
+        user_id = decoded_token
+
+        # Si el mismo token tenía otro socket abierto (reconexión antes de que el viejo
+        # se diera cuenta de que murió), se cierra el viejo: no puede haber dos colas.
+        previous = users.get(token)
+        if previous and previous.outbox:
+            previous.outbox.close(code=1000)
+        outbox = Outbox(token, websocket, binary=binary)
+        
+        if session:
+            users[token] = UserRecord(session["user_id"], session["name"], session["function"],
+                                      session["group_id"], session["muted_users"], websocket, outbox)
+            session_stats["loaded"] += 1
+            logger.info(f"Sesión restaurada para: {session['name']}")
+        else:
+            users[token] = UserRecord(user_id, surname, sector, websocket=websocket, outbox=outbox)
+            await save_session_async(token, user_id, surname, sector)
+            logger.info(f"Sesión nueva para: {surname}")
+        routing.update(token)
+
+        # Confirmación de conexión exitosa
+        send_to(token, {"type": "connection_success", "message": "Conectado"})
+
+        # Si ya era miembro de un canal (persistido en la sesión), se lo reintegra
+        # directamente al reconectar -- no hace falta pedirle de nuevo el nombre ni la
+        # contraseña del canal cada vez, la contraseña ya se validó la primera vez que
+        # entró y el token/sesión identifica que es la misma persona.
+        if users[token].group_id:
+            send_to(token, {"type": "group_joined", "group_id": users[token].group_id})
+
+        # Enviar historial al usuario en segundo plano: si esto se hiciera con await acá
+        # mismo, el mensaje de Cámara Familiar (monitor_join) que el cliente ya mandó
         # apenas se conecta quedaba sin poder procesarse hasta que terminara de bajar TODO
         # el historial del día (con audio incluido) por este mismo socket -- eso era la
         # causa de la demora al conectar la Cámara Familiar entre dos dispositivos reales.
         # Corriéndolo aparte, el bucle de abajo puede empezar a leer y reenviar señalización
         # WebRTC de inmediato, en paralelo con el historial que sigue bajando.
+        # Reanudación: el cliente manda en la URL el último id de mensaje que ya tiene
+        # (?last_seen_id=N) y solo se le reenvía lo posterior. Los teléfonos de rampa se
+        # reconectan cada vez que se apaga la pantalla, y antes cada reconexión volvía a
+        # bajar el historial entero. Sin ese parámetro (página recién cargada, con la
+        # lista vacía) se manda todo como siempre. Si el cliente tiene mensajes todavía
+        # pendientes de transcripción, el cursor que manda es el anterior al más viejo de
+        # ellos (ver resumeCursor en script.js): los transcript_update que se perdieron con
+        # el socket caído vuelven así en el texto de esos mensajes.
         async def send_history():
             try:
-                history = get_history()
-                for msg in history:
-                    # Re-formatear del almacenamiento
-                    # msg['user_id'] es 'surname_sector'
-                    parts = msg['user_id'].split('_')
-                    snd = parts[0] if len(parts) > 0 else 'Unknown'
-                    fn = parts[1] if len(parts) > 1 else 'Rampa'
-                    sender_id = f"{snd}_{fn}"
-                    await websocket.send_json({
-                        "type": "message",
-                        "id": msg["id"],
-                        "sender": snd,
-                        "sender_id": sender_id,
-                        "function": fn,
-                        "text": msg["text"],
-                        "timestamp": msg["timestamp"],
-                        "audio": msg["audio"]
-                    })
-                await websocket.send_json({"type": "history_end"})
+                cursor = 0
+                resumed = last_seen_id is not None and last_seen_id > 0
+                if resumed:
+                    cursor = last_seen_id
+                resume_stats["resumes" if resumed else "full_loads"] += 1
+                sent_key = "resumed_messages" if resumed else "full_messages"
+                # Se pagina en lugar de traer todo junto, así nunca está el día entero en memoria
+                while True:
+                    rows = await run_db(get_history_page, after_id=cursor, limit=HISTORY_MAX_PAGE_SIZE)
+                    for row in rows:
+                        msg = _history_row(row)
+                        # Re-formatear del almacenamiento
+                        # msg['user_id'] es 'surname_sector'
+                        parts = msg['user_id'].split('_')
+                        snd = parts[0] if len(parts) > 0 else 'Unknown'
+                        fn = parts[1] if len(parts) > 1 else 'Rampa'
+                        sender_id = f"{snd}_{fn}"
+                        payload = {
+                            "type": "message",
+                            "id": msg["id"],
+                            "sender": snd,
+                            "sender_id": sender_id,
+                            "function": fn,
+                            "text": msg["text"],
+                            "timestamp": msg["timestamp"],
+                        }
+                        if "audio_url" in msg:
+                            payload["audio_url"] = msg["audio_url"]
+                        else:
+                            payload["audio"] = msg.get("audio")
+                        if "waveform" in msg:
+                            payload["waveform"] = msg["waveform"]
+                        if not await outbox.put_wait(encode_frame(payload), PRIORITY_BULK):
+                            return
+                        resume_stats[sent_key] += 1
+                    if len(rows) < HISTORY_MAX_PAGE_SIZE:
+                        break
+                    cursor = rows[-1][0]
+                await outbox.put_wait(encode_frame({"type": "history_end"}), PRIORITY_BULK)
             except Exception:
                 pass  # conexión ya cerrada u otro error de envío: no hay nada más que hacer
 
         asyncio.create_task(send_history())
 
-        await broadcast_users()
+        presence.heartbeat(token)
+        presence.send_snapshot(token)
+        presence.touch(token)
 
         # Escuchar mensajes entrantes del WebSocket
         while True:
-            data = await websocket.receive_text()
-            try:
-                message = json.loads(data)
-            except json.JSONDecodeError:
-                continue
+            frame = await websocket.receive()
+            if frame["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(frame.get("code", 1000))
+            audio_body = None
+            if frame.get("bytes") is not None:
+                try:
+                    message, audio_body = decode_binary_frame(frame["bytes"])
+                except ValueError as e:
+                    logger.error(f"Frame binario inválido de {token[:15]}...: {e}")
+                    continue
+            else:
+                try:
+                    message = json.loads(frame.get("text") or "")
+                except json.JSONDecodeError:
+                    continue
 
             msg_type = message.get("type")
             
             if msg_type == "ping":
-                await websocket.send_json({"type": "pong"})
-                save_session(
-                    token,
-                    users[token]["user_id"],
-                    users[token]["name"],
-                    users[token]["function"],
-                    users[token]["group_id"],
-                    users[token]["muted_users"]
-                )
+                send_to(token, {"type": "pong"})
+                presence.heartbeat(token)
+                session_store.mark_dirty(token)
                 
             elif msg_type == "status_update":
                 if token in users:
-                    users[token]["active"] = message.get("active", True)
-                    await broadcast_users()
+                    users[token].active = message.get("active", True)
+                    presence.touch(token)
 
             elif msg_type == "toggle_updates":
                 app_state["updates_enabled"] = message.get("enabled", True)
-                await websocket.send_json({"type": "updates_status", "enabled": app_state["updates_enabled"]})
+                send_to(token, {"type": "updates_status", "enabled": app_state["updates_enabled"]})
+                await backplane.publish({"kind": "state", "state": {"updates_enabled": app_state["updates_enabled"]}})
                 
             elif msg_type == "refresh_users":
-                # Client requests fresh user list (called periodically for live updates)
-                await broadcast_users()
+                # El cliente manda el alcance y la versión de presencia que tiene: si está
+                # al día no hace falta mandarle nada; si quedó atrás (o es un cliente
+                # viejo que no los manda), se le manda la lista completa solo a él.
+                if not presence.is_current(token, message.get("scope"), message.get("version")):
+                    presence.stats["resyncs"] += 1
+                    presence.send_snapshot(token)
                 
             elif msg_type in ["audio", "message", "group_message", "direct_message"]:
                 # Accept 'audio', 'message', 'group_message' and 'direct_message' types
-                audio_data = message.get("data") or message.get("audio")
+                audio_data = audio_body if audio_body is not None else (message.get("data") or message.get("audio"))
                 # Always normalize sender to the authenticated user's name/function from the server
-                message["sender"] = users[token].get("name", "Unknown")
-                message["function"] = users[token].get("function", "Unknown")
+                message["sender"] = users[token].name
+                message["function"] = users[token].function
                 message["sender_token"] = token  # Include token so broadcast can match sender
+                if isinstance(audio_data, str):
+                    try:
+                        audio_data = base64.b64decode(audio_data)
+                    except Exception:
+                        logger.error(f"Audio base64 inválido de {token[:15]}...")
+                        audio_data = None
                 if audio_data:
-                    await audio_queue.put((token, audio_data, message))
+                    duplicate = claim_ingest(token, message, audio_data)
+                    if duplicate is None:
+                        await audio_queue.put((token, audio_data, message))
+                    else:
+                        send_to(token, {"type": "message_ack", "client_key": message.get("client_key"),
+                                        "id": duplicate["id"], "duplicate": True})
                     
+            elif msg_type == "stream_start":
+                await start_live_stream(token, message)
+
+            elif msg_type == "stream_chunk":
+                if audio_body is not None:
+                    await relay_stream_chunk(token, message, audio_body)
+
+            elif msg_type == "stream_end":
+                close_live_stream_later(token, message.get("stream_id"), message.get("duration"))
+
             elif msg_type == "logout":
+                await end_live_streams_of(token)
                 await leave_monitor_room(token)
-                users[token]["logged_in"] = False
-                delete_session(token)
+                users[token].logged_in = False
+                await session_store.delete(token)
                 if token in users:
                     del users[token]
-                await websocket.send_json({"type": "logout_success", "message": "Sesión cerrada"})
-                await broadcast_users()
+                routing.update(token)
+                outbox.put(encode_frame({"type": "logout_success", "message": "Sesión cerrada"}))
+                presence.touch(token)
+                await outbox.drain(timeout=2)
+                outbox.close(close_socket=False)
                 await websocket.close()
                 break
                 
             elif msg_type == "mute_user":
                 target = message.get("target_user_id")
                 if target:
-                    users[token]["muted_users"].add(target)
-                    save_session(
-                        token,
-                        users[token]["user_id"],
-                        users[token]["name"],
-                        users[token]["function"],
-                        users[token]["group_id"],
-                        users[token]["muted_users"]
-                    )
+                    users[token].muted_users.add(target)
+                    session_store.mark_dirty(token)
                     
             elif msg_type == "unmute_user":
                 target = message.get("target_user_id")
                 if target:
-                    users[token]["muted_users"].discard(target)
-                    save_session(
-                        token,
-                        users[token]["user_id"],
-                        users[token]["name"],
-                        users[token]["function"],
-                        users[token]["group_id"],
-                        users[token]["muted_users"]
-                    )
+                    users[token].muted_users.discard(target)
+                    session_store.mark_dirty(token)
                     
             elif msg_type == "create_group":
                 # Crea un canal nuevo. Falla si ya existe uno con ese nombre (sin
@@ -858,28 +3979,31 @@ async def websocket_endpoint(websocket: WebSocket, token: str):
                 input_name = (message.get("group_id") or "").strip()
                 password = message.get("password") or ""
                 if not input_name or not password:
-                    await websocket.send_json({
+                    send_to(token, {
                         "type": "group_error",
                         "message": "Poné un nombre de canal y una contraseña."
                     })
                 else:
-                    with db_connection() as conn:
-                        c = conn.cursor()
-                        c.execute(q("SELECT name FROM channels WHERE LOWER(name) = LOWER(?)"), (input_name,))
-                        already_exists = c.fetchone()
-                        if not already_exists:
-                            password_hash = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
-                            c.execute(
-                                q("INSERT INTO channels (name, password_hash, created_at) VALUES (?, ?, ?)"),
-                                (input_name, password_hash, datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"))
-                            )
-                    if already_exists:
-                        await websocket.send_json({
+                    already_exists = await find_channel_async(input_name) is not None
+                    busy = False
+                    if not already_exists:
+                        try:
+                            password_hash = await hash_password_async(password)
+                            already_exists = not await create_channel_async(input_name, password_hash)
+                        except HashingBusy:
+                            busy = True
+                    if busy:
+                        send_to(token, {
+                            "type": "group_error",
+                            "message": "Servidor ocupado, probá de nuevo en unos segundos."
+                        })
+                    elif already_exists:
+                        send_to(token, {
                             "type": "group_error",
                             "message": "Ya existe un canal con ese nombre. Probá con otro o entrá con \"Entrar al Canal\"."
                         })
                     else:
-                        await add_user_to_group(token, websocket, input_name)
+                        await add_user_to_group(token, input_name)
 
             elif msg_type == "join_group":
                 # Entra a un canal existente. Falla si no existe, o si la contraseña
@@ -887,218 +4011,345 @@ async def websocket_endpoint(websocket: WebSocket, token: str):
                 input_name = (message.get("group_id") or "").strip()
                 password = message.get("password") or ""
                 if not input_name or not password:
-                    await websocket.send_json({
+                    send_to(token, {
                         "type": "group_error",
                         "message": "Poné un nombre de canal y una contraseña."
                     })
                 else:
-                    with db_connection() as conn:
-                        c = conn.cursor()
-                        c.execute(q("SELECT name, password_hash FROM channels WHERE LOWER(name) = LOWER(?)"), (input_name,))
-                        row = c.fetchone()
-                    if not row:
-                        await websocket.send_json({
-                            "type": "group_error",
-                            "message": "No existe un canal con ese nombre."
-                        })
-                    elif not bcrypt.checkpw(password.encode('utf-8'), row[1].encode('utf-8')):
-                        await websocket.send_json({
-                            "type": "group_error",
-                            "message": "Contraseña incorrecta."
-                        })
+                    # Solo por IP: el nombre sale del token y cualquiera puede usar otro
+                    ip_key = ip_throttle_key(client_ip(websocket.headers, websocket.client))
+                    wait = throttled_for(ip_key)
+                    row = None if wait else await find_channel_async(input_name)
+                    error = None
+                    if wait:
+                        error = f"Demasiados intentos. Probá de nuevo en {max(1, int(wait + 0.999))} segundos."
+                    elif not row:
+                        error = "No existe un canal con ese nombre."
                     else:
-                        await add_user_to_group(token, websocket, row[0])
+                        try:
+                            if not await check_channel_password(row[0], password, row[1]):
+                                record_failure(ip_key)
+                                error = "Contraseña incorrecta."
+                        except HashingBusy:
+                            error = "Servidor ocupado, probá de nuevo en unos segundos."
+                    if error:
+                        send_to(token, {"type": "group_error", "message": error})
+                    else:
+                        await add_user_to_group(token, row[0])
 
 
             elif msg_type == "leave_group":
                 await leave_monitor_room(token)
-                group_id = users[token]["group_id"]
-                if group_id and group_id in groups:
-                    if token in groups[group_id]:
-                        groups[group_id].remove(token)
-                    if not groups[group_id]:
-                        del groups[group_id]
-                users[token]["group_id"] = None
-                save_session(
-                    token,
-                    users[token]["user_id"],
-                    users[token]["name"],
-                    users[token]["function"],
-                    None,
-                    users[token]["muted_users"]
-                )
-                await websocket.send_json({"type": "group_left"})
-                await broadcast_users()
+                users[token].group_id = None
+                routing.update(token)
+                session_store.mark_dirty(token)
+                send_to(token, {"type": "group_left"})
+                presence.send_snapshot(token)
+                presence.touch(token)
 
             elif msg_type == "monitor_join":
                 # Modo Cámara Familiar: unirse a la sala en vivo del propio grupo.
                 # Solo se puede entrar a la sala del grupo del que ya se es miembro.
                 group_id = message.get("group_id")
-                user_group_id = users[token]["group_id"]
+                user_group_id = users[token].group_id
                 if not group_id or group_id != user_group_id:
-                    await websocket.send_json({
+                    send_to(token, {
                         "type": "monitor_error",
                         "message": "Tenés que estar en ese grupo para activar la Cámara Familiar."
                     })
                 else:
-                    user_id = f"{users[token]['name']}_{users[token]['function']}"
+                    user_id = f"{users[token].name}_{users[token].function}"
                     room = monitor_rooms.setdefault(group_id, {})
 
                     # Roster de quienes ya estaban, para que el nuevo arme sus conexiones
                     existing = [
-                        {"user_id": f"{users[tk]['name']}_{users[tk]['function']}", "camera_on": on}
+                        {"user_id": f"{users[tk].name}_{users[tk].function}", "camera_on": on}
                         for tk, on in room.items() if tk != token and tk in users
                     ]
+                    existing += [{"user_id": uid, "camera_on": on}
+                                 for uid, (_, on) in monitor_remote.get(group_id, {}).items()]
                     room[token] = message.get("camera_on", True)
-                    await websocket.send_json({"type": "monitor_roster", "group_id": group_id, "participants": existing})
+                    send_to(token, {"type": "monitor_roster", "group_id": group_id, "participants": existing})
 
                     # Avisar a los que ya estaban que se sumó alguien nuevo
                     for other_token in list(room.keys()):
                         if other_token == token:
                             continue
-                        other_ws = users.get(other_token, {}).get("websocket")
-                        if other_ws:
-                            try:
-                                await other_ws.send_json({
-                                    "type": "monitor_peer_joined",
-                                    "user_id": user_id,
-                                    "camera_on": room[token]
-                                })
-                            except Exception as e:
-                                logger.error(f"Error avisando ingreso a sala familiar a {other_token}: {e}")
+                        send_to(other_token, {
+                            "type": "monitor_peer_joined",
+                            "user_id": user_id,
+                            "camera_on": room[token]
+                        })
+                    await backplane.publish({"kind": "room", "event": "joined", "group_id": group_id,
+                                             "user_id": user_id, "camera_on": room[token]})
 
             elif msg_type == "monitor_leave":
                 await leave_monitor_room(token)
 
             elif msg_type == "monitor_camera_state":
-                group_id = users[token]["group_id"]
+                group_id = users[token].group_id
                 camera_on = bool(message.get("camera_on"))
                 if group_id and group_id in monitor_rooms and token in monitor_rooms[group_id]:
                     monitor_rooms[group_id][token] = camera_on
-                    user_id = f"{users[token]['name']}_{users[token]['function']}"
+                    user_id = f"{users[token].name}_{users[token].function}"
                     for other_token in list(monitor_rooms[group_id].keys()):
                         if other_token == token:
                             continue
-                        other_ws = users.get(other_token, {}).get("websocket")
-                        if other_ws:
-                            try:
-                                await other_ws.send_json({
-                                    "type": "monitor_camera_state",
-                                    "user_id": user_id,
-                                    "camera_on": camera_on
-                                })
-                            except Exception as e:
-                                logger.error(f"Error avisando cámara a {other_token}: {e}")
+                        send_to(other_token, {
+                            "type": "monitor_camera_state",
+                            "user_id": user_id,
+                            "camera_on": camera_on
+                        })
+                    await backplane.publish({"kind": "room", "event": "camera", "group_id": group_id,
+                                             "user_id": user_id, "camera_on": camera_on})
 
             elif msg_type in ["monitor_offer", "monitor_answer", "monitor_ice_candidate"]:
                 # Señalización WebRTC de la Cámara Familiar: el servidor solo reenvía el
                 # mensaje tal cual al destinatario, sin guardar estado de la conexión.
                 target_user_id = message.get("target_user_id")
                 target_token = find_token_by_user_id(target_user_id) if target_user_id else None
-                target_ws = users[target_token]["websocket"] if target_token and target_token in users else None
 
-                if target_ws:
-                    sender_user_id = f"{users[token]['name']}_{users[token]['function']}"
-                    try:
-                        await target_ws.send_json({**message, "from_user_id": sender_user_id})
-                    except Exception as e:
-                        logger.error(f"Error reenviando señal de video a {target_user_id}: {e}")
+                sender_user_id = f"{users[token].name}_{users[token].function}"
+                if target_token in routing.online:
+                    if not send_to(target_token, {**message, "from_user_id": sender_user_id}):
+                        logger.error(f"No se pudo reenviar señal de video a {target_user_id}")
+                elif target_user_id and backplane.enabled:
+                    # No está conectado a este worker: que lo entregue el que lo tenga
+                    await backplane.publish({"kind": "signal", "target_user_id": target_user_id,
+                                             "message": {**message, "from_user_id": sender_user_id}})
 
     except WebSocketDisconnect:
         logger.info(f"Cliente desconectado (en segundo plano): {token[:15]}...")
-        await leave_monitor_room(token)
-        if token in users:
-            users[token]["websocket"] = None
-            users[token]["active"] = False
-            await broadcast_users()
-            save_session(
-                token,
-                users[token]["user_id"],
-                users[token]["name"],
-                users[token]["function"],
-                users[token]["group_id"],
-                users[token]["muted_users"]
-            )
+        await abort_live_streams_of(token)
+        if getattr(users.get(token), "websocket", None) is websocket:
+            await leave_monitor_room(token)
+        if detach_socket(token, websocket):
+            session_store.mark_dirty(token)
+            presence.touch(token)
     except Exception as e:
         logger.error(f"Excepción en conexión WebSocket {token[:15]}...: {str(e)}")
-        await leave_monitor_room(token)
-        if token in users:
-            users[token]["websocket"] = None
-            users[token]["active"] = False
-            await broadcast_users()
-        await websocket.close()
+        await abort_live_streams_of(token)
+        if getattr(users.get(token), "websocket", None) is websocket:
+            await leave_monitor_room(token)
+        if detach_socket(token, websocket):
+            presence.touch(token)
+        try:
+            await websocket.close()
+        except Exception:
+            pass
+
+# Clips de audio por hash de contenido. Como el contenido de un hash nunca cambia, se
+# puede cachear para siempre ("immutable"); el ETag es el propio hash y se soporta
+# Range para que el reproductor del navegador pueda pedir por partes. ?original=1 devuelve
+# el clip tal como se subió (clientes sin Opus, ver ingest_clip), o el mismo si no hay.
+# Solo se atiende un rango simple; uno múltiple o ilegible se ignora y va el clip entero
+# con 200, como permite RFC 7233. 416 queda para un rango válido que cae fuera del clip.
+_AUDIO_HASH_RE = re.compile(r"^[0-9a-f]{64}$")
+_RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+def _parse_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """(inicio, fin) inclusive del rango pedido, o None si no hay que atenderlo (ausente,
+    múltiple o ilegible). Un rango válido que no se puede satisfacer da inicio > fin."""
+    match = _RANGE_RE.match(header.strip())
+    if not match or not any(match.groups()):
+        return None
+    first, last = match.groups()
+    if not first:
+        # "bytes=-N": los últimos N bytes ("bytes=-0" no pide nada)
+        return (max(size - int(last), 0), size - 1) if int(last) else (size, size - 1)
+    if last and int(last) < int(first):
+        return None
+    return int(first), min(int(last) if last else size - 1, size - 1)
+
+@app.get("/audio/{audio_hash}")
+async def get_audio_clip(audio_hash: str, request: Request, original: bool = False):
+    if not _AUDIO_HASH_RE.match(audio_hash):
+        raise HTTPException(status_code=404, detail="Audio no encontrado")
+    etag = f'"{audio_hash}-original"' if original else f'"{audio_hash}"'
+    headers = {
+        "ETag": etag,
+        "Cache-Control": "public, max-age=31536000, immutable",
+        "Accept-Ranges": "bytes",
+    }
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=headers)
+
+    blob = await run_db(load_audio_blob, audio_hash, original)
+    if not blob:
+        raise HTTPException(status_code=404, detail="Audio no encontrado")
+    mime, data = blob
+
+    byte_range = _parse_range(request.headers.get("range", ""), len(data))
+    if byte_range:
+        start, end = byte_range
+        if start > end:
+            return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{len(data)}"})
+        headers["Content-Range"] = f"bytes {start}-{end}/{len(data)}"
+        return Response(content=data[start:end + 1], status_code=206, media_type=mime, headers=headers)
+
+    return Response(content=data, media_type=mime, headers=headers)
+
+# Historial paginado por cursor. Antes devolvía TODOS los mensajes del día (con el audio)
+# en una sola respuesta; ahora cada pedido trae a lo sumo una página, y el cuerpo se va
+# armando mensaje por mensaje mientras se envía. Los cursores para seguir paginando van
+# en los headers X-Next-Before-Id (más viejos) y X-Next-After-Id (más nuevos), así el
+# cuerpo sigue siendo la misma lista JSON de siempre.
+async def history_response(before_id: Optional[int], after_id: Optional[int],
+                           limit: Optional[int], fields: Optional[str]) -> StreamingResponse:
+    if fields not in (None, "full", "meta"):
+        raise HTTPException(status_code=400, detail="fields debe ser 'full' o 'meta'")
+    if before_id is not None and after_id is not None:
+        raise HTTPException(status_code=400, detail="Usá before_id o after_id, no los dos")
+    page_size = max(1, min(limit or HISTORY_PAGE_SIZE, HISTORY_MAX_PAGE_SIZE))
+    rows = await run_db(get_history_page, before_id, after_id, page_size, fields == "meta")
+
+    headers = {}
+    if rows:
+        headers["X-Next-After-Id"] = str(rows[-1][0])
+        if len(rows) == page_size or after_id is not None:
+            headers["X-Next-Before-Id"] = str(rows[0][0])
+
+    async def body():
+        yield "["
+        for i, row in enumerate(rows):
+            yield ("," if i else "") + json.dumps(_history_row(row), ensure_ascii=False)
+        yield "]"
+
+    return StreamingResponse(body(), media_type="application/json", headers=headers)
 
 @app.get("/history")
-async def get_history_endpoint():
-    return get_history()
+async def get_history_endpoint(before_id: Optional[int] = None, after_id: Optional[int] = None,
+                               limit: Optional[int] = None, fields: Optional[str] = None):
+    return await history_response(before_id, after_id, limit, fields)
 
 @app.get("/api/history")
-async def get_api_history_endpoint():
-    return get_history()
+async def get_api_history_endpoint(before_id: Optional[int] = None, after_id: Optional[int] = None,
+                                   limit: Optional[int] = None, fields: Optional[str] = None):
+    return await history_response(before_id, after_id, limit, fields)
+
+# Búsqueda en las transcripciones (ver search_messages). Devuelve cada mensaje como en el
+# historial más el canal y el fragmento con las coincidencias entre «»; si puede haber
+# más resultados, next_before_id es el cursor para pedir la página siguiente.
+_SEARCH_TIME_RE = re.compile(r"^\d{4}-\d{2}-\d{2}([ T]\d{2}:\d{2})?$")
+search_stats = {"queries": 0, "errors": 0, "total_ms": 0.0, "max_ms": 0.0}
+
+@app.get("/api/search")
+async def search_endpoint(text: str = Query("", alias="q"), user_id: Optional[str] = None, group_id: Optional[str] = None,
+                          since: Optional[str] = None, until: Optional[str] = None,
+                          before_id: Optional[int] = None, limit: Optional[int] = None):
+    terms = search_terms(text)
+    if not terms:
+        raise HTTPException(status_code=400, detail="Falta el texto a buscar")
+    for value in (since, until):
+        if value and not _SEARCH_TIME_RE.match(value):
+            raise HTTPException(status_code=400, detail="since/until deben ser YYYY-MM-DD o YYYY-MM-DD HH:MM")
+    since = since.replace("T", " ") if since else None
+    until = until.replace("T", " ") if until else None
+    page_size = max(1, min(limit or SEARCH_PAGE_SIZE, SEARCH_MAX_PAGE_SIZE))
+
+    started = time.monotonic()
+    try:
+        rows = await run_db(search_messages, terms, user_id, group_id, since, until, before_id, page_size)
+    except Exception as e:
+        search_stats["errors"] += 1
+        logger.error(f"Error buscando '{text}': {e}")
+        raise HTTPException(status_code=500, detail="No se pudo completar la búsqueda")
+    elapsed_ms = (time.monotonic() - started) * 1000
+    search_stats["queries"] += 1
+    search_stats["total_ms"] += elapsed_ms
+    search_stats["max_ms"] = max(search_stats["max_ms"], elapsed_ms)
+
+    results = []
+    for row in rows:
+        msg = _history_row(row[:10])
+        msg.update({"group_id": row[10], "snippet": row[11]})
+        results.append(msg)
+    return {"results": results, "next_before_id": rows[-1][0] if len(rows) == page_size else None}
 
 # Lista los canales/grupos existentes (nunca expone la contraseña)
 @app.get("/api/groups")
 async def list_groups():
-    with db_connection() as conn:
-        c = conn.cursor()
-        c.execute("SELECT name FROM channels ORDER BY LOWER(name)")
-        names = [row[0] for row in c.fetchall()]
+    names = await list_channel_names_async()
 
     result = []
     for name in names:
-        active_members = sum(
-            1 for u in users.values()
-            if u.get("group_id") == name and u.get("websocket")
-        )
-        result.append({"name": name, "active_members": active_members})
+        result.append({"name": name, "active_members": len(routing.groups.get(name, ()))})
     return {"groups": result}
 
 
+# Métricas operativas (cola de audio, pool de conexiones) para dimensionar la concurrencia
+@app.get("/api/metrics")
+async def metrics_endpoint():
+    return {
+        "audio_pipeline": audio_pipeline_metrics(),
+        "db_pool": get_db_pool().stats(),
+        "history_resume": resume_stats,
+        "fanout": fanout_metrics(),
+        "outbox": outbox_metrics(),
+        "presence": presence.metrics(),
+        "live_streams": {**stream_stats, "open": len(live_streams), "closing": len(_stream_tasks)},
+        "backplane": backplane.metrics(),
+        "audio_ingest": ingest_stats,
+        "transcription": {"backend": transcription.name, **transcription.metrics()},
+        "dedup": {**dedup_stats, "keys": ingest_keys.size, "transcripts": transcript_cache.size},
+        "retention": retention_stats,
+        "sessions": {"resident": len(users), "connected": len(routing.online), **session_stats},
+        "credentials": {**hasher.metrics(), **credential_stats, "channel_cache": channel_verifications.size,
+                        "throttled": login_throttle.blocked_count + register_throttle.blocked_count,
+                        "tracked_keys": login_throttle.size},
+        "search": {**search_stats, "avg_ms": round(search_stats["total_ms"] / max(search_stats["queries"], 1), 2)},
+    }
+
 # Evento de inicio del servidor FastAPI
 @app.on_event("startup")
 async def startup_event():
+    global decode_executor, recognize_executor, audio_queue, transcription_slots
     try:
         logger.info("Iniciando aplicación HANDLEPHONE...")
-        init_db()
-
-        # Pre-cargar sesiones registradas en DB al diccionario de usuarios activo en memoria
-        try:
-            with db_connection() as conn:
-                c = conn.cursor()
-                c.execute("SELECT token, user_id, name, function, group_id, muted_users FROM sessions")
-                for row in c.fetchall():
-                    token, user_id, name, function, group_id, muted_users_str = row
-                    try:
-                        muted_users = set(json.loads(muted_users_str))
-                    except Exception:
-                        muted_users = set()
-                    
-                    # Cargar como desconectados temporales (active=False, websocket=None) pero logged_in=True
-                    users[token] = {
-                        "user_id": user_id,
-                        "name": name,
-                        "function": function,
-                        "logged_in": True,
-                        "websocket": None,
-                        "muted_users": muted_users,
-                        "subscription": None,
-                        "group_id": group_id,
-                        "active": False
-                    }
-            logger.info(f"Sesiones persistentes precargadas en memoria: {len(users)}")
-        except Exception as db_err:
-            logger.error(f"Error cargando sesiones persistentes al inicio: {db_err}")
+        # Colas, semáforos y locks de asyncio quedan atados al primer event loop que los
+        # usa: se crean de nuevo en cada arranque, así un segundo arranque en el mismo
+        # proceso (otro TestClient, por ejemplo) no hereda los del loop anterior.
+        audio_queue = asyncio.Queue()
+        transcription_slots = asyncio.Semaphore(TRANSCRIBE_WORKERS)
+        session_store.bind_loop()
+        transcription.bind_loop()
+        await run_db(init_db)
 
         # Programar loops asíncronos en segundo plano
-        asyncio.create_task(clear_messages())
-        asyncio.create_task(process_audio_queue())
-        asyncio.create_task(clean_expired_sessions())
-        asyncio.create_task(periodic_broadcast_users())
+        asyncio.create_task(retention_loop())
+        recognize_executor = ThreadPoolExecutor(max_workers=TRANSCRIBE_WORKERS, thread_name_prefix="recognize")
+        if DECODE_PROCESSES > 0:
+            decode_executor = ProcessPoolExecutor(max_workers=DECODE_PROCESSES)
+        for _ in range(TRANSCRIBE_WORKERS):
+            asyncio.create_task(process_audio_queue())
+        asyncio.create_task(session_eviction_loop())
+        asyncio.create_task(presence_liveness_loop())
+        asyncio.create_task(session_store.run())
+        await backplane.start(handle_backplane_event)
+        if backplane.enabled:
+            asyncio.create_task(backplane_loop())
         logger.info("Tareas en segundo plano programadas exitosamente.")
     except Exception as e:
         logger.error(f"Error grave en el inicio de FastAPI: {e}")
         raise
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    global decode_executor, recognize_executor
+    try:
+        await session_store.flush()
+    except Exception as e:
+        logger.error(f"Error volcando sesiones pendientes al apagar: {e}")
+    await backplane.publish({"kind": "bye"})
+    await backplane.stop()
+    for executor in (decode_executor, recognize_executor):
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+    decode_executor = recognize_executor = None
+    close_db_executor()
+    close_db_pool()
+    logger.info("Conexiones a la base de datos cerradas.")
+
 if __name__ == "__main__":
     import uvicorn
     port = int(os.getenv("PORT", 8000))
@@ -15,6 +15,11 @@ function getDefaultDeviceName() {
 
 let ws = null;
 let lastPongAt = 0; // último "pong" del servidor, para detectar conexiones muertas (ver startPing)
+let lastSeenMsgId = 0; // id del último mensaje recibido: al reconectar solo se pide lo posterior
+let presenceScope = null; // alcance de la lista de usuarios: canal actual, o '' en la pantalla principal
+let presenceVersion = -1; // versión de la lista de usuarios que tenemos (ver presence_delta)
+const presenceUsers = new Map(); // pid -> usuario del alcance
+const presenceContacts = new Map(); // pid -> contacto directo de otro alcance
 let userId = null;
 let currentGroup = null;
 let isRecording = false;
@@ -865,6 +870,20 @@ function startAudioKeepAlive() {
     }
 }
 
+// Cursor de reanudación: lo posterior al último mensaje recibido, salvo que haya mensajes
+// todavía "Pendiente de transcripción". Sus transcript_update se pierden si llegan con el
+// socket caído, así que se pide desde el más viejo de ellos: displayMessage reconoce los
+// que ya están por id y solo les completa el texto.
+function resumeCursor() {
+    let cursor = lastSeenMsgId;
+    document.querySelectorAll('[data-msg-id]').forEach(el => {
+        const id = parseInt(el.getAttribute('data-msg-id'), 10);
+        const text = el.querySelector('.msg-text')?.textContent;
+        if (id > 0 && id <= cursor && text === 'Pendiente de transcripción') cursor = id - 1;
+    });
+    return cursor;
+}
+
 function connectWebSocket(token) {
     requestWakeLock();
     startAudioKeepAlive();
@@ -878,7 +897,11 @@ function connectWebSocket(token) {
     let historyLoaded = false;
 
     const wsProtocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
-    ws = new WebSocket(`${wsProtocol}//${window.location.host}/ws/${token}`);
+    // binary=1: el audio viaja en frames binarios (ver encodeAudioFrame) en lugar de base64
+    const cursor = resumeCursor();
+    const resumeQuery = cursor ? `&last_seen_id=${cursor}` : '';
+    ws = new WebSocket(`${wsProtocol}//${window.location.host}/ws/${token}?binary=1${resumeQuery}`);
+    ws.binaryType = 'arraybuffer';
     ws.onopen = () => {
         console.log("WebSocket conectado");
         lastPongAt = Date.now(); // arranca "sana", da margen antes de sospechar que está muerta
@@ -886,7 +909,8 @@ function connectWebSocket(token) {
     };
     ws.onmessage = (event) => {
         try {
-            const data = JSON.parse(event.data);
+            const data = event.data instanceof ArrayBuffer ? decodeAudioFrame(event.data) : JSON.parse(event.data);
+            if (data.audio_url) data.audio_url = playableAudioUrl(data.audio_url);
             if (data.type === 'pong') {
                 lastPongAt = Date.now();
                 return;
@@ -899,6 +923,7 @@ function connectWebSocket(token) {
                 console.log(`Historial cargado (${historyMsgIds.size} mensajes). Auto-play activado solo para lo que llegue de acá en más.`);
             } else if (data.type === 'message' || data.type === 'group_message' || data.type === 'direct_message') {
                 displayMessage(data);
+                if (data.id && data.id > lastSeenMsgId) lastSeenMsgId = data.id;
 
                 // Determine if this is our own message
                 const myToken = localStorage.getItem('sessionToken');
@@ -907,12 +932,63 @@ function connectWebSocket(token) {
                 if (!historyLoaded) {
                     // Still loading history - remember this ID but don't auto-play
                     if (data.id) historyMsgIds.add(data.id);
-                } else if (data.audio && !isMine) {
+                } else if (data.stream && finishLiveStream(data.stream)) {
+                    // Ya se escuchó en vivo mientras se transmitía
+                } else if ((data.audio_url || data.audio) && !isMine) {
                     // Live message after history loaded - auto-play!
-                    enqueueAudio(data.audio, data.sender, data.type === 'group_message' ? data.group_id : null);
+                    enqueueAudio(data.audio_local_url || data.audio_url || data.audio, data.sender, data.type === 'group_message' ? data.group_id : null);
+                    data.audio_local_url = null; // la cola la libera después de reproducirla
                 }
+                if (data.audio_local_url) URL.revokeObjectURL(data.audio_local_url);
+            } else if (data.type === 'stream_start') {
+                if (historyLoaded) handleStreamStart(data);
+            } else if (data.type === 'stream_chunk') {
+                handleStreamChunk(data);
+            } else if (data.type === 'stream_error') {
+                // El servidor descartó nuestra transmisión: al soltar se manda el clip completo
+                const outgoing = outgoingStreams.get(data.stream_id);
+                if (outgoing) outgoing.failed = true;
+                console.warn('Transmisión en vivo rechazada:', data.message);
+            } else if (data.type === 'message_ack') {
+                // Reintento de un mensaje que el servidor ya tenía: no se vuelve a mostrar
+                if (data.duplicate) console.log('Mensaje ya recibido por el servidor:', data.client_key);
+            } else if (data.type === 'transcript_update') {
+                // Segunda fase de la entrega: el audio ya llegó con el texto pendiente,
+                // acá llega la transcripción para ese mismo mensaje (por id).
+                document.querySelectorAll(`[data-msg-id="${data.id}"] .msg-text`).forEach(el => {
+                    el.textContent = data.text || 'Mensaje de voz';
+                });
             } else if (data.type === 'user_list') {
-                updateUserList(data.users);
+                // Lista completa: llega una vez al conectar, o cuando la pedimos por
+                // haber quedado atrás de la versión del servidor.
+                presenceUsers.clear();
+                presenceContacts.clear();
+                data.users.forEach(u => presenceUsers.set(u.pid || u.user_id, u));
+                (data.contacts || []).forEach(u => presenceContacts.set(u.pid, u));
+                presenceScope = typeof data.scope === 'string' ? data.scope : null;
+                presenceVersion = typeof data.version === 'number' ? data.version : -1;
+                renderPresence();
+            } else if (data.type === 'presence_delta') {
+                if (data.scope !== presenceScope || data.version <= presenceVersion) {
+                    // De un canal del que ya salimos, o ya incluido en una lista completa más nueva
+                } else if (data.base !== presenceVersion) {
+                    // Nos perdimos un cambio en el medio: pedir la lista entera
+                    requestUserList();
+                } else {
+                    data.upsert.forEach(u => {
+                        presenceUsers.set(u.pid, u);
+                        presenceContacts.delete(u.pid);
+                    });
+                    data.remove.forEach(pid => presenceUsers.delete(pid));
+                    presenceVersion = data.version;
+                    renderPresence();
+                }
+            } else if (data.type === 'presence_contact') {
+                data.users.forEach(u => {
+                    if (!presenceUsers.has(u.pid)) presenceContacts.set(u.pid, u);
+                });
+                data.remove.forEach(pid => presenceContacts.delete(pid));
+                renderPresence();
             } else if (data.type === 'group_error') {
                 showError(data.message);
             } else if (data.type === 'group_joined') {
@@ -938,12 +1014,10 @@ function connectWebSocket(token) {
                 }
                 
                 updateSwipeHint();
-                // Refuerzo redundante: aparte del broadcast que ya dispara el servidor
-                // al unirse, se pide una lista fresca acá también, para no depender de
-                // una sola oportunidad si justo hubo una reconexión en el medio.
-                if (ws && ws.readyState === WebSocket.OPEN) {
-                    ws.send(JSON.stringify({ type: 'refresh_users' }));
-                }
+                // Refuerzo redundante: aparte del delta que ya dispara el servidor al
+                // unirse, se le avisa qué versión tenemos, para no depender de una sola
+                // oportunidad si justo hubo una reconexión en el medio.
+                requestUserList();
                 // Conectar a la Cámara Familiar del grupo automáticamente: si alguien ya
                 // tiene la cámara prendida, se muestra sola sin tocar ningún botón.
                 autoJoinMonitorRoom();
@@ -993,11 +1067,189 @@ function startPing() {
     }
 
     ws.send(JSON.stringify({ type: 'ping' }));
-    // Also request fresh user list on each ping
-    ws.send(JSON.stringify({ type: 'refresh_users' }));
+    // Con cada ping se avisa qué versión de la lista de usuarios tenemos; el servidor
+    // solo contesta (con la lista entera) si quedamos atrás.
+    requestUserList();
     setTimeout(startPing, 10000);
 }
 
+// Frame binario de audio: 4 bytes con el largo del encabezado (big-endian), el
+// encabezado en JSON y después el audio crudo. Mismo formato que encode_binary_frame
+// en main.py.
+function encodeAudioFrame(header, audioBuffer) {
+    const headerBytes = new TextEncoder().encode(JSON.stringify(header));
+    const frame = new Uint8Array(4 + headerBytes.length + audioBuffer.byteLength);
+    new DataView(frame.buffer).setUint32(0, headerBytes.length);
+    frame.set(headerBytes, 4);
+    frame.set(new Uint8Array(audioBuffer), 4 + headerBytes.length);
+    return frame.buffer;
+}
+
+// El servidor guarda los clips en Opus (ver ingest_clip en main.py), que Safari de iOS
+// anterior a la 17 no reproduce. Ahí se pide el clip tal como se subió (?original=1; si no
+// se guardó aparte el servidor devuelve el de siempre) y no se usa la copia en Opus que
+// viene en el frame binario.
+const OPUS_PLAYBACK = !!document.createElement('audio').canPlayType('audio/ogg; codecs=opus');
+
+function playableAudioUrl(url) {
+    return OPUS_PLAYBACK || !url || !url.startsWith('/audio/') ? url : `${url}?original=1`;
+}
+
+function decodeAudioFrame(buffer) {
+    const headerLength = new DataView(buffer).getUint32(0);
+    const header = JSON.parse(new TextDecoder().decode(new Uint8Array(buffer, 4, headerLength)));
+    if (header.type === 'stream_chunk') {
+        header.chunk = buffer.slice(4 + headerLength);
+        return header;
+    }
+    if (!OPUS_PLAYBACK && (header.audio_mime || '').includes('opus')) return header;
+    const audioBlob = new Blob([buffer.slice(4 + headerLength)], { type: header.audio_mime || 'audio/webm' });
+    // El auto-play sale de memoria; el botón ▶ del mensaje sigue usando audio_url del
+    // servidor (cacheado por el navegador), así esta copia se libera apenas se reproduce.
+    header.audio_local_url = URL.createObjectURL(audioBlob);
+    return header;
+}
+
+// Push-to-talk en vivo: mientras se mantiene apretado el botón, el audio sale en
+// pedazos de STREAM_CHUNK_MS (stream_start / stream_chunk / stream_end) y los demás lo
+// escuchan casi al mismo tiempo, en lugar de esperar a que se suelte el botón y se
+// suba el clip entero. Si el socket no está abierto se graba y envía como siempre.
+// Si la transmisión no se completa (el socket se cayó o se reemplazó a mitad, o el
+// servidor la rechazó con stream_error) el servidor la descarta y al soltar se manda el
+// clip completo por el camino normal, con la misma client_key.
+const STREAM_CHUNK_MS = 250;
+const outgoingStreams = new Map(); // stream_id -> transmisión propia en curso
+
+function currentTimeLabel() {
+    const now = new Date();
+    return `${String(now.getHours()).padStart(2,'0')}:${String(now.getMinutes()).padStart(2,'0')}`;
+}
+
+function startAudioStream(header) {
+    if (!ws || ws.readyState !== WebSocket.OPEN) return null;
+    const socket = ws; // los pedazos solo sirven en el socket donde se abrió la transmisión
+    const streamId = `${Date.now().toString(36)}${Math.random().toString(36).slice(2, 8)}`;
+    const clientKey = newClientKey();
+    let seq = 0;
+    // Cadena de promesas: los pedazos salen en orden aunque arrayBuffer() sea asíncrono
+    let pending = Promise.resolve();
+    const stream = { clientKey, failed: false };
+    const send = (frameHeader, blob) => {
+        pending = pending.then(async () => {
+            if (stream.failed) return;
+            const buffer = blob ? await blob.arrayBuffer() : new ArrayBuffer(0);
+            if (ws !== socket || socket.readyState !== WebSocket.OPEN) {
+                stream.failed = true;
+                return;
+            }
+            socket.send(encodeAudioFrame({ ...frameHeader, stream_id: streamId }, buffer));
+        }).catch(err => {
+            stream.failed = true;
+            console.error('Error enviando audio en vivo:', err);
+        });
+    };
+    outgoingStreams.set(streamId, stream);
+    send({ ...header, type: 'stream_start', mime: 'audio/webm', client_key: clientKey });
+    stream.chunk = blob => { if (blob.size) send({ type: 'stream_chunk', seq: seq++ }, blob); };
+    // Resuelve true si la transmisión llegó completa (stream_end incluido) por el mismo socket
+    stream.end = async duration => {
+        send({ type: 'stream_end', duration });
+        await pending;
+        outgoingStreams.delete(streamId);
+        return !stream.failed;
+    };
+    return stream;
+}
+
+// Envío del clip completo; sin conexión queda en la cola offline del service worker, que
+// usa el JSON con base64 y lo reenvía tal cual (con su client_key) al reconectar.
+async function sendOrQueueAudio(header, audioBlob) {
+    if (await sendAudioMessage(header, audioBlob)) return;
+    const reader = new FileReader();
+    reader.readAsDataURL(audioBlob);
+    reader.onloadend = () => {
+        const base64Audio = reader.result.split(',')[1];
+        navigator.serviceWorker?.controller?.postMessage({
+            type: 'QUEUE_MESSAGE',
+            message: { ...header, audio: base64Audio }
+        });
+    };
+}
+
+// Lado del que escucha: los pedazos se van agregando a un MediaSource y suenan a medida
+// que llegan. Si el navegador no soporta MediaSource con webm/opus, se ignoran y el
+// mensaje completo se reproduce como siempre cuando llega al final.
+const liveStreams = new Map(); // stream -> { audio, mediaSource, sourceBuffer, queue, ended }
+const LIVE_STREAM_MIME = 'audio/webm;codecs=opus';
+
+function handleStreamStart(data) {
+    if (isMuted || !window.MediaSource || !MediaSource.isTypeSupported(LIVE_STREAM_MIME)) return;
+    if (clientMutedUsers.has(data.sender_id)) return;
+    const mediaSource = new MediaSource();
+    const audio = new Audio(URL.createObjectURL(mediaSource));
+    const entry = { audio, mediaSource, sourceBuffer: null, queue: [], ended: false };
+    liveStreams.set(data.stream, entry);
+    mediaSource.addEventListener('sourceopen', () => {
+        entry.sourceBuffer = mediaSource.addSourceBuffer(LIVE_STREAM_MIME);
+        entry.sourceBuffer.addEventListener('updateend', () => pumpLiveStream(entry));
+        pumpLiveStream(entry);
+    });
+    audio.play().catch(err => console.warn('Autoplay bloqueado (en vivo):', err));
+}
+
+function handleStreamChunk(data) {
+    const entry = liveStreams.get(data.stream);
+    if (!entry) return;
+    entry.queue.push(data.chunk);
+    pumpLiveStream(entry);
+}
+
+function pumpLiveStream(entry) {
+    const { sourceBuffer, mediaSource } = entry;
+    if (!sourceBuffer || sourceBuffer.updating) return;
+    if (entry.queue.length > 0) {
+        sourceBuffer.appendBuffer(entry.queue.shift());
+    } else if (entry.ended && mediaSource.readyState === 'open') {
+        mediaSource.endOfStream();
+    }
+}
+
+// Llegó el mensaje final de una transmisión: si se estaba escuchando en vivo, se cierra
+// el MediaSource y se avisa que no hay que volver a reproducirlo.
+function finishLiveStream(streamKey) {
+    const entry = liveStreams.get(streamKey);
+    if (!entry) return false;
+    liveStreams.delete(streamKey);
+    entry.ended = true;
+    pumpLiveStream(entry);
+    entry.audio.onended = () => URL.revokeObjectURL(entry.audio.src);
+    return true;
+}
+
+// Clave de idempotencia del mensaje: viaja igual en el envío directo y en los reintentos
+// de la cola offline, así el servidor descarta las copias repetidas.
+function newClientKey() {
+    if (window.crypto?.randomUUID) return crypto.randomUUID();
+    return `${Date.now().toString(36)}-${Math.random().toString(36).slice(2, 12)}`;
+}
+
+async function sendAudioMessage(header, audioBlob) {
+    const buffer = await audioBlob.arrayBuffer();
+    if (!ws || ws.readyState !== WebSocket.OPEN) return false;
+    ws.send(encodeAudioFrame({ ...header, mime: audioBlob.type }, buffer));
+    return true;
+}
+
+function requestUserList() {
+    if (ws && ws.readyState === WebSocket.OPEN) {
+        ws.send(JSON.stringify({ type: 'refresh_users', scope: presenceScope, version: presenceVersion }));
+    }
+}
+
+function renderPresence() {
+    updateUserList([...presenceUsers.values(), ...presenceContacts.values()]);
+}
+
 function stopPing() {
     // No se necesita implementación explícita para detener pings
 }
@@ -1037,17 +1289,16 @@ function playAudioAndWait(audioData, sender, groupId) {
             // Skip if this sender is individually muted
             if (sender && clientMutedUsers.has(sender)) { resolve(); return; }
 
-            const audioBlob = base64ToBlob(audioData, 'audio/webm');
-            if (!audioBlob) { reject(new Error("No se pudo convertir audio")); return; }
-            const audioUrl = URL.createObjectURL(audioBlob);
-            const audio = new Audio(audioUrl);
+            const source = audioDataToUrl(audioData);
+            if (!source) { reject(new Error("No se pudo convertir audio")); return; }
+            const audio = new Audio(source.url);
 
             audio.onended = () => {
-                URL.revokeObjectURL(audioUrl);
+                source.revoke();
                 resolve();
             };
             audio.onerror = (e) => {
-                URL.revokeObjectURL(audioUrl);
+                source.revoke();
                 reject(e);
             };
 
@@ -1086,7 +1337,7 @@ function updateUserList(users) {
     const activeUsers = users.filter(u => u.active !== false);
     const offlineUsers = users.filter(u => u.active === false);
 
-    // El servidor identifica a cada usuario como "nombre_función" (ver broadcast_users en main.py),
+    // El servidor identifica a cada usuario como "nombre_función" (ver Presence._entry en main.py),
     // mientras que la variable global `userId` incluye además el legajo simulado ("legajo_nombre_función").
     // Se reconstruye el mismo formato acá para poder detectar correctamente la propia fila.
     const myUserId = `${localStorage.getItem('userName') || ''}_${localStorage.getItem('userFunction') || ''}`;
@@ -1257,9 +1508,10 @@ function displayMessage(data) {
     const chatList = data.type === 'group_message' ? document.getElementById('group-chat-list') : document.getElementById('chat-list');
     if (!chatList) return;
 
-    // Check if message is already displayed by unique ID to prevent duplicates
+    // Check if message is already displayed by unique ID to prevent duplicates. Se busca en
+    // las dos listas: al reanudar, un mensaje de grupo vuelve como "message" del historial.
     if (data.id) {
-        const duplicate = chatList.querySelector(`[data-msg-id="${data.id}"]`);
+        const duplicate = document.querySelector(`.chat-message[data-msg-id="${data.id}"]`);
         if (duplicate) {
             // Update transcription text if it was pending
             const textEl = duplicate.querySelector('.msg-text');
@@ -1317,13 +1569,13 @@ function displayMessage(data) {
             </div>
             <p class="msg-text text-sm text-slate-200 leading-snug mt-0.5">${data.text || 'Mensaje de voz'}</p>
         </div>
-        ${data.audio ? '<button class="play-btn flex-shrink-0 w-7 h-7 rounded-full bg-sky-600/20 hover:bg-sky-600/40 text-sky-400 flex items-center justify-center text-xs transition">▶</button>' : ''}
+        ${(data.audio_url || data.audio) ? '<button class="play-btn flex-shrink-0 w-7 h-7 rounded-full bg-sky-600/20 hover:bg-sky-600/40 text-sky-400 flex items-center justify-center text-xs transition">▶</button>' : ''}
     `;
-    if (data.audio) {
+    if (data.audio_url || data.audio) {
         const playBtn = messageDiv.querySelector('.play-btn');
         playBtn?.addEventListener('click', (e) => {
             e.stopPropagation();
-            playAudio(data.audio, data.sender, data.type === 'group_message' ? data.group_id : null, playBtn);
+            playAudio(data.audio_url || data.audio, data.sender, data.type === 'group_message' ? data.group_id : null, playBtn);
         });
     }
     chatList.appendChild(messageDiv);
@@ -1358,10 +1610,9 @@ async function playAudio(audioData, sender, groupId, btnElement = null) {
             document.querySelectorAll('.play-btn').forEach(btn => btn.textContent = '▶');
         }
 
-        const audioBlob = base64ToBlob(audioData, 'audio/webm');
-        if (!audioBlob) throw new Error("No se pudo convertir el audio");
-        const audioUrl = URL.createObjectURL(audioBlob);
-        const audio = new Audio(audioUrl);
+        const source = audioDataToUrl(audioData);
+        if (!source) throw new Error("No se pudo convertir el audio");
+        const audio = new Audio(source.url);
         audio._audioData = audioData; // unique key identifier
         currentAudio = audio;
         
@@ -1386,7 +1637,7 @@ async function playAudio(audioData, sender, groupId, btnElement = null) {
         }
         
         audio.onended = () => { 
-            URL.revokeObjectURL(audioUrl);
+            source.revoke();
             if (btnElement) btnElement.textContent = '▶';
             if (currentAudio === audio) currentAudio = null;
         };
@@ -1414,34 +1665,38 @@ async function toggleTalk(forceState = null) {
             const stream = await navigator.mediaDevices.getUserMedia({ audio: true });
             mediaRecorder = new MediaRecorder(stream);
             audioChunks = [];
-            mediaRecorder.ondataavailable = e => audioChunks.push(e.data);
+            const liveStream = startAudioStream({
+                message_type: activeDirectTarget ? 'direct_message' : 'message',
+                target_user_id: activeDirectTarget || undefined,
+                timestamp: currentTimeLabel(),
+                text: 'Pendiente de transcripción'
+            });
+            mediaRecorder.ondataavailable = e => {
+                audioChunks.push(e.data);
+                if (liveStream) liveStream.chunk(e.data);
+            };
+            const directTarget = activeDirectTarget; // se limpia al soltar, antes de onstop
             mediaRecorder.onstop = async () => {
                 const durationSecs = Math.round((Date.now() - recordingStartTime) / 1000) || 1;
-                const audioBlob = new Blob(audioChunks, { type: 'audio/webm' });
-                const reader = new FileReader();
-                reader.readAsDataURL(audioBlob);
-                reader.onloadend = () => {
-                    const base64Audio = reader.result.split(',')[1];
-                    const now = new Date();
-                    const ts = `${String(now.getHours()).padStart(2,'0')}:${String(now.getMinutes()).padStart(2,'0')}`;
-                    const userFunction = localStorage.getItem('userFunction') || 'Operador';
-                    if (ws && ws.readyState === WebSocket.OPEN) {
-                        ws.send(JSON.stringify({
-                            type: activeDirectTarget ? 'direct_message' : 'message',
-                            target_user_id: activeDirectTarget || undefined,
-                            audio: base64Audio,
-                            sender: userId,
-                            function: userFunction,
-                            timestamp: ts,
-                            duration: durationSecs,
-                            text: 'Pendiente de transcripción'
-                        }));
-                    }
-                };
                 stream.getTracks().forEach(track => track.stop());
+                if (liveStream && await liveStream.end(durationSecs)) return;
+                const audioBlob = new Blob(audioChunks, { type: 'audio/webm' });
+                const now = new Date();
+                const ts = `${String(now.getHours()).padStart(2,'0')}:${String(now.getMinutes()).padStart(2,'0')}`;
+                const userFunction = localStorage.getItem('userFunction') || 'Operador';
+                await sendOrQueueAudio({
+                    type: directTarget ? 'direct_message' : 'message',
+                    target_user_id: directTarget || undefined,
+                    sender: userId,
+                    function: userFunction,
+                    timestamp: ts,
+                    duration: durationSecs,
+                    text: 'Pendiente de transcripción',
+                    client_key: liveStream ? liveStream.clientKey : newClientKey()
+                }, audioBlob);
             };
             recordingStartTime = Date.now();
-            mediaRecorder.start();
+            mediaRecorder.start(liveStream ? STREAM_CHUNK_MS : undefined);
             isRecording = true;
             startVuMeter(stream); // Start VU meter with same mic stream
             // Visual feedback: red button + pulse rings
@@ -1485,41 +1740,32 @@ async function toggleGroupTalk(forceState = null) {
             const stream = await navigator.mediaDevices.getUserMedia({ audio: true });
             mediaRecorder = new MediaRecorder(stream);
             audioChunks = [];
-            mediaRecorder.ondataavailable = e => audioChunks.push(e.data);
+            const liveStream = startAudioStream({
+                message_type: 'group_message',
+                group_id: currentGroup,
+                text: 'Mensaje de voz'
+            });
+            mediaRecorder.ondataavailable = e => {
+                audioChunks.push(e.data);
+                if (liveStream) liveStream.chunk(e.data);
+            };
+            const groupId = currentGroup;
             mediaRecorder.onstop = async () => {
                 const durationSecs = Math.round((Date.now() - recordingStartTime) / 1000) || 1;
-                const audioBlob = new Blob(audioChunks, { type: 'audio/webm' });
-                const reader = new FileReader();
-                reader.readAsDataURL(audioBlob);
-                reader.onloadend = () => {
-                    const base64Audio = reader.result.split(',')[1];
-                    if (ws && ws.readyState === WebSocket.OPEN) {
-                        ws.send(JSON.stringify({
-                            type: 'group_message',
-                            group_id: currentGroup,
-                            audio: base64Audio,
-                            sender: userId,
-                            duration: durationSecs,
-                            text: 'Mensaje de voz'
-                        }));
-                    } else {
-                        navigator.serviceWorker.controller?.postMessage({
-                            type: 'QUEUE_MESSAGE',
-                            message: {
-                                type: 'group_message',
-                                group_id: currentGroup,
-                                audio: base64Audio,
-                                sender: userId,
-                                duration: durationSecs,
-                                text: 'Mensaje de voz'
-                            }
-                        });
-                    }
-                };
                 stream.getTracks().forEach(track => track.stop());
+                if (liveStream && await liveStream.end(durationSecs)) return;
+                const audioBlob = new Blob(audioChunks, { type: 'audio/webm' });
+                await sendOrQueueAudio({
+                    type: 'group_message',
+                    group_id: groupId,
+                    sender: userId,
+                    duration: durationSecs,
+                    text: 'Mensaje de voz',
+                    client_key: liveStream ? liveStream.clientKey : newClientKey()
+                }, audioBlob);
             };
             recordingStartTime = Date.now();
-            mediaRecorder.start();
+            mediaRecorder.start(liveStream ? STREAM_CHUNK_MS : undefined);
             isGroupRecording = true;
             groupTalkButton.classList.add('recording');
         } catch (err) {
@@ -1750,8 +1996,8 @@ async function showHistory() {
                 </div>
             `;
             item.addEventListener('click', () => {
-                if (msg.audio) {
-                    playAudio(msg.audio, name, null);
+                if (msg.audio_url || msg.audio) {
+                    playAudio(playableAudioUrl(msg.audio_url) || msg.audio, name, null);
                 }
             });
             historyList.appendChild(item);
@@ -1967,6 +2213,21 @@ function completeLogout() {
     updateSwipeHint();
 }
 
+// El servidor manda los clips por URL (/audio/<hash>); los mensajes guardados antes de
+// eso todavía traen el audio en base64. Devuelve la URL a reproducir y cómo liberarla.
+function audioDataToUrl(audioData) {
+    if (typeof audioData === 'string' && audioData.startsWith('/audio/')) {
+        return { url: audioData, revoke: () => {} };
+    }
+    if (typeof audioData === 'string' && audioData.startsWith('blob:')) {
+        return { url: audioData, revoke: () => URL.revokeObjectURL(audioData) };
+    }
+    const audioBlob = base64ToBlob(audioData, 'audio/webm');
+    if (!audioBlob) return null;
+    const url = URL.createObjectURL(audioBlob);
+    return { url, revoke: () => URL.revokeObjectURL(url) };
+}
+
 function base64ToBlob(base64, mime) {
     try {
         const byteString = atob(base64);
@@ -2272,7 +2533,13 @@ document.addEventListener('DOMContentLoaded', () => {
 
     // PWA Widget communication listener
     navigator.serviceWorker?.addEventListener('message', (event) => {
-        if (event.data && event.data.type === 'PTT_WIDGET_START') {
+        if (event.data && event.data.type === 'SEND_MESSAGE') {
+            // Mensaje de la cola offline: lleva su client_key original, así que si ya había
+            // llegado al servidor (o lo manda otra pestaña) se descarta allá.
+            if (ws && ws.readyState === WebSocket.OPEN) {
+                ws.send(JSON.stringify(event.data.message));
+            }
+        } else if (event.data && event.data.type === 'PTT_WIDGET_START') {
             console.log('PTT triggered from PWA widget shortcut');
             toggleTalk(true);
             setTimeout(() => toggleTalk(false), 5000); // Record 5s default if triggered remotely
@@ -0,0 +1,28 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# main lee la configuración al importarse: SQLite temporal (vacía y no ausente para que
+# load_dotenv no complete DATABASE_URL desde un .env), transcripción de prueba y
+# decodificación en hilos en lugar de procesos.
+os.environ["DATABASE_URL"] = ""
+os.environ["SQLITE_PATH"] = os.path.join(tempfile.mkdtemp(), "tests.db")
+os.environ["TRANSCRIBE_BACKEND"] = "stub"
+os.environ["DECODE_PROCESSES"] = "0"
+os.environ["BACKPLANE"] = ""
+# Los templates y estáticos se montan con rutas relativas
+os.chdir(ROOT)
+sys.path.insert(0, ROOT)
+
+import main  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+
+
+@pytest.fixture
+def client():
+    with TestClient(main.app) as test_client:
+        yield test_client
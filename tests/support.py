@@ -0,0 +1,65 @@
+import base64
+import io
+import json
+import itertools
+import threading
+import time
+
+import numpy as np
+import soundfile as sf
+
+_clip_seed = itertools.count(1)
+
+
+def token(employee_id: str, surname: str = "Perez", function: str = "Rampa") -> str:
+    return base64.b64encode(f"{employee_id}_{surname}_{function}".encode()).decode()
+
+
+def clip(seconds: float = 1.0) -> str:
+    """WAV en base64, distinto en cada llamada para que la deduplicación no lo descarte."""
+    step = 4 + next(_clip_seed) / 7
+    samples = (np.sin(np.arange(int(16000 * seconds)) / step) * 0.3).astype("float32")
+    buf = io.BytesIO()
+    sf.write(buf, samples, 16000, format="WAV")
+    return base64.b64encode(buf.getvalue()).decode()
+
+
+def receive(ws, timeout: float = 5.0) -> dict:
+    """receive_json con límite de tiempo: un mensaje que no llega falla el test en vez de
+    colgarlo. La espera corre en un thread aparte para usar solo la API pública de TestClient."""
+    result = {}
+
+    def _receive():
+        try:
+            result["message"] = ws.receive_json()
+        except BaseException as e:
+            result["error"] = e
+
+    thread = threading.Thread(target=_receive, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    if thread.is_alive():
+        raise TimeoutError(f"No llegó ningún mensaje en {timeout:g}s")
+    if "error" in result:
+        raise result["error"]
+    return result["message"]
+
+
+def receive_until(ws, message_type: str, timeout: float = 5.0, **match) -> dict:
+    while True:
+        message = receive(ws, timeout)
+        if message.get("type") == message_type and all(message.get(k) == v for k, v in match.items()):
+            return message
+
+
+def send(ws, message_type: str, /, **fields):
+    ws.send_text(json.dumps({"type": message_type, **fields}))
+
+
+def settle(condition, timeout=5.0):
+    """Espera algo que el servidor hace en segundo plano (p. ej. el finally del endpoint
+    después de que el test cierra el socket)."""
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.02)
@@ -0,0 +1,61 @@
+import base64
+import io
+
+import numpy as np
+import soundfile as sf
+
+import main
+from support import clip, receive_until, send, token
+
+
+def test_original_upload_is_served_to_clients_without_opus(client):
+    original = base64.b64decode(clip())
+    with client.websocket_connect(f"/ws/{token('601', 'Ibarra')}") as ws:
+        send(ws, "create_group", group_id="Safari", password="clave")
+        receive_until(ws, "group_joined")
+        send(ws, "audio", data=base64.b64encode(original).decode(), group_id="Safari", duration=1,
+             client_key="ios-1", mime="audio/wav")
+        message = receive_until(ws, "group_message")
+
+    assert message["audio_mime"] == main.INGEST_MIME
+    transcoded = client.get(message["audio_url"])
+    assert transcoded.headers["content-type"].startswith("audio/ogg")
+    fallback = client.get(message["audio_url"] + "?original=1")
+    assert fallback.status_code == 200
+    assert fallback.headers["content-type"] == "audio/wav"
+    assert fallback.content == original
+    assert fallback.headers["etag"] != transcoded.headers["etag"]
+
+
+def test_opus_upload_is_not_kept_twice():
+    samples = (np.sin(np.arange(16000) / 5) * 0.3).astype("float32")
+    buf = io.BytesIO()
+    sf.write(buf, samples, 16000, format="OGG", subtype="VORBIS")
+    result = main.ingest_clip(buf.getvalue(), "audio/ogg")
+    assert result["mime"] == main.INGEST_MIME
+    assert result["original"] is None
+
+
+def test_range_requests(client):
+    audio = base64.b64decode(clip())
+    stored = main.save_message("Range_Rampa", audio, "texto", "10:00", mime="audio/wav")
+    url = f"/audio/{stored['audio_hash']}"
+    size = len(audio)
+
+    def get(range_header):
+        return client.get(url, headers={"Range": range_header})
+
+    partial = get("bytes=10-19")
+    assert partial.status_code == 206
+    assert partial.content == audio[10:20]
+    assert partial.headers["content-range"] == f"bytes 10-19/{size}"
+    assert get("bytes=-5").content == audio[-5:]
+    assert get(f"bytes={size - 2}-{size + 100}").content == audio[-2:]
+    # Múltiple, ilegible o invertido: se ignora y va el clip entero
+    for ignored in ("bytes=0-1,5-6", "items=0-1", "bytes=5-2", "bytes=-"):
+        response = get(ignored)
+        assert response.status_code == 200 and response.content == audio
+    for unsatisfiable in (f"bytes={size}-", "bytes=-0"):
+        response = get(unsatisfiable)
+        assert response.status_code == 416
+        assert response.headers["content-range"] == f"bytes */{size}"
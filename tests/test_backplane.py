@@ -0,0 +1,41 @@
+import importlib.util
+import os
+
+from fastapi.testclient import TestClient
+
+import main
+from support import clip, receive_until, send, settle, token
+
+
+def load_worker(name, monkeypatch):
+    """Otra copia de main.py con su propio estado, como un segundo proceso de uvicorn."""
+    monkeypatch.setenv("BACKPLANE", "memory")
+    spec = importlib.util.spec_from_file_location(name, os.path.join(os.path.dirname(main.__file__), "main.py"))
+    worker = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(worker)
+    return worker
+
+
+def test_group_message_and_transcript_cross_workers(monkeypatch):
+    worker_a = load_worker("worker_a", monkeypatch)
+    worker_b = load_worker("worker_b", monkeypatch)
+    worker_b.backplane = worker_b.InMemoryBackplane(worker_a.backplane.hub)
+    assert worker_a.NODE_ID != worker_b.NODE_ID
+
+    with TestClient(worker_a.app) as client_a, TestClient(worker_b.app) as client_b:
+        settle(lambda: len(worker_a.backplane.hub.members) == 2)
+        with client_a.websocket_connect(f"/ws/{token('501', 'Acosta')}") as ws_a, \
+                client_b.websocket_connect(f"/ws/{token('502', 'Bravo')}") as ws_b:
+            send(ws_a, "create_group", group_id="Backplane", password="clave")
+            receive_until(ws_a, "group_joined")
+            send(ws_b, "join_group", group_id="Backplane", password="clave")
+            receive_until(ws_b, "group_joined")
+
+            send(ws_a, "audio", data=clip(), group_id="Backplane", duration=1, client_key="cross-worker")
+            audio = receive_until(ws_b, "group_message", timeout=10)
+            assert audio["sender_id"] == "Acosta_Rampa"
+            update = receive_until(ws_b, "transcript_update", timeout=10)
+            assert update["id"] == audio["id"]
+            assert update["text"].startswith("Transcripción de prueba")
+        assert worker_b.backplane.stats["received"] >= 2
+        assert worker_a.backplane.stats["errors"] == worker_b.backplane.stats["errors"] == 0
@@ -0,0 +1,44 @@
+import random
+import string
+
+import main
+
+
+def login(client, surname, password, forwarded_for):
+    return client.post("/login", json={"surname": surname, "password": password},
+                       headers={"X-Forwarded-For": forwarded_for})
+
+
+def test_spoofed_forwarded_for_does_not_escape_the_ip_limit(client, monkeypatch):
+    monkeypatch.setattr(main, "TRUSTED_PROXY_HOPS", 1)
+    monkeypatch.setattr(main, "LOGIN_MAX_FAILURES_PER_IP", 3)
+    monkeypatch.setattr(main, "LOGIN_FAILURE_DELAY_SECONDS", 0.01)
+    statuses = [login(client, "Nadie", "mala", f"10.0.0.{n}, 203.0.113.7").status_code for n in range(4)]
+    assert statuses == [401, 401, 401, 429]
+    # Otra IP real (la que agrega el proxy) sigue pudiendo intentar
+    assert login(client, "Nadie", "mala", "10.0.0.1, 203.0.113.8").status_code == 401
+
+
+def test_failed_logins_slow_down_a_surname_without_locking_it_out(client, monkeypatch):
+    monkeypatch.setattr(main, "TRUSTED_PROXY_HOPS", 1)
+    monkeypatch.setattr(main, "LOGIN_FAILURE_DELAY_SECONDS", 0.01)
+    surname = "Victima" + "".join(random.choices(string.ascii_lowercase, k=6))
+    assert client.post("/register", json={"surname": surname, "password": "correcta1"}).status_code == 200
+    delayed = main.credential_stats["login_delayed"]
+    for n in range(main.LOGIN_MAX_FAILURES + 2):
+        assert login(client, surname, "mala", f"198.51.100.{n}").status_code == 401
+    response = login(client, surname, "correcta1", "192.0.2.1")
+    assert response.status_code == 200
+    assert main.credential_stats["login_delayed"] - delayed == 3
+    assert main.login_delay(f"login:{surname.lower()}") == 0
+
+
+def test_forwarded_for_is_ignored_without_trusted_proxies(monkeypatch):
+    class Client:
+        host = "192.0.2.10"
+
+    monkeypatch.setattr(main, "TRUSTED_PROXY_HOPS", 0)
+    assert main.client_ip({"x-forwarded-for": "1.1.1.1"}, Client) == "192.0.2.10"
+    monkeypatch.setattr(main, "TRUSTED_PROXY_HOPS", 2)
+    assert main.client_ip({"x-forwarded-for": "1.1.1.1, 203.0.113.7, 10.0.0.2"}, Client) == "203.0.113.7"
+    assert main.client_ip({"x-forwarded-for": "10.0.0.2"}, Client) == "192.0.2.10"
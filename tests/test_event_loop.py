@@ -0,0 +1,92 @@
+import asyncio
+import threading
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+from support import clip, receive_until, send, settle, token
+
+
+def test_ping_answered_while_history_query_is_running(client, monkeypatch):
+    started = threading.Event()
+    release = threading.Event()
+    original = main.get_history_page
+
+    def slow_history_page(*args, **kwargs):
+        started.set()
+        release.wait(10)
+        return original(*args, **kwargs)
+
+    monkeypatch.setattr(main, "get_history_page", slow_history_page)
+    responses = []
+    request = threading.Thread(target=lambda: responses.append(client.get("/api/history")))
+    request.start()
+    try:
+        assert started.wait(5)
+        with client.websocket_connect(f"/ws/{token('201')}") as ws:
+            sent = time.monotonic()
+            send(ws, "ping")
+            receive_until(ws, "pong", timeout=2)
+            assert time.monotonic() - sent < 1
+            assert request.is_alive()
+    finally:
+        release.set()
+        request.join(10)
+    assert responses[0].status_code == 200
+
+
+def test_app_can_start_twice_in_the_same_process():
+    for round_ in range(2):
+        with TestClient(main.app) as test_client:
+            with test_client.websocket_connect(f"/ws/{token(f'21{round_}')}") as ws:
+                send(ws, "create_group", group_id=f"Reinicio{round_}", password="clave")
+                receive_until(ws, "group_joined")
+                send(ws, "ping")
+                receive_until(ws, "pong")
+            assert test_client.get("/api/history").status_code == 200
+
+
+def test_transcription_survives_a_restart():
+    for round_ in range(2):
+        with TestClient(main.app) as test_client:
+            with test_client.websocket_connect(f"/ws/{token(f'22{round_}')}") as ws:
+                send(ws, "create_group", group_id=f"Transcribe{round_}", password="clave")
+                receive_until(ws, "group_joined")
+                send(ws, "audio", data=clip(), group_id=f"Transcribe{round_}", duration=1,
+                     client_key=f"restart-{round_}")
+                update = receive_until(ws, "transcript_update", timeout=10)
+                assert update["text"].startswith("Transcripción de prueba")
+
+
+def test_hung_recognizer_keeps_its_slot_and_is_not_retried(monkeypatch):
+    release = threading.Event()
+    calls = []
+
+    def hung_recognize(wav_bytes):
+        calls.append(wav_bytes)
+        release.wait(10)
+        return "tarde"
+
+    backend = main.transcription
+    monkeypatch.setattr(main, "TRANSCRIBE_WORKERS", 1)
+    monkeypatch.setattr(backend, "recognize", hung_recognize)
+    monkeypatch.setattr(backend, "timeout", 0.3)
+    monkeypatch.setattr(backend, "retries", 2)
+    monkeypatch.setattr(backend, "breaker_failures", 100)
+    monkeypatch.setattr(backend, "stats", dict.fromkeys(backend.stats, 0))
+    with TestClient(main.app) as test_client:
+        try:
+            for _ in range(2):
+                with pytest.raises(asyncio.TimeoutError):
+                    test_client.portal.call(backend.transcribe, b"wav")
+            assert len(calls) == 1
+            assert backend.in_flight == 1
+            assert backend.stats["retries"] == 0
+            assert backend.stats["saturated"] == 1
+        finally:
+            release.set()
+        settle(lambda: backend.in_flight == 0)
+        monkeypatch.setattr(backend, "recognize", lambda wav_bytes: "a tiempo")
+        assert test_client.portal.call(backend.transcribe, b"wav") == "a tiempo"
@@ -0,0 +1,42 @@
+import asyncio
+
+import main
+
+
+class FakeSocket:
+    def __init__(self, delay):
+        self.delay = delay
+        self.sent = []
+
+    async def send_text(self, frame):
+        await asyncio.sleep(self.delay)
+        self.sent.append(frame)
+
+    async def close(self, code=1000):
+        pass
+
+
+def test_fanout_latency_waits_for_the_slowest_send(monkeypatch):
+    monkeypatch.setattr(main, "users", {})
+    monkeypatch.setattr(main, "fanout_stats", {})
+
+    async def scenario():
+        sockets = {"rapido": FakeSocket(0), "lento": FakeSocket(0.2), "colgado": FakeSocket(10)}
+        for tk, ws in sockets.items():
+            main.users[tk] = main.UserRecord(tk, tk, "Rampa", websocket=ws,
+                                             outbox=main.Outbox(tk, ws, send_timeout=0.4))
+        failed = await main.fanout(list(sockets), {"type": "group_message"}, kind="prueba")
+        stats = main.fanout_stats["prueba"]
+        # Encolar no cierra la difusión: falta que los writers manden
+        assert failed == [] and stats["completed"] == 0
+        while not stats["completed"]:
+            await asyncio.sleep(0.02)
+        for user in main.users.values():
+            user.outbox.close(close_socket=False)
+        return sockets, stats
+
+    sockets, stats = asyncio.run(scenario())
+    assert len(sockets["rapido"].sent) == len(sockets["lento"].sent) == 1
+    assert stats["broadcasts"] == stats["completed"] == 1
+    assert stats["failed"] == 1  # el envío colgado venció
+    assert 400 <= stats["last_latency_ms"] < 2000
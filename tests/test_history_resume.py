@@ -0,0 +1,29 @@
+import time
+
+import main
+from support import clip, receive_until, send, token
+
+
+def test_resume_from_pending_message_replays_its_transcript(client, monkeypatch):
+    monkeypatch.setattr(main, "TRANSCRIBE_STUB_DELAY_MS", 300)
+    sender = token("301", "Gomez")
+    with client.websocket_connect(f"/ws/{sender}") as ws:
+        send(ws, "create_group", group_id="Reanudar", password="clave")
+        receive_until(ws, "group_joined")
+        send(ws, "audio", data=clip(), group_id="Reanudar", duration=1, client_key="resume-1")
+        message = receive_until(ws, "group_message")
+        assert message["text"] == main.PENDING_TRANSCRIPT
+    # El transcript_update sale con el socket ya cerrado
+    deadline = time.monotonic() + 10
+
+    def stored_text():
+        return main.get_history_page(after_id=message["id"] - 1, limit=1, meta_only=True)[0][2]
+
+    while stored_text() == main.PENDING_TRANSCRIPT:
+        assert time.monotonic() < deadline
+        time.sleep(0.05)
+
+    with client.websocket_connect(f"/ws/{sender}?last_seen_id={message['id'] - 1}") as ws:
+        replayed = receive_until(ws, "message", id=message["id"])
+        assert replayed["text"].startswith("Transcripción de prueba")
+        receive_until(ws, "history_end")
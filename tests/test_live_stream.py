@@ -0,0 +1,94 @@
+import asyncio
+import base64
+from contextlib import contextmanager
+
+import main
+from support import clip, receive_until, send, settle, token
+
+
+def stream_frames(ws, stream_id, group_id, audio, chunks=2, client_key=None):
+    send(ws, "stream_start", stream_id=stream_id, message_type="group_message", group_id=group_id,
+         mime="audio/wav", client_key=client_key)
+    size = -(-len(audio) // chunks)
+    for seq in range(chunks):
+        header = {"type": "stream_chunk", "stream_id": stream_id, "seq": seq}
+        ws.send_bytes(main.encode_binary_frame(header, audio[seq * size:(seq + 1) * size]))
+
+
+@contextmanager
+def joined(client, employee_id, surname, group_id, create=False):
+    with client.websocket_connect(f"/ws/{token(employee_id, surname)}") as ws:
+        send(ws, "create_group" if create else "join_group", group_id=group_id, password="clave")
+        receive_until(ws, "group_joined")
+        yield ws
+
+
+def test_malformed_seq_gets_an_error_frame_and_keeps_the_socket(client):
+    with joined(client, "501", "Mendez", "Vivo1", create=True) as ws:
+        send(ws, "stream_start", stream_id="s1", message_type="group_message", group_id="Vivo1", mime="audio/wav")
+        ws.send_bytes(main.encode_binary_frame({"type": "stream_chunk", "stream_id": "s1", "seq": "x"}, b"audio"))
+        error = receive_until(ws, "stream_error")
+        assert error["stream_id"] == "s1"
+        assert not any(stream.token == token("501", "Mendez") for stream in main.live_streams.values())
+        send(ws, "ping")
+        receive_until(ws, "pong")
+
+
+def test_stream_and_following_clip_are_delivered_in_order(client):
+    with joined(client, "511", "Paz", "Vivo2", create=True) as speaker, \
+            joined(client, "512", "Quiroga", "Vivo2") as listener:
+        audio = base64.b64decode(clip(2.0))
+        stream_frames(speaker, "s2", "Vivo2", audio, client_key="stream-key")
+        send(speaker, "stream_end", stream_id="s2", duration=2)
+        send(speaker, "audio", data=clip(0.5), group_id="Vivo2", duration=1, client_key="after-stream")
+
+        first = receive_until(listener, "group_message")
+        second = receive_until(listener, "group_message")
+        assert first.get("stream") and first["client_key"] == "stream-key"
+        assert second["client_key"] == "after-stream"
+        assert second["id"] > first["id"]
+
+
+def test_stream_retried_as_full_clip_is_stored_once(client):
+    with joined(client, "521", "Rojas", "Vivo3", create=True) as speaker:
+        audio = base64.b64decode(clip())
+        send(speaker, "audio", data=base64.b64encode(audio).decode(), group_id="Vivo3", duration=1,
+             client_key="same-key")
+        stored = receive_until(speaker, "group_message")
+        stream_frames(speaker, "s3", "Vivo3", audio, client_key="same-key")
+        send(speaker, "stream_end", stream_id="s3", duration=1)
+        ack = receive_until(speaker, "message_ack")
+        assert ack == {"type": "message_ack", "client_key": "same-key", "id": stored["id"], "duplicate": True}
+
+
+def test_stream_interrupted_by_disconnect_is_discarded(client, monkeypatch):
+    discarded = []
+    monkeypatch.setattr(main, "delete_stream_chunks", discarded.append)
+    with joined(client, "531", "Soria", "Vivo4", create=True) as speaker:
+        stream_frames(speaker, "s4", "Vivo4", base64.b64decode(clip()))
+        send(speaker, "ping")
+        receive_until(speaker, "pong")
+    settle(lambda: discarded)
+    assert not any(stream.token == token("531", "Soria") for stream in main.live_streams.values())
+    assert main.stream_stats["aborted"] >= 1
+
+
+def test_stream_over_the_size_limit_is_closed_without_blocking_the_socket(client, monkeypatch):
+    release = asyncio.Event()
+    original = main.ingest_audio
+
+    async def slow_ingest(*args, **kwargs):
+        await release.wait()
+        return await original(*args, **kwargs)
+
+    monkeypatch.setattr(main, "STREAM_MAX_BYTES", 1000)
+    monkeypatch.setattr(main, "ingest_audio", slow_ingest)
+    with joined(client, "541", "Toledo", "Vivo5", create=True) as speaker:
+        stream_frames(speaker, "s5", "Vivo5", base64.b64decode(clip()), client_key="too-long")
+        send(speaker, "ping")
+        receive_until(speaker, "pong")
+        assert not any(stream.token == token("541", "Toledo") for stream in main.live_streams.values())
+        assert main._stream_tasks
+        client.portal.call(release.set)
+        stored = receive_until(speaker, "group_message", timeout=10)
+        assert stored["client_key"] == "too-long"
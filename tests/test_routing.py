@@ -0,0 +1,47 @@
+import main
+from support import receive_until, send, settle, token
+
+
+def test_routing_indexes_stay_consistent_across_groups(client):
+    alice, bob, carla = token("401", "Alonso"), token("402", "Benitez"), token("403", "Castro", "Tractorista")
+    with client.websocket_connect(f"/ws/{alice}") as ws_a, client.websocket_connect(f"/ws/{bob}") as ws_b:
+        receive_until(ws_a, "connection_success")
+        receive_until(ws_b, "connection_success")
+        assert main.routing.check() == []
+        assert {alice, bob} <= main.routing.lobby
+
+        send(ws_a, "create_group", group_id="Norte", password="clave")
+        receive_until(ws_a, "group_joined")
+        send(ws_b, "create_group", group_id="Sur", password="clave")
+        receive_until(ws_b, "group_joined")
+        assert main.routing.check() == []
+        assert main.routing.groups["Norte"] == {alice}
+
+        with client.websocket_connect(f"/ws/{carla}") as ws_c:
+            receive_until(ws_c, "connection_success")
+            send(ws_c, "join_group", group_id="Norte", password="clave")
+            receive_until(ws_c, "group_joined")
+            assert main.routing.groups["Norte"] == {alice, carla}
+            assert main.routing.user_tokens["Castro_Tractorista"] == {carla}
+
+            # Pasarse de canal saca del anterior
+            send(ws_b, "join_group", group_id="Norte", password="clave")
+            receive_until(ws_b, "group_joined")
+            assert "Sur" not in main.routing.groups
+            assert main.routing.check() == []
+        settle(lambda: carla not in main.routing.online)
+        assert main.routing.groups["Norte"] == {alice, bob}
+        assert main.routing.check() == []
+
+        send(ws_a, "leave_group")
+        receive_until(ws_a, "group_left")
+        assert alice in main.routing.lobby
+        assert main.routing.check() == []
+
+        send(ws_b, "logout")
+        receive_until(ws_b, "logout_success")
+        settle(lambda: bob not in main.routing.user_tokens.get("Benitez_Rampa", ()))
+        assert main.routing.check() == []
+    settle(lambda: not main.routing.online & {alice, bob, carla})
+    assert "Norte" not in main.routing.groups
+    assert main.routing.check() == []
@@ -0,0 +1,59 @@
+import re
+from datetime import datetime, timedelta
+
+import main
+
+
+class RecordingCursor:
+    """Cursor de mentira: anota el SQL y contesta lo mínimo que piden las migraciones."""
+
+    def __init__(self, rows=()):
+        self.statements = []
+        self.rows = list(rows)
+        self.rowcount = 1
+
+    def execute(self, sql, params=None):
+        self.statements.append(" ".join(sql.split()))
+
+    def fetchone(self):
+        return self.rows.pop(0) if self.rows else None
+
+    def fetchall(self):
+        return []
+
+    def matching(self, pattern):
+        return [sql for sql in self.statements if re.search(pattern, sql)]
+
+
+def test_postgres_partition_ddl(monkeypatch):
+    monkeypatch.setattr(main, "USE_POSTGRES", True)
+    c = RecordingCursor(rows=[("r",)])
+    main._migration_retention_storage(c)
+
+    [create] = c.matching(r"^CREATE TABLE messages ")
+    assert create.endswith("PRIMARY KEY (id, date)) PARTITION BY RANGE (date)")
+    assert c.matching(r"^CREATE TABLE messages_default PARTITION OF messages DEFAULT$")
+    today = datetime.utcnow().date()
+    for n in range(main.PARTITION_DAYS_AHEAD + 1):
+        day, next_day = today + timedelta(days=n), today + timedelta(days=n + 1)
+        assert c.matching(rf"^CREATE TABLE IF NOT EXISTS messages_{day:%Y%m%d} PARTITION OF messages "
+                          rf"FOR VALUES FROM \('{day}'\) TO \('{next_day}'\)$")
+    assert c.statements[-1].endswith("ON messages (user_id, client_key, date)")
+
+
+def test_postgres_client_keys_are_unique_across_days(monkeypatch):
+    monkeypatch.setattr(main, "USE_POSTGRES", True)
+    c = RecordingCursor()
+    main._migration_message_client_keys(c)
+    [create] = c.matching(r"^CREATE TABLE IF NOT EXISTS message_client_keys ")
+    assert "PRIMARY KEY (user_id, client_key))" in create
+    assert "PARTITION" not in create
+
+    # Un reintento que llega al día siguiente encuentra el mensaje por la tabla de claves
+    c = RecordingCursor(rows=[(7, "hash", 10, "audio/webm")])
+    c.rowcount = 0
+    stored = main._insert_message(c, "Perez_Rampa", b"audio", "texto", "23:59", 1, "audio/webm",
+                                  client_key="retry")
+    assert stored == {"id": 7, "audio_hash": "hash", "audio_size": 10, "audio_mime": "audio/webm",
+                      "duplicate": True}
+    assert not c.matching(r"^INSERT INTO messages ")